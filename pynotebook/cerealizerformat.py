@@ -40,24 +40,35 @@ def _replace_styles(texel, table):
     if texel.is_group or texel.is_container:
         for child in texel.childs:
             _replace_styles(child, table)
+        if len(texel.weights) != len(texeltree.weightnames):
+            # file was written before weight channels were added
+            texel.compute_weights()
     else:
-        if 'style' in texel.__dict__:
-            sid = id(texel.style)
+        style = getattr(texel, 'style', None)
+        if style is not None:
+            sid = id(style)
             if not sid in table:
-                table[sid] = styles.create_style(**texel.style)
+                table[sid] = styles.create_style(**style)
             texel.style = table[sid]
-        if isinstance(texel, texeltree.NewLine) and 'parstyle' in texel.__dict__:
+        if isinstance(texel, texeltree.NewLine):
             sid = id(texel.parstyle)
             if not sid in table:
-                table[sid] = texel.parstyle = styles.create_style(**texel.parstyle)
+                table[sid] = styles.create_style(**texel.parstyle)
             texel.parstyle = table[sid]
 
-def loads(s):
+def loads(s, interner=None):
+    """Loads a model from *s*.
+
+       If an *interner* (see texeltree.Interner) is given, identical
+       subtrees of the loaded texel tree are shared.
+    """
     assert s.startswith(magic)
     s = cmagic+s[len(magic):]
     
     model =  cerealizer.Dumper().undump(BytesIO(s))
     _replace_styles(model.texel, {})
+    if interner is not None:
+        model.texel = interner.intern(model.texel)
     return model
 
 
@@ -86,3 +97,60 @@ def test_00():
     assert str(model1.texel) == str(model2.texel)
     assert model1.get_style(5) is model2.get_style(5)
     assert model1.get_parstyle(5) is model2.get_parstyle(5)
+    assert texeltree.content_hash(model1.texel) == \
+        texeltree.content_hash(model2.texel)
+
+
+def _mk_notebook(ncells):
+    # A generated notebook with many repeated outputs and bitmaps
+    model = textmodel.TextModel()
+    for k in range(ncells):
+        tmp = textmodel.TextModel(u'# step %i\nrun()' % (k % 10))
+        out = textmodel.TextModel(u'Result\n'+u'0.000 1.000 2.000\n'*20).texel
+        if k % 3 == 0:
+            bitmap = nbtexels.BitmapRGB(bytes(3*64*64), (64, 64))
+            out = texeltree.grouped([out, bitmap])
+        cell = nbtexels.ScriptingCell(tmp.texel, out, number=k)
+        model.insert(len(model), mk_textmodel(cell))
+    return model
+
+
+def test_01():
+    "loading with interning"
+    model = _mk_notebook(20)
+    s = dumps(model)
+    interner = texeltree.Interner()
+    model1 = loads(s)
+    model2 = loads(s, interner)
+    assert interner.shared > 0 and interner.saved > 0
+    assert texeltree.content_hash(model1.texel) == \
+        texeltree.content_hash(model2.texel)
+    assert str(model1.texel) == str(model2.texel)
+    assert model2.get_style(5) is model1.get_style(5)
+
+
+def benchmark_00():
+    "memory saved by interning on load"
+    import tracemalloc
+    import time
+    s = dumps(_mk_notebook(2000))
+    measured = None # interner of the measured run
+    for interning in (False, True):
+        # The first load is timed, the second one measures memory.
+        # Each load gets its own interner.
+        if interning:
+            timed = texeltree.Interner()
+            measured = texeltree.Interner()
+        else:
+            timed = measured = None
+        t0 = time.time()
+        loads(s, timed)
+        t1 = time.time()
+        tracemalloc.start()
+        model = loads(s, measured)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print("interning: %-5s  load: %.2f s  memory: %.1f MB" % (
+            interning, t1-t0, current/1e6))
+    print("shared texels: %i, estimated savings: %.1f MB" % (
+        measured.shared, measured.saved/1e6))
@@ -15,7 +15,8 @@ from pynotebook.graphics import LineColor, LineWidth, LineDashes, LineJoin, \
     LineCap, FillColor, Line, Polygon, Path, Circle, Ellipse, Arc, \
     Rectangle, Font, GraphicsText, Translate, Rotate, Scale
 from pynotebook.textmodel.texeltree import Group, Text, NewLine, Tabulator, G,\
-    T, dump, EMPTYSTYLE, NULL_TEXEL, grouped, hash_style
+    T, dump, EMPTYSTYLE, NULL_TEXEL, grouped, hash_style, iter_leaves, \
+    TreeBuilder, as_style
 from functools import reduce
 from base64 import b64encode
 import json
@@ -142,7 +143,7 @@ class _TexelProcessor:
         return r
 
     def handle_UnformattedText(self, texel):
-        strings = [t.text for t in _flatten(texel)]
+        strings = [leaf.text for i1, i2, leaf in iter_leaves(texel)]
         return reduce(_join_strings, strings, [])
 
     ### nbtexels
@@ -348,13 +349,13 @@ def _extract_graphicsobjects(obj):
 def _extract_texel(obj, state):
     """Extract a single texel from a json object"""
     if type(obj) is list:
-        l = []
+        builder = TreeBuilder()
         for elem in obj:
             if type(elem) is dict and 'cmd' in elem:
                 _eval_cmd(elem, state)
             else:
-                l.append(_extract_texel(elem, state))
-        return grouped(l)
+                builder.append(_extract_texel(elem, state))
+        return builder.get_texel()
 
     if type(obj) is str:
         return Text(obj, style=state.current_style)
@@ -432,6 +433,7 @@ def _eval_cmd(obj, state):
         style = d.copy()
         name = style['name']
         del style['name']
+        style = as_style(style)
         state.defined_styles[name] = style
         state.current_style = style
 
@@ -444,6 +446,7 @@ def _eval_cmd(obj, state):
         parstyle = d.copy()
         name = parstyle['name']
         del parstyle['name']
+        parstyle = as_style(parstyle)
         state.defined_parstyles[name] = parstyle
         state.current_parstyle = parstyle
 
@@ -456,14 +459,17 @@ def _eval_cmd(obj, state):
         raise Exception('Unknown command %s' % cmd)
 
     
-def from_simple(obj):
+def from_simple(obj, interner=None):
     class state:
-        current_style = {}
+        current_style = EMPTYSTYLE
         defined_styles = {}
-        current_parstyle = {}
+        current_parstyle = EMPTYSTYLE
         defined_parstyles = {}
 
-    return _extract_texel(obj, state)
+    texel = _extract_texel(obj, state)
+    if interner is not None:
+        texel = interner.intern(texel)
+    return texel
 
 
 def dumps(model):
@@ -471,13 +477,13 @@ def dumps(model):
     return magic+json.dumps(simple, indent=2)
 
 
-def loads(s):
+def loads(s, interner=None):
     n = len(magic)
     if not s.startswith(magic):
         raise('Not a pynotebook-file:', repr(s[:n]))
     model = TextModel()
     simple = json.loads(s[n:])
-    model.texel = from_simple(simple)
+    model.texel = from_simple(simple, interner)
     return model
 
 
@@ -3,7 +3,9 @@
 
 from .textmodel.textmodel import TextModel, dump_range
 from .textmodel.texeltree import Texel, T, G, NL, Container, Single, \
-    iter_childs, dump, NULL_TEXEL, length, grouped, copy
+    iter_childs, dump, NULL_TEXEL, length, grouped, copy, add_weight, \
+    find_child, get_sums
+from .textmodel.weights import find_weight, get_weight
 
 import wx
 import base64    
@@ -18,8 +20,15 @@ def mk_textmodel(texel):
 
 
 
+# Weight channel counting the cells. It allows to locate cells by
+# bisection instead of walking through the notebook.
+CELLS = add_weight('cells')
+
+
 class Cell(Container):
-    pass
+    # Regardless of its content, a cell counts as one cell.
+    functions = Container.functions[:CELLS]+(lambda l:1,)+ \
+        Container.functions[CELLS+1:]
 
 
 class TextCell(Cell):
@@ -93,13 +102,71 @@ class NotFound(Exception): pass
 def find_cell(texel, i, i0=0):
     if isinstance(texel, Cell):
         return i0, texel
-    elif texel.is_group:
-        for j1, j2, child in iter_childs(texel):
-            if j1<=i<j2:
-                return find_cell(child, i-j1, i0+j1)
+    elif texel.is_group and 0 <= i < length(texel):
+        k = find_child(texel, i)
+        j1 = get_sums(texel)[k]
+        return find_cell(texel.childs[k], i-j1, i0+j1)
     raise NotFound()
 
 
+def count_cells(texel):
+    """Returns the number of cells in *texel*."""
+    return texel.weights[CELLS]
+
+
+def cell_number(texel, i):
+    """Returns the number of the cell containing index *i*.
+
+       Cells are counted from 0. Index *i* must be inside a cell.
+    """
+    find_cell(texel, i) # raises NotFound
+    return get_weight(texel, CELLS, i)
+
+
+def get_cell(texel, k):
+    """Returns start index and cell of the *k*-th cell in *texel*."""
+    if not 0 <= k < count_cells(texel):
+        raise IndexError(k)
+    return find_cell(texel, find_weight(texel, k, CELLS))
+
+
+def iter_cell_ranges(texel, part='input', i=0):
+    """Iterates through the index ranges (i1, i2) of the inputs or
+       outputs of all ScriptingCells, starting with the cell at *i*.
+    """
+    if part == 'input':
+        k = 1
+    elif part == 'output':
+        k = 3
+    else:
+        raise ValueError(part)
+    for n in range(get_weight(texel, CELLS, i), count_cells(texel)):
+        i0, cell = get_cell(texel, n)
+        if isinstance(cell, ScriptingCell):
+            offsets = get_sums(cell)
+            yield i0+offsets[k], i0+offsets[k+1]
+
+
+def search_cells(model, pattern, part='input', i=0, flags=0):
+    """Like model.search(pattern, i), but matches are restricted to
+       the inputs or outputs of ScriptingCells.
+    """
+    for i1, i2 in iter_cell_ranges(model.texel, part, i):
+        if i2 > i:
+            for match in model.search(pattern, max(i, i1), i2, flags):
+                yield match
+
+
+def get_cell_replacements(model, pattern, repl, part='input', flags=0):
+    """Returns the edits replacing all matches of *pattern* in the
+       inputs or outputs of ScriptingCells, see model.apply_edits.
+    """
+    edits = []
+    for i1, i2 in iter_cell_ranges(model.texel, part):
+        edits.extend(model.get_replacements(pattern, repl, i1, i2, flags))
+    return edits
+
+
 def _bitmap_saver(bitmap):
     # we convert images to png before saving to save disk space
     w, h = bitmap.size
@@ -217,3 +284,52 @@ def test_01():
     obj = pickle.loads(s)
     s2 = pickle.dumps(obj)
     assert s == s2
+
+
+def test_02():
+    "cells weight"
+    cells = []
+    for k in range(100):
+        cells.append(TextCell(T('cell %i' % k)))
+        cells.append(ScriptingCell(T('%i+1' % k), T(str(k+1))))
+    texel = grouped(cells)
+    assert count_cells(texel) == 200
+    i = 0
+    for k, cell in enumerate(cells):
+        assert get_cell(texel, k) == (i, cell)
+        assert cell_number(texel, i) == k
+        assert cell_number(texel, i+length(cell)-1) == k
+        assert find_cell(texel, i+1) == (i, cell)
+        i += length(cell)
+    try:
+        get_cell(texel, 200)
+        assert False
+    except IndexError:
+        pass
+
+
+def test_03():
+    "search_cells"
+    cells = []
+    for k in range(100):
+        cells.append(TextCell(T('cell %i' % k)))
+        cells.append(ScriptingCell(T('%i+1' % k), T(str(k+1))))
+    model = mk_textmodel(grouped(cells))
+    found = [match.group() for i1, i2, match in 
+             search_cells(model, r'\d+')]
+    assert found == [s for k in range(100) for s in (str(k), '1')]
+    found = [match.group() for i1, i2, match in 
+             search_cells(model, r'\d+', 'output')]
+    assert found == [str(k+1) for k in range(100)]
+    i0, cell = get_cell(model.texel, 21)
+    found = [match.group() for i1, i2, match in 
+             search_cells(model, r'\d+', 'output', i0)]
+    assert found == [str(k+1) for k in range(10, 100)]
+
+    undo = model.apply_edits(get_cell_replacements(model, r'\+', '-'))
+    assert model.get_text().count('-') == 100
+    i0, cell = get_cell(model.texel, 1)
+    assert cell.input.text == '0-1'
+    assert count_cells(model.texel) == 200
+    model.apply_edits(undo)
+    assert model.get_text().count('-') == 0
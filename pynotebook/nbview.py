@@ -5,14 +5,14 @@ from .textmodel import texeltree
 from .textmodel.textmodel import TextModel
 from .textmodel.styles import create_style, updated_style, EMPTYSTYLE
 from .textmodel.texeltree import Group, Text, groups, grouped, insert, \
-    length, get_text, join, get_rightmost, NULL_TEXEL, dump, iter_leaves
+    length, get_text, join, get_rightmost, NULL_TEXEL, dump, iter_styles
 from .textmodel.properties import overridable_property
 from .wxtextview.boxes import Box, VGroup, VBox, Row, Rect, check_box, \
     NewlineBox, TextBox, TabulatorBox, extend_range_seperated, replace_boxes, \
     ChildBox, calc_length
 from .wxtextview.simplelayout import create_paragraphs, Paragraph
 from .wxtextview.testdevice import TESTDEVICE
-from .wxtextview.builder import BuilderBase
+from .wxtextview.builder import BuilderBase, text_cache
 from .wxtextview.wxdevice import WxDevice
 from .wxtextview.wxtextview import WXTextView as _WXTextView
 
@@ -470,13 +470,11 @@ def is_temp(model, i):
 
 def find_temp(tree):
     j1 = j2 = None
-    for i1, i2, texel in iter_leaves(tree):
-        if texel.style.get('temp'):
+    for i1, i2, style in iter_styles(tree):
+        if style.get('temp'):
             if j1 is None:
                 j1 = i1
-                j2 = i2
-            else:
-                j2 = max(j2, i2)
+            j2 = i2
     return j1, j2
 
 
@@ -556,20 +554,17 @@ class Builder(BuilderBase):
         return [TextBox(texel.text, self.mk_style(texel.style), 
                 self.device)]
 
-    _textcache = dict()
-    _textcache_keys = []
+    _textcache = text_cache
     def Text_handler(self, texel):
         # caching version
-        key = texel.text, id(texel.style), id(self.parstyle), self.device
+        key = TextBox, texel.text, texel.style.id, self.parstyle.id, \
+            self.device
         try:
             return self._textcache[key]
-        except: pass        
+        except KeyError:
+            pass
         r = [TextBox(texel.text, self.mk_style(texel.style), 
                      self.device)]
-        self._textcache_keys.insert(0, key)        
-        if len(self._textcache_keys) > 10000:
-            _key = self._textcache_keys.pop()
-            del self._textcache[_key]
         self._textcache[key] = r
         return r
     
@@ -726,7 +721,8 @@ def strip_cells(texel):
 
 
 class NBView(_WXTextView):
-    temp_range = (0, 0)
+    temp_range = overridable_property('temp_range')
+    _temp_marks = None
     ScriptingCell = ScriptingCell
     _maxw = 0 # will be set later
     _logfile = None
@@ -771,9 +767,10 @@ class NBView(_WXTextView):
         self.set_model(model)
 
     def set_model(self, model):
-        # Only meant to be called on fresh NBViews. Therefore we do
-        # not reset cursor, selection etc.
+        # Only meant to be called on fresh NBViews. Cursor, selection
+        # and temp range are reset.
         _WXTextView.set_model(self, model)
+        self._temp_marks = None
 
     def save(self, filename):        
         from . import cerealizerformat
@@ -839,6 +836,29 @@ class NBView(_WXTextView):
         else:
             self.temp_range = j1, i+len(new)
 
+    def get_temp_range(self):
+        # The temp range is kept as a pair of marks, so that it moves
+        # with the text.
+        marks = self._temp_marks
+        if marks is None:
+            return 0, 0
+        return marks[0].get(), marks[1].get()
+
+    def set_temp_range(self, temp_range):
+        marks = self._temp_marks
+        j1, j2 = temp_range
+        if j1 == j2:
+            if marks is not None:
+                for mark in marks:
+                    self.remove_mark(mark)
+                self._temp_marks = None
+        elif marks is None:
+            self._temp_marks = self.create_mark(j1, 'temp'), \
+                self.create_mark(j2, 'temp')
+        else:
+            for mark, j in zip(marks, temp_range):
+                self.marks.move_mark(mark, j)
+
     def clear_temp(self):
         self.complete_count = 0
         j1, j2 = self.temp_range
@@ -940,6 +960,15 @@ class NBView(_WXTextView):
         return find_cell(self.model.texel, self.index)
 
     def execute(self):
+        with self.model.changes():
+            result = self._execute()
+        return result
+
+    def _execute(self):
+        # Executes the cell at the index and moves the index behind
+        # it. Must be called inside of model.changes(). The layout is
+        # updated and the viewport is adjusted at the end of the
+        # block.
         self.clear_temp()
         i0, cell = self.find_cell()
         if not isinstance(cell, ScriptingCell):
@@ -958,17 +987,18 @@ class NBView(_WXTextView):
         self.model.insert(i0, mk_textmodel(new))
         infos.append((self._remove, i0, i0+length(new)))
         self.add_undo(infos) 
-        self.adjust_viewport()
+        self.index = i0+length(new)
         return result
 
     def execute_all(self):
         self.index = 0
-        while 1:
-            try:
-                i, cell = self.find_cell()
-            except NotFound:
-                break
-            self.execute()
+        with self.model.changes():
+            while 1:
+                try:
+                    i, cell = self.find_cell()
+                except NotFound:
+                    break
+                self._execute()
 
     def reset_interpreter(self):
         self.init_clients()
@@ -1415,8 +1445,89 @@ def test_17():
     assert model.get_parstyle(i0) == {}
     assert model.get_parstyle(i1) == {'bullet':True}
     assert model.get_parstyle(i2) == {}
+
+
+def test_18():
+    "remove output rebuilds once"
+    ns = init_testing(False)
+    model = ns['model']
+    view = ns['view']
+    for k in range(5):
+        cell = ScriptingCell(TextModel(u'%i' % k).texel, 
+                             TextModel(u'out\n'*3).texel)
+        model.insert(len(model), mk_textmodel(cell))
+    builder = view.builder
+    calls = []
+    rebuild = builder.rebuild
+    def counting_rebuild():
+        calls.append(1)
+        rebuild()
+    builder.rebuild = counting_rebuild
+    view.remove_output()
+    assert not 'out' in model.get_text()
+    assert len(calls) == 1
+    check_box(view.layout, model.texel)
+
+
+def test_19():
+    "execute changes the output length"
+    ns = init_testing(False)
+    model = ns['model']
+    view = ns['view']
+    cell1 = ScriptingCell(TextModel(u'for i in range(5):\n print(i)').texel,
+                          TextModel(u'x').texel)
+    cell2 = ScriptingCell(TextModel(u'2').texel, NULL_TEXEL)
+    model.insert(len(model), mk_textmodel(cell1))
+    model.insert(len(model), mk_textmodel(cell2))
+    text = model.get_text()
+    view.index = 1
+    view.execute()
+    i0, cell = find_cell(model.texel, 1)
+    assert get_text(cell.output) == u'0\n1\n2\n3\n4\n'
+    assert view.index == i0+length(cell)
+    check_box(view.layout, model.texel)
+    view.execute()
+    assert view.index == len(model)
+    check_box(view.layout, model.texel)
+    view.undo()
+    view.undo()
+    assert model.get_text() == text
+    check_box(view.layout, model.texel)
     
 
+def benchmark_00():
+    "layout of a large notebook with and without glyph advances"
+    import time
+    from .wxtextview import wxdevice
+    ns = init_testing(False)
+    view = ns['view']
+    model = TextModel('')
+    for k in range(500):
+        code = TextModel(u'\n'.join(
+            u'x_%i = sum([i*%i for i in range(%i)]) # comment' % (i, k, i)
+            for i in range(10)))
+        cell = ScriptingCell(code.texel, Text(u'%i\n' % k * 10))
+        model.insert(len(model), mk_textmodel(cell))
+        model.insert(len(model), TextModel(u'Some explanations. '*20+'\n'))
+    old = wxdevice.use_advances
+    try:
+        for use_advances in (False, True):
+            wxdevice.use_advances = use_advances
+            wxdevice.clear_metrics()
+            text_cache.clear()
+            t0 = time.time()
+            view.model = model
+            t1 = time.time()
+            layout = view.layout
+            for i in range(0, len(model), 97):
+                layout.get_index(100, layout.get_rect(i, 0, 0).y1)
+            t2 = time.time()
+            print("use_advances=%s: layout %.2f s, hit tests %.2f s" % (
+                use_advances, t1-t0, t2-t1))
+    finally:
+        wxdevice.use_advances = old
+
+
 def demo_00():
     from .wxtextview import testing
     ns = test_11()
@@ -3,8 +3,7 @@
 from .clients import Client, Aborted
 from .nbstream import StreamRecorder
 from .textmodel.textmodel import TextModel
-from .textmodel.texeltree import Text, grouped, get_text, NL, length, dump, \
-    iter_childs
+from .textmodel.texeltree import Text, grouped, get_text, NL, length, dump
 from .textmodel.styles import create_style
 
 import sys
@@ -26,23 +25,11 @@ def join(elements, sep):
     return list(elements)
 
 
-def mk_breaklist(texel, i0=0):
-    # helper
-    if not texel.weights[2]: return ()
-    if texel.is_group or texel.is_container:
-        r = []
-        for i1, i2, child in iter_childs(texel):
-            r += mk_breaklist(child, i1+i0)
-        return r
-    return [i0+length(texel)]
-
-
 def pycolorize(texel, styles=None, bgcolor='#FFFFFF'):
     model = TextModel()
     model.texel = grouped([texel, NL]) # the NL is needed by
                                        # tokenizer. We have to remove
                                        # it in the end
-    position2index = model.position2index
     text = get_text(model.texel)
     instream = io.BytesIO(text.encode('utf-8')).readline
 
@@ -70,7 +57,6 @@ def pycolorize(texel, styles=None, bgcolor='#FFFFFF'):
 
     class Painter:
         ai = 0
-        breaks = [0]+mk_breaklist(model.texel)
         l = []
         def moveto(self, i, style=_styles[None]):
             # move index to $i$ and create texels the text between $ai$ and $i$            
@@ -84,11 +70,7 @@ def pycolorize(texel, styles=None, bgcolor='#FFFFFF'):
             self.l.extend([x for x in join(t, NL) if length(x)])
             self.ai = i
             
-        def add(self, t):
-            srow, scol = t.start
-            erow, ecol = t.end
-            if srow < 1:
-                return
+        def add(self, t, i1, i2):
             toktype = t.type
             
             if token.LPAR <= toktype and toktype <= token.OP:
@@ -96,12 +78,6 @@ def pycolorize(texel, styles=None, bgcolor='#FFFFFF'):
             elif toktype == token.NAME and keyword.iskeyword(t.string):
                 toktype = _KEYWORD
 
-            i1 = self.breaks[srow-1]+scol
-            i2 = self.breaks[erow-1]+ecol
-
-            if debug:
-                assert i1 == position2index(srow-1, scol)
-                assert i2 == position2index(erow-1, ecol)
             try:
                 style = _styles[toktype]
             except:
@@ -116,8 +92,16 @@ def pycolorize(texel, styles=None, bgcolor='#FFFFFF'):
     except:
         return texel
 
+    l = [t for t in l if t.start[0] >= 1]
+    positions = []
     for t in l:
-        painter.add(t)
+        srow, scol = t.start
+        erow, ecol = t.end
+        positions.append((srow-1, scol))
+        positions.append((erow-1, ecol))
+    indices = model.positions_to_indices(positions)
+    for k, t in enumerate(l):
+        painter.add(t, indices[2*k], indices[2*k+1])
         
     painter.moveto(len(text))
     return grouped(painter.l[:-1]) # note that we are stripping of the last NL
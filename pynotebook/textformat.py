@@ -2,8 +2,9 @@
 
 
 from .textmodel.textmodel import TextModel
-from .textmodel.texeltree import NULL_TEXEL, iter_childs, get_text
-from .nbtexels import Cell, TextCell, ScriptingCell, mk_textmodel
+from .textmodel.texeltree import NULL_TEXEL, iter_childs, get_text, \
+    TreeBuilder
+from .nbtexels import Cell, TextCell, ScriptingCell, mk_textmodel, CELLS
 
 import re
 
@@ -12,8 +13,9 @@ def get_cells(texel):
     if isinstance(texel, Cell):
         return [texel]
     r = []
-    for i1, i2, child in iter_childs(texel):
-        r.extend(get_cells(child))
+    if texel.weights[CELLS]: # skip subtrees without cells
+        for i1, i2, child in iter_childs(texel):
+            r.extend(get_cells(child))
     return r
 
 
@@ -38,8 +40,7 @@ rx_in = re.compile('\[In\s*(\w*)\]\:$').match
 rx_text = re.compile('\[Text\]\:$').match
 
 def fromtext(s, ScriptingCell=ScriptingCell):
-    model = TextModel()
-    cells = []
+    builder = TreeBuilder()
     l = []
     fields = [NULL_TEXEL, NULL_TEXEL]
     mode = None
@@ -66,7 +67,7 @@ def fromtext(s, ScriptingCell=ScriptingCell):
                 fields[1] = texel
             cell = ScriptingCell(*fields)
             fields[0] = fields[1] = NULL_TEXEL
-        cells.append(cell)
+        builder.append(cell)
 
     
     for line in s.split('\n'):
@@ -86,10 +87,7 @@ def fromtext(s, ScriptingCell=ScriptingCell):
             l.append(line)
     if l:
         flush()
-    model = TextModel()
-    for cell in cells:
-        model.append(mk_textmodel(cell))
-    return model
+    return mk_textmodel(builder.get_texel())
 
 
 def test_00():
@@ -108,3 +106,30 @@ Zeile 2
     print(repr(text))
     print(repr(t))
     assert t == text
+
+
+def benchmark_00():
+    "loading a notebook with 50000 cells"
+    import time
+    from .textmodel.texeltree import is_root_efficient
+    from .nbtexels import count_cells
+    l = []
+    for k in range(25000):
+        l.append("[In %i]:\nx = %i\nprint(x)\n[Out %i]:\n%i" % (k, k, k, k))
+        l.append("[Text]:\nSome text about step %i." % k)
+    text = '\n'.join(l)+'\n'
+    t0 = time.time()
+    model = fromtext(text)
+    t1 = time.time()
+    assert count_cells(model.texel) == 50000
+    assert is_root_efficient(model.texel)
+    print("fromtext:              %.2f s" % (t1-t0))
+
+    # for comparison: appending the cells one by one
+    cells = get_cells(model.texel)
+    t0 = time.time()
+    model = TextModel()
+    for cell in cells:
+        model.append(mk_textmodel(cell))
+    t1 = time.time()
+    print("appending cells:       %.2f s" % (t1-t0))
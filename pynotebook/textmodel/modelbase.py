@@ -8,6 +8,7 @@
 #
 
 import weakref
+from contextlib import contextmanager
 
 #  List of views for a model is kept separately so that models
 #  can be pickled without fear of accidentally trying to pickle
@@ -18,6 +19,64 @@ _model_views = weakref.WeakKeyDictionary() # {Model: [object]}
 from .properties import overridable_property
 
 
+# Signals which are collected while changes are deferred. Each entry
+# translates the signal arguments into a change (i1, i2, n): the text
+# between *i1* and *i2* has been replaced by *n* characters.
+_range_signals = {
+    'inserted' : lambda i, n: (i, i, n),
+    'removed' : lambda i, text: (i, i+len(text), 0),
+    'replaced' : lambda i, n1, n2: (i, i+n1, n2),
+    'properties_changed' : lambda i1, i2: (i1, i2, i2-i1),
+}
+
+
+class ChangeSet:
+    """Collects changes and merges overlapping and adjacent ones.
+
+       Changes are added in the coordinates of the current text. The
+       merged changes are returned in the coordinates of the text
+       before the first change.
+    """
+    def __init__(self):
+        # Entries are lists [o1, o2, c1, c2]: the original range
+        # o1...o2 has become c1...c2.
+        self.entries = []
+
+    def add(self, j1, j2, n):
+        entries = self.entries
+        delta = n-(j2-j1)
+        # Entries behind the change are shifted. As edits tend to
+        # move forward, we start at the end.
+        k2 = len(entries)
+        while k2 > 0 and entries[k2-1][2] > j2:
+            k2 -= 1
+            entries[k2][2] += delta
+            entries[k2][3] += delta
+        k1 = k2
+        while k1 > 0 and entries[k1-1][3] >= j1:
+            k1 -= 1
+        offset = 0 # difference between current and original indices
+        if k1 > 0:
+            o1, o2, c1, c2 = entries[k1-1]
+            offset = c2-o2
+        if k1 < k2 and entries[k1][2] <= j1:
+            o1, c1 = entries[k1][0], entries[k1][2]
+        else:
+            o1, c1 = j1-offset, j1
+        if k1 < k2 and entries[k2-1][3] >= j2:
+            o2, c2 = entries[k2-1][1], entries[k2-1][3]
+        elif k1 < k2:
+            o2, c2 = j2-entries[k2-1][3]+entries[k2-1][1], j2
+        else:
+            o2, c2 = j2-offset, j2
+        entries[k1:k2] = [[o1, o2, c1, c2+delta]]
+
+    def get_ranges(self):
+        """Returns the merged changes as sorted list of tuples (i1, i2,
+           n) in original coordinates."""
+        return [(o1, o2, c2-c1) for o1, o2, c1, c2 in self.entries]
+
+
 class Model(object):
     """A Model represents an application object which can appear in a View.
     Each Model can have any number of Views attached to it. When a Model is
@@ -70,13 +129,53 @@ class Model(object):
     #		View notification
     #
 
+    _changeset = None
+    @contextmanager
+    def changes(self):
+        """Context manager which defers the notification of views.
+
+        Observers which define a method 'changed' are not notified
+        about the individual changes made inside of the with
+        block. Instead, they receive a single call changed(model,
+        ranges) at the end. *Ranges* is a sorted list of tuples (i1,
+        i2, n), meaning that the text between *i1* and *i2* of the
+        model before the block has been replaced by *n*
+        characters. All other observers are notified as usual. At
+        the beginning of the block, the method 'changes_started' of
+        the observers is called, if present, and at the end, after
+        'changed', the method 'changes_finished'.
+
+        Blocks can be nested. Only the outermost block delivers."""
+        if self._changeset is not None:
+            yield
+            return
+        self._changeset = ChangeSet()
+        for view in self.views:
+            self._call_if_present(view, 'changes_started', self)
+        try:
+            yield
+        finally:
+            ranges = self._changeset.get_ranges()
+            del self._changeset
+            if ranges:
+                for view in self.views:
+                    self._call_if_present(view, 'changed', self, ranges)
+            for view in self.views:
+                self._call_if_present(view, 'changes_finished', self)
+
     def notify_views(self, message = 'model_changed', *args, **kwds):
         """For each observer, if the observer defines a method with
         the name of the message, call it with the given
         arguments. Otherwise, if it defines a method called
         'model_changed', call it with no arguments. Otherwise, do
-        nothing for that observer."""
-        for view in self.views:
+        nothing for that observer. 
+
+        See also changes()."""
+        views = self.views
+        if self._changeset is not None and message in _range_signals:
+            self._changeset.add(*_range_signals[message](*args, **kwds))
+            views = [view for view in views if not hasattr(view, 'changed')]
+        for view in views:
             if not self._call_if_present(view, message, self, *args, **kwds):
                 self._call_if_present(view, 'model_changed', self)
 
@@ -0,0 +1,147 @@
+# -*- coding: latin-1 -*-
+
+# Regular expression search over texel trees. The text is read leaf
+# by leaf in chunks, so that the document is never materialized as a
+# whole. Consecutive chunks overlap, so that matches which span
+# several leaves or chunks are found.
+
+
+from .texeltree import length, iter_leaves
+import re
+
+
+debug = 0
+
+chunksize = 1<<16 # characters read at once
+overlap = 1<<10   # maximum length of matches spanning a chunk border
+
+
+def iter_chunks(texel, i1, i2, size=None):
+    """Iterates through the text between *i1* and *i2* in chunks of
+       about *size* characters.
+    """
+    if size is None:
+        size = chunksize
+    if i1 >= i2:
+        return
+    parts = []
+    n = 0
+    for j1, j2, leaf in iter_leaves(texel, i1):
+        if j1 >= i2:
+            break
+        text = leaf.text
+        if j1 < i1 or j2 > i2:
+            text = text[max(i1-j1, 0):min(i2, j2)-j1]
+        parts.append(text)
+        n += len(text)
+        if n >= size:
+            yield u''.join(parts)
+            parts = []
+            n = 0
+    if parts:
+        yield u''.join(parts)
+
+
+def finditer(texel, pattern, i1=0, i2=None, flags=0, size=None):
+    """Iterates lazily through the matches of *pattern* in *i1*...*i2*.
+
+       Yields tuples (j1, j2, match). Note that the positions of the
+       match object are relative to the current chunk, while *j1* and
+       *j2* are indices in *texel*. Matches which exceed the
+       *overlap* at a chunk border might be missed or truncated.
+    """
+    if i2 is None:
+        i2 = length(texel)
+    regex = re.compile(pattern, flags)
+    chunks = iter_chunks(texel, i1, i2, size)
+    # Text before i1 is needed as context, e.g. for \b, ^ or
+    # lookbehinds.
+    buf = u''.join(iter_chunks(texel, max(0, i1-overlap), i1))
+    base = i1-len(buf) # index of buf[0]
+    pos = len(buf)     # search position in buf
+    eof = False
+    while 1:
+        m = regex.search(buf, pos)
+        if m is not None and (eof or m.end()+overlap <= len(buf)):
+            yield base+m.start(), base+m.end(), m
+            pos = m.end()
+            if m.end() == m.start():
+                pos += 1 # empty match
+                if pos > len(buf):
+                    return
+            continue
+        if eof:
+            return
+        # No match is safe yet. Matches can not start before *pos*.
+        if m is None:
+            pos = max(pos, len(buf)-overlap)
+        else:
+            pos = max(pos, m.start())
+        # Some text before pos is kept as context, e.g. for \b or ^
+        drop = max(0, pos-overlap)
+        buf = buf[drop:]
+        base += drop
+        pos -= drop
+        try:
+            buf += next(chunks)
+        except StopIteration:
+            eof = True
+
+
+
+def test_00():
+    "iter_chunks"
+    from .texeltree import T, G, NL, grouped
+    texel = grouped([T("%i," % i) for i in range(1000)])
+    text = u''.join("%i," % i for i in range(1000))
+    for i1, i2 in ((0, len(text)), (5, 100), (7, 7), (3, 2000)):
+        chunks = list(iter_chunks(texel, i1, i2, 100))
+        assert u''.join(chunks) == text[i1:i2]
+        for chunk in chunks[:-1]:
+            assert 100 <= len(chunk) < 110
+
+
+def test_01():
+    "finditer"
+    global overlap
+    from .texeltree import T, G, NL, grouped
+    texel = grouped([T("%i," % i) for i in range(1000)]+[NL, T("abc")])
+    text = u''.join("%i," % i for i in range(1000))+"\nabc"
+    old = overlap
+    try:
+        overlap = 20
+        for pattern, flags in ((r'1\d,2', 0), (r'99', 0), (r'\b1', 0),
+                               (r'^', re.M), (r'\d+$', re.M), (r'x*', 0),
+                               (r'c$', 0), (r'(\d),\1', 0)):
+            expected = [(m.start(), m.end()) for m in
+                        re.finditer(pattern, text, flags)]
+            for size in (10, 100, 10000):
+                found = [(j1, j2) for j1, j2, m in
+                         finditer(texel, pattern, flags=flags, size=size)]
+                assert found == expected
+        l = list(finditer(texel, r'\d+', 100, 120))
+        assert [m.group() for j1, j2, m in l] == ['37', '38', '39', '40',
+                                                  '41', '42', '4']
+        assert [text[j1:j2] for j1, j2, m in l] == \
+            [m.group() for j1, j2, m in l]
+    finally:
+        overlap = old
+
+
+def test_02():
+    "finditer with start index"
+    from .texeltree import T, G, NL, grouped, get_text
+    text = u"abcd efg\nd xd\n  abc d"
+    texel = grouped([T(text[:6]), T(text[6:8]), NL, T(text[9:13]), NL,
+                     T(text[14:])])
+    assert get_text(texel) == text
+    for pattern in (r'\bd', r'(?m)^d', r'(?<=c)d', r'(?<=\n)\s*\w', r'\B\w',
+                    r'^a', r'd$'):
+        regex = re.compile(pattern)
+        for i1 in range(len(text)+1):
+            expected = [(m.start(), m.end()) for m in 
+                        regex.finditer(text, i1)]
+            for size in (2, 100):
+                found = [(j1, j2) for j1, j2, m in 
+                         finditer(texel, pattern, i1, size=size)]
+                assert found == expected, (pattern, i1, found, expected)
@@ -3,7 +3,10 @@
 from . import texeltree
 from .texeltree import G, T, length, grouped, provides_childs, iter_childs, \
     is_root_efficient, is_list_efficient, is_homogeneous, calc_length, \
-    get_pieces, fuse, EMPTYSTYLE, NL, NewLine, style_pool, hash_style
+    get_pieces, fuse, EMPTYSTYLE, NL, NewLine, style_pool, hash_style, \
+    Style, as_style
+from .weights import find_weight, get_weight
+from weakref import WeakValueDictionary
 
 
 debug = 0
@@ -31,38 +34,164 @@ class StyleIterator:
 
 
 def create_style(**kwds):
-    global style_pool
-    key = hash_style(kwds)
-    try:
-        return style_pool[key]
-    except KeyError:
-        style_pool[key] = kwds
-        return kwds
+    return as_style(kwds)
+
 
+_transitions = WeakValueDictionary() # (style id, properties) -> style
 
 def updated_style(style, properties):
-    new = style.copy()
+    """Returns *style* with *properties* added or replaced.
+
+       Results are memoized, since the same updates are applied to
+       the same styles over and over again.
+    """
+    try:
+        key = style.id, tuple(sorted(properties.items()))
+        return _transitions[key]
+    except KeyError:
+        pass
+    except (AttributeError, TypeError): # plain dict or unhashable values
+        key = None
+    new = dict(style)
     new.update(properties)
-    return create_style(**new)
+    new = as_style(new)
+    if key is not None:
+        _transitions[key] = new
+    return new
 
 
 def get_style(texel, i):
     if i < 0 or i >= length(texel):
         raise IndexError(i)
     if provides_childs(texel):
-        for i1,i2, child in iter_childs(texel):
-            if i1 <= i < i2:
-                return get_style(child, i-i1)
+        k = texeltree.find_child(texel, i)
+        return get_style(texel.childs[k], i-texeltree.get_sums(texel)[k])
     return texel.style
 
 
-def fuse_styles(l1, l2):
-    if len(l1) and len(l2):
-        tail = l1[-1]
-        n, style = l2[0]
-        if tail[1] is style:
-            return l1[:-1]+[(tail[0]+n, style)]+l2[1:]
-    return l1+l2
+def _iter_pieces(texel, i1, i2, opaque=None):
+    # Iterates through the leaves of *texel* which overlap i1...i2.
+    # Subtrees for which *opaque* returns True are treated as
+    # leaves. Yields tuples (j1, j2, leaf) clipped to i1...i2. The
+    # first leaf is located by bisection, all others are visited in
+    # order, so that the costs are O(log n) plus the number of pieces.
+    stack = [] # frames [childs, index of next child, its offset]
+    j = 0
+    while 1:
+        n = texel.weights[1]
+        if n and j < i2 and j+n > i1:
+            if (texel.is_group or texel.is_container) and \
+                    not (opaque and opaque(texel)):
+                k = 0
+                if i1 > j:
+                    k = texeltree.find_child(texel, i1-j)
+                    j += texeltree.get_sums(texel)[k]
+                stack.append([texel.childs, k, j])
+            else:
+                yield max(j, i1), min(j+n, i2), texel
+        while stack:
+            frame = stack[-1]
+            childs, k, j = frame
+            if k < len(childs) and j < i2:
+                texel = childs[k]
+                frame[1] = k+1
+                frame[2] = j+texel.weights[1]
+                break
+            stack.pop()
+        else:
+            return
+
+
+def coalesced(runs):
+    """Joins neighbouring style runs (n, style) with the same style."""
+    current = None
+    m = 0
+    for n, style in runs:
+        if style is current:
+            m += n
+            continue
+        if m:
+            yield m, current
+        m, current = n, style
+    if m:
+        yield m, current
+
+
+def iter_style_runs(texel, i1, i2):
+    """Iterates through the style runs in *i1*...*i2*.
+
+       Yields tuples (n, style). Neighbouring runs with the same
+       style are joined.
+    """
+    return coalesced((j2-j1, leaf.style) for j1, j2, leaf \
+                     in _iter_pieces(texel, i1, i2))
+
+
+def _parstyle(texel):
+    if isinstance(texel, NewLine):
+        return texel.parstyle
+    return EMPTYSTYLE
+
+
+def iter_parstyle_runs(texel, i1, i2):
+    """Iterates through the paragraph style runs in *i1*...*i2*.
+
+       Yields tuples (n, style). Subtrees without newlines are
+       skipped as a whole.
+    """
+    return coalesced((j2-j1, _parstyle(leaf)) for j1, j2, leaf in \
+        _iter_pieces(texel, i1, i2, lambda t:not t.weights[2]))
+
+
+def _next_newline(texel, i):
+    # Returns the first leaf at or after index *i* which ends a
+    # line, or None. Subtrees without line breaks are skipped.
+    if not texel.weights[2]:
+        return None
+    if texel.is_group or texel.is_container:
+        childs = texel.childs
+        offsets = texeltree.get_sums(texel)
+        k = 0
+        if i > 0:
+            k = texeltree.find_child(texel, min(i, length(texel)-1))
+        for k in range(k, len(childs)):
+            leaf = _next_newline(childs[k], max(i-offsets[k], 0))
+            if leaf is not None:
+                return leaf
+        return None
+    return texel
+
+
+def get_parstyle(texel, i):
+    """Returns the paragraph style at index *i*.
+
+       The paragraph style is stored in the NewLine which terminates
+       the paragraph. It is found by a direct descent in O(log n).
+    """
+    if i < 0 or i >= length(texel):
+        raise IndexError(i)
+    leaf = _next_newline(texel, i)
+    if leaf is None:
+        raise IndexError(i)
+    return _parstyle(leaf)
+
+
+def iter_paragraphs(texel, i1, i2):
+    """Iterates through the paragraphs containing positions *i1*...*i2*.
+
+       Yields tuples (start, end, parstyle), where end is the index
+       after the terminating NewLine. Text after the last NewLine is
+       not reported. The costs are O(log n) plus the number of
+       paragraphs.
+    """
+    start = find_weight(texel, get_weight(texel, 2, i1), 2)
+    for j1, j2, leaf in _iter_pieces(texel, start, length(texel), 
+                                     lambda t:not t.weights[2]):
+        if leaf.weights[2]:
+            yield start, j2, _parstyle(leaf)
+            start = j2
+            if start > i2:
+                return
 
 
 def get_styles(texel, i1, i2):
@@ -72,21 +201,7 @@ def get_styles(texel, i1, i2):
     post:
         style_length(__return__) == i2-i1
     """
-    if i1 == i2:
-        return []
-    if provides_childs(texel):
-        j1 = i1
-        j2 = i2
-        styles = []
-        for child in texel.childs:
-            n = length(child)
-            if j1 < n and j2 > 0:
-                new = get_styles(child, j1, min(j2, n))
-                styles = fuse_styles(styles, new)
-            j1 = max(0, j1-n)
-            j2 = max(0, j2-n)
-        return styles
-    return [(i2-i1, texel.style)]
+    return list(iter_style_runs(texel, i1, i2))
 
 
 
@@ -148,11 +263,172 @@ def set_styles(texel, i, iterator):
 
 
 
-def set_properties(texel, i1, i2, properties):
-    """Sets text properties in $i1$...$i2$."""
-    l1 = get_styles(texel, i1, i2)
-    l2 = [(n, updated_style(s, properties)) for n, s in l1]
-    return set_styles(texel, i1, StyleIterator(iter(l2)))
+def _add_run(memo, n, style):
+    if memo and memo[-1][1] is style:
+        memo[-1] = (memo[-1][0]+n, style)
+    else:
+        memo.append((n, style))
+
+
+def _map_styles(texel, i1, i2, f, memo):
+    # Helper for map_styles. Requires 0 <= i1 < i2 <= length(texel).
+    if texel.is_group or texel.is_container:
+        lists = [] # alternating unchanged and changed childs
+        same = []
+        j = 0
+        for child in texel.childs:
+            n = length(child)
+            if n and j < i2 and j+n > i1:
+                new = _map_styles(child, max(i1-j, 0), min(i2-j, n), f, memo)
+                if len(new) != 1 or new[0] is not child:
+                    lists.append(same)
+                    lists.append(new)
+                    same = []
+                    j += n
+                    continue
+            same.append(child)
+            j += n
+        if not lists:
+            return [texel]
+        lists.append(same)
+        return texeltree._spliced_childs(texel, lists)
+
+    style = texel.style
+    if memo is not None:
+        _add_run(memo, i2-i1, style)
+    new = f(style)
+    if new is style:
+        return [texel]
+    if texel.is_text:
+        text = texel.text
+        r = []
+        if i1 > 0:
+            r.append(T(text[:i1], style))
+        r.append(T(text[i1:i2], new))
+        if i2 < len(text):
+            r.append(T(text[i2:], style))
+        return r
+    return [texel.set_style(new)]
+
+
+def map_styles(texel, i1, i2, f, memo=None):
+    """Replaces the style s of all leaves in $i1$...$i2$ by f(s).
+
+       Works in a single pass. Subtrees in which no style changes
+       are returned as they are, so that they stay shared with
+       *texel*. If *memo* is a list, the original style runs are
+       appended to it (as returned by get_styles).
+
+       pre:
+           is_root_efficient(texel)
+       post:
+           length(texel) == calc_length(__return__)
+    """
+    i1 = max(i1, 0)
+    i2 = min(i2, length(texel))
+    if i1 >= i2:
+        return [texel]
+    cache = {}
+    def cached(style):
+        try:
+            return cache[style]
+        except KeyError:
+            new = cache[style] = f(style)
+            return new
+    return _map_styles(texel, i1, i2, cached, memo)
+
+
+def set_properties(texel, i1, i2, properties, memo=None):
+    """Sets text properties in $i1$...$i2$.
+
+       If *memo* is a list, the original style runs are appended to
+       it.
+    """
+    return map_styles(texel, i1, i2, 
+                      lambda style:updated_style(style, properties), memo)
+
+
+def _apply_runs(texel, j0, runs, state, memo):
+    # Helper for apply_runs. The texel starts at index *j0*. The
+    # runs are visited in order, state[0] is the first unfinished
+    # run. Memo runs are recorded in state[1]...state[2].
+    n = length(texel)
+    k = state[0]
+    if not n or k == len(runs) or runs[k][0] >= j0+n:
+        return [texel]
+    if texel.is_group or texel.is_container:
+        lists = [] # alternating unchanged and changed childs
+        same = []
+        lo, hi = state[1], state[2]
+        j = j0
+        for child in texel.childs:
+            n = length(child)
+            if state[0] < len(runs) and runs[state[0]][0] < j+n:
+                new = _apply_runs(child, j, runs, state, memo)
+                if len(new) != 1 or new[0] is not child:
+                    lists.append(same)
+                    lists.append(new)
+                    same = []
+                    j += n
+                    continue
+            elif memo is not None and j < hi and j+n > lo:
+                for m, style in iter_style_runs(
+                        child, max(lo-j, 0), min(hi-j, n)):
+                    _add_run(memo, m, style)
+            same.append(child)
+            j += n
+        if not lists:
+            return [texel]
+        lists.append(same)
+        return texeltree._spliced_childs(texel, lists)
+
+    style = texel.style
+    j2 = j0+n
+    if memo is not None:
+        _add_run(memo, min(j2, state[2])-max(j0, state[1]), style)
+    pieces = [] # (j1, j2, style)
+    def add(j1, j2, style):
+        if pieces and pieces[-1][2] is style:
+            pieces[-1] = (pieces[-1][0], j2, style)
+        else:
+            pieces.append((j1, j2, style))
+    j = j0
+    while k < len(runs) and runs[k][0] < j2:
+        r1, r2, properties = runs[k]
+        if r1 > j:
+            add(j, r1, style)
+            j = r1
+        add(j, min(r2, j2), updated_style(style, properties))
+        j = min(r2, j2)
+        if r2 > j2:
+            break
+        k += 1
+    state[0] = k
+    if j < j2:
+        add(j, j2, style)
+    if len(pieces) == 1:
+        new = pieces[0][2]
+        if new is style:
+            return [texel]
+        return [texel.set_style(new)]
+    text = texel.text
+    return [T(text[j1-j0:j2-j0], s) for j1, j2, s in pieces]
+
+
+def apply_runs(texel, i0, runs, memo=None):
+    """Applies the properties of several runs in a single pass.
+
+       *Runs* is a sorted sequence of non overlapping spans (i1, i2,
+       properties) with indices relative to *i0*. If *memo* is a
+       list, the original style runs from *i0* to the end of the
+       last span are appended to it.
+    """
+    runs = [(i0+i1, i0+i2, properties) for i1, i2, properties in runs
+            if i1 < i2]
+    if not runs:
+        return [texel]
+    state = [0, i0, runs[-1][1]]
+    return _apply_runs(texel, 0, runs, state, memo)
 
 
 
@@ -163,23 +439,7 @@ def get_parstyles(texel, i1, i2):
     post:
         style_length(__return__) == i2-i1
     """
-    if i1 == i2:
-        return []
-    if texel.weights[2]>0 and provides_childs(texel):
-        j1 = i1
-        j2 = i2
-        styles = []
-        for child in texel.childs:
-            n = length(child)
-            if j1 < n and j2 > 0:
-                new = get_parstyles(child, j1, min(j2, n))
-                styles = fuse_styles(styles, new)
-            j1 = max(0, j1-n)
-            j2 = max(0, j2-n)
-        return styles
-    elif isinstance(texel, NewLine):
-        return [(i2-i1, texel.parstyle)]
-    return [(i2-i1, EMPTYSTYLE)]
+    return list(iter_parstyle_runs(texel, i1, i2))
 
 
 
@@ -228,11 +488,16 @@ def set_parstyles(texel, i, iterator):
     assert False
 
 
-def set_parproperties(texel, i1, i2, properties):
-    """Sets paragraph properties in $i1$...$i2$."""
-    l1 = get_parstyles(texel, i1, i2)
-    l2 = [(n, updated_style(s, properties)) for n, s in l1]
-    return set_parstyles(texel, i1, StyleIterator(iter(l2)))
+def set_parproperties(texel, i1, i2, properties, runs=None):
+    """Sets paragraph properties in $i1$...$i2$.
+
+       The current paragraph style runs *runs* can be passed if they
+       are already known.
+    """
+    if runs is None:
+        runs = iter_parstyle_runs(texel, i1, i2)
+    new = coalesced((n, updated_style(s, properties)) for n, s in runs)
+    return set_parstyles(texel, i1, StyleIterator(new))
 
 
 # -- debug --
@@ -251,8 +516,8 @@ if debug: # enable contract checking
 
 def test_00():
     "get_style"
-    s10 = dict(size=10)
-    s12 = dict(size=12)
+    s10 = create_style(size=10)
+    s12 = create_style(size=12)
     g = G([T("01", s10), 
            T("23", s12), 
            T("4567890", s10)])
@@ -325,3 +590,122 @@ def test_12():
 
     print(get_parstyles(g, 0, length(g)))
 
+
+
+def test_13():
+    "Style"
+    import pickle, gc
+    s1 = create_style(size=10, bold=True)
+    assert s1 is create_style(bold=True, size=10)
+    assert s1 is texeltree.as_style(dict(size=10, bold=True))
+    assert s1 == dict(size=10, bold=True)
+    assert s1['size'] == 10 and s1.get('italic') is None
+    assert hash(s1) == hash(create_style(size=10, bold=True))
+    assert pickle.loads(pickle.dumps(s1)) is s1
+    try:
+        s1['size'] = 12
+        assert False
+    except TypeError:
+        pass
+    d = s1.copy() # copies are mutable dicts
+    d['size'] = 12
+    assert s1['size'] == 10
+
+    s2 = updated_style(s1, dict(size=12))
+    assert s2 is create_style(size=12, bold=True)
+    assert updated_style(s1, dict(size=12)) is s2
+    assert updated_style(s1, {}) is s1
+    assert T("x", dict(size=12, bold=True)).style is s2
+
+    # unused styles are collected and their ids are not reused
+    n = s2.id
+    s3 = create_style(unused=1)
+    assert s3.id > n
+    del s2, s3
+    gc.collect()
+    assert not (('unused', 1),) in style_pool
+    assert create_style(unused=1).id > n+1
+
+
+def test_14():
+    "style runs"
+    from random import Random
+    random = Random(0)
+    styles = [create_style(size=k) for k in range(3)]
+    parstyles = [create_style(base=k) for k in range(2)]
+    l = []
+    for k in range(300):
+        x = random.random()
+        if x < 0.2:
+            l.append(NewLine(random.choice(styles),
+                             random.choice(parstyles)))
+        else:
+            l.append(T("x"*random.randrange(1, 5), random.choice(styles)))
+    t = grouped(l)
+    n = length(t)
+    def expected(f, i1, i2):
+        return list(coalesced((1, f(i)) for i in range(i1, i2)))
+    def parstyle(i):
+        for j1, j2, leaf in texeltree.iter_leaves(t, i):
+            return _parstyle(leaf)
+    for k in range(50):
+        i1 = random.randrange(n)
+        i2 = random.randrange(i1, n+1)
+        assert get_styles(t, i1, i2) == expected(
+            lambda i:get_style(t, i), i1, i2)
+        assert get_parstyles(t, i1, i2) == expected(parstyle, i1, i2)
+    assert get_styles(t, 5, 5) == []
+
+    new = grouped(set_properties(t, 10, 100, dict(bold=True)))
+    for n, style in get_styles(new, 10, 100):
+        assert style['bold']
+    assert get_styles(new, 0, 10) == get_styles(t, 0, 10)
+
+
+def benchmark_00():
+    "get_styles over many style runs"
+    import time
+    for n in (10**3, 10**4, 10**5):
+        l = [T("abc", create_style(size=k % 2)) for k in range(n)]
+        t = grouped(l)
+        t0 = time.time()
+        runs = get_styles(t, 0, length(t))
+        t1 = time.time()
+        assert len(runs) == n
+        print("%6i runs: %.1f ms" % (n, (t1-t0)*1000))
+
+
+def test_15():
+    "map_styles"
+    from random import Random
+    random = Random(1)
+    styles = [create_style(size=k) for k in range(3)]
+    l = []
+    for k in range(400):
+        if random.random() < 0.2:
+            l.append(NewLine(random.choice(styles)))
+        else:
+            l.append(T("x"*random.randrange(1, 5), random.choice(styles)))
+    l.append(texeltree.Fraction(T("ab", styles[0]), T("cd", styles[1])))
+    t = grouped(l)
+    n = length(t)
+    bigger = lambda s:create_style(size=s['size']+1)
+    for k in range(30):
+        i1 = random.randrange(n)
+        i2 = random.randrange(i1, n+1)
+        memo = []
+        new = grouped(map_styles(t, i1, i2, bigger, memo))
+        assert memo == get_styles(t, i1, i2)
+        assert is_root_efficient(new)
+        assert length(new) == n
+        assert get_styles(new, 0, i1) == get_styles(t, 0, i1)
+        assert get_styles(new, i2, n) == get_styles(t, i2, n)
+        assert get_styles(new, i1, i2) == [
+            (m, bigger(s)) for m, s in get_styles(t, i1, i2)]
+
+    # unchanged subtrees are shared
+    new = grouped(set_properties(t, 0, n, dict(bold=True)))
+    assert grouped(set_properties(new, 0, n, dict(bold=True))) is new
+    new2 = grouped(set_properties(new, 10, 20, dict(bold=False)))
+    leaves = lambda t:[leaf for j1, j2, leaf in texeltree.iter_leaves(t, 40)]
+    assert all(a is b for a, b in zip(leaves(new), leaves(new2)))
@@ -1,8 +1,16 @@
 # -*- coding: latin-1 -*-
 
 
-from copy import copy as shallow_copy
 from functools import reduce
+from operator import mul
+from itertools import accumulate, count
+from bisect import bisect_left, bisect_right
+from array import array
+from hashlib import blake2b
+from weakref import WeakValueDictionary, ref
+from collections import OrderedDict
+from threading import RLock
+import sys
 
 
 debug = 0
@@ -19,87 +27,314 @@ def set_nmax(n):
         raise ValueError("nmax must be a multiple of 4.")    
     nmax = n
 
+
+maxleaf = 1024
+
+def set_maxleaf(n):
+    """Sets the maximal length of text leaves to *n*.
+
+       Longer texts are split into several leaves. This keeps the
+       cost of an edit inside a very long line proportional to
+       *maxleaf* instead of the length of the line.
+    """
+    global maxleaf
+    if n < 1:
+        raise ValueError("maxleaf must be positive.")
+    maxleaf = n
+
+
+textcache_min = 256
+textcache_max = 1<<20
+textcache_total = 1<<22
+
+def set_textcache(nmin, nmax=None, total=None):
+    """Sets the length range of groups which cache their text.
+
+       Groups shorter than *nmin* rebuild their text on every call of
+       get_text, which is cheap for them. Groups longer than *nmax*
+       do not cache. Since every level of a tree can cache the same
+       text, the number of cached characters is also limited in
+       total to *total*. The oldest cached texts are dropped first.
+    """
+    global textcache_min, textcache_max, textcache_total
+    textcache_min = nmin
+    if nmax is not None:
+        textcache_max = nmax
+    if total is not None:
+        textcache_total = total
+        _shrink_textcache()
+
     
-EMPTYSTYLE = {}
-style_pool = {():EMPTYSTYLE}
+# ---- Styles ----
+#
+# Styles are immutable dictionaries. They are interned: equal styles
+# are the same object and can be compared by identity. The pool only
+# holds weak references, so that unused styles are collected. Each
+# style has a small integer id which is never reused and can be used
+# in cache keys.
+
+class Style(dict):
+    """An immutable, interned style. Use as_style() to create styles."""
+    __slots__ = ('id', 'key', '_hash', '_plain', '__weakref__')
+
+    def __hash__(self):
+        return self._hash
+
+    def _readonly(self, *args, **kwds):
+        raise TypeError("styles are immutable")
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = \
+        setdefault = update = _readonly
+
+    def __reduce__(self):
+        return as_style, (dict(self),)
+
+
+style_pool = WeakValueDictionary() # key -> style
+_style_ids = count()
+
+
+def _plain(style):
+    # Styles are saved as plain dicts. The dict is cached, so that
+    # equal styles are still shared in files.
+    try:
+        return style._plain
+    except AttributeError:
+        d = style._plain = dict(style)
+        return d
+
 
 def hash_style(style):
-    return tuple(sorted(style.items()))
+    try:
+        return style.key
+    except AttributeError:
+        return tuple(sorted(style.items()))
 
 
 def as_style(d):
-    global style_pool
+    """Returns the interned style with the same items as dict *d*."""
+    if type(d) is Style:
+        return d
     key = hash_style(d)
     try:
         return style_pool[key]
     except KeyError:
-        style_pool[key] = d
-        return d
+        pass
+    style = Style(d)
+    style.key = key
+    style.id = next(_style_ids)
+    style._hash = hash(key)
+    style_pool[key] = style
+    return style
+
+EMPTYSTYLE = as_style({})
+
+
+# ---- Weight channels ----
+#
+# Each texel has a tuple of weights. The first three channels (depth,
+# length and lineno) are builtin. Further channels can be added with
+# add_weight(). Groups and containers aggregate them by sum, so that
+# find_weight and get_weight can locate them by bisection.
+
+weightnames = ['depth', 'length', 'lineno']
+_text_functions = [] # computes the weights of text leaves in added channels
+
+def _text_weights(text):
+    w = (0, len(text), 0)
+    if _text_functions:
+        w += tuple([f(text) for f in _text_functions])
+    return w
+
+
+def _pad_weights(cls):
+    # Adds the default values for missing channels to the weights
+    # and functions which are defined in class *cls*.
+    n = len(weightnames)
+    weights = cls.__dict__.get('weights')
+    if type(weights) is tuple and len(weights) < n:
+        cls.weights = weights+(0,)*(n-len(weights))
+    functions = cls.__dict__.get('functions')
+    if type(functions) is tuple and len(functions) < n:
+        cls.functions = functions+(sum,)*(n-len(functions))
 
 
 # ---- Tree objects ----
+#
+# Texel trees can consist of millions of nodes. To keep the memory
+# footprint small, all texel classes declare __slots__ and therefore
+# have no per instance __dict__. Subclasses which do not declare
+# __slots__ (e.g. cells) will get a __dict__ as usual.
+
+def _slotnames(cls):
+    # Returns the names of all slots of *cls*, including the slots of
+    # the base classes.
+    try:
+        return cls.__dict__['_slotnames_cache']
+    except KeyError:
+        pass
+    names = []
+    for c in reversed(cls.__mro__):
+        for name in c.__dict__.get('__slots__', ()):
+            if not name.startswith('__') and not name in names:
+                names.append(name)
+    cls._slotnames_cache = tuple(names)
+    return cls._slotnames_cache
+
+
 class Texel:
+    __slots__ = ()
     is_single = 0
     is_container = 0
     is_group = 0
     is_text = 0
     is_endmark = 0
-    weights = (0, 0, 0) # depth, length, lineno
+    weights = (0, 0, 0) # depth, length, lineno, ... (see weightnames)
+
+    def __init_subclass__(cls, **kwds):
+        super().__init_subclass__(**kwds)
+        _pad_weights(cls)
+
+    def __getstate__(self):
+        state = {}
+        for name in _slotnames(self.__class__):
+            try:
+                state[name] = getattr(self, name)
+            except AttributeError:
+                pass
+        d = getattr(self, '__dict__', None)
+        if d:
+            state.update(d)
+        for name, value in state.items():
+            if type(value) is Style:
+                state[name] = _plain(value)
+        return state
+
+    def __setstate__(self, state):
+        if state is not None:
+            for name, value in state.items():
+                setattr(self, name, value)
+
+    def clone(self):
+        """Returns a shallow copy of *self*."""
+        clone = self.__class__.__new__(self.__class__)
+        for name in _slotnames(self.__class__):
+            try:
+                setattr(clone, name, getattr(self, name))
+            except AttributeError:
+                pass
+        d = getattr(self, '__dict__', None)
+        if d:
+            clone.__dict__.update(d)
+        return clone
 
 
 class Single(Texel):
+    __slots__ = ('style',)
     is_single = 1
     weights = (0, 1, 0)
-    style = EMPTYSTYLE
     text = '-'
 
+    def __new__(cls, *args, **kwds):
+        # Subclasses often do not call Single.__init__. We therefore
+        # set the default style here.
+        self = Texel.__new__(cls)
+        self.style = EMPTYSTYLE
+        return self
+
     def __init__(self, style=None):
         if style:
-            self.style = style
+            self.style = as_style(style)
 
     def set_style(self, style):
-        clone = shallow_copy(self)
-        clone.style = style
+        clone = self.clone()
+        clone.style = as_style(style)
         return clone
 
     def __setstate__(self, state):
-        if state is not None:
-            self.__dict__ = state.copy()
-            self.style = as_style(self.style)
+        Texel.__setstate__(self, state)
+        self.style = as_style(self.style)
 
 
 class Text(Texel):
+    __slots__ = ('text', 'style', 'weights')
     is_text = 1
     def __init__(self, text, style=EMPTYSTYLE):
         self.text = text
-        self.style = style
-        self.weights = (0, len(text), 0)
+        self.style = as_style(style)
+        self.weights = _text_weights(text)
 
     def __repr__(self):
         return "T(%s)" % repr(self.text)
 
     def set_style(self, style):
-        clone = shallow_copy(self)
-        clone.style = style
-        return clone
+        return Text(self.text, style)
     
+    def __getstate__(self):
+        return dict(text=self.text, style=_plain(self.style))
+
     def __setstate__(self, state):
         if state is not None:
-            self.__dict__ = state.copy()
-            self.style = as_style(self.style)
+            self.text = state['text']
+            self.style = as_style(state['style'])
+            self.weights = _text_weights(self.text)
 
 T = Text
 
 
 class _TexelWithChilds(Texel):
+    # Besides the aggregated weights, groups and containers store the
+    # prefix sums of all weights which are aggregated by sum (e.g.
+    # length and lineno). The prefix sums allow to locate childs by
+    # bisection instead of linear search. They are computed on first
+    # use, see get_sums(). Since texels never change, they can also
+    # cache their text and their content hash (see get_text and
+    # content_hash).
+    __slots__ = ('childs', 'weights', 'sums', 'textcache', 'hashcache', 
+                 '__weakref__')
+
     def compute_weights(self):
-        if len(self.childs): # for empty groups, we use the default weights
-            w_list = zip(*[child.weights for child in self.childs])
-            self.weights = [f(l) for (l, f) in zip(w_list, self.functions)]
+        childs = self.childs
+        for name in ('sums', 'textcache', 'hashcache'): # childs have changed
+            try:
+                delattr(self, name)
+            except AttributeError:
+                pass
+        if not len(childs): # for empty groups, we use the default weights
+            self.weights = Texel.weights
+            return
+        self.weights = tuple([f(l) for l, f in zip(
+            zip(*[child.weights for child in childs]), self.functions)])
+
+    def compute_sums(self):
+        childs = self.childs
+        if not len(childs):
+            self.sums = tuple([array('q', (0,)) if f is sum else None \
+                               for f in self.functions])
+            return
+        self.sums = tuple([
+            array('q', accumulate(l, initial=0)) if f is sum else None \
+            for l, f in zip(zip(*[child.weights for child in childs]),
+                            self.functions)])
+
+    def __getstate__(self):
+        state = Texel.__getstate__(self)
+        state.pop('sums', None) # sums are recomputed when needed
+        state.pop('textcache', None)
+        state.pop('hashcache', None)
+        return state
 
+    def __setstate__(self, state):
+        if state is not None:
+            Texel.__setstate__(self, state)
+            # Note that the childs may not be restored yet (cerealizer
+            # restores parents first), so we can not recompute the
+            # weights here. Older versions stored weights as list and
+            # did not store them at all for empty groups.
+            self.weights = tuple(state.get('weights', Texel.weights))
 
 
 class Group(_TexelWithChilds):
+    __slots__ = ()
     is_group = 1
     functions = (
         lambda l:max(l)+1, 
@@ -121,6 +356,7 @@ G = Group
 
 
 class Container(_TexelWithChilds):
+    __slots__ = ()
     is_container = 1
     functions = (
         lambda l:0,
@@ -128,7 +364,7 @@ class Container(_TexelWithChilds):
         sum)
         
     def set_childs(self, childs):
-        clone = shallow_copy(self)
+        clone = self.clone()
         clone.childs = list(childs[:])
         clone.compute_weights()
         return clone
@@ -142,27 +378,37 @@ class Container(_TexelWithChilds):
         
 
 class NewLine(Single):
+    __slots__ = ('parstyle', 'is_endmark')
     weights = (0, 1, 1)
-    style = EMPTYSTYLE
-    parstyle = EMPTYSTYLE
     text = u'\n'
 
+    def __new__(cls, *args, **kwds):
+        self = Single.__new__(cls)
+        self.parstyle = EMPTYSTYLE
+        self.is_endmark = 0
+        return self
+
+    def __init__(self, style=None, parstyle=None):
+        if style:
+            self.style = as_style(style)
+        if parstyle:
+            self.parstyle = as_style(parstyle)
+
     def __repr__(self):
         return 'NL'
 
     def set_parstyle(self, style):
-        clone = shallow_copy(self)
-        clone.parstyle = style
+        clone = self.clone()
+        clone.parstyle = as_style(style)
         return clone
 
     def __setstate__(self, state):
-        if state is not None:
-            self.__dict__ = state.copy()
-            self.style = as_style(self.style)
-            self.parstyle = as_style(self.parstyle)
+        Single.__setstate__(self, state)
+        self.parstyle = as_style(self.parstyle)
 
 
 class Tabulator(Single):
+    __slots__ = ()
     text = u'\t'
 
     def __repr__(self):
@@ -171,6 +417,7 @@ class Tabulator(Single):
 
 class Fraction(Container):
     # A simple math object for debugging
+    __slots__ = ()
     def __init__(self, denominator, nominator):
         self.childs = [TAB, denominator, TAB, nominator, TAB]
         self.compute_weights()
@@ -182,6 +429,35 @@ ENDMARK = NewLine()
 ENDMARK.is_endmark = 1
 NULL_TEXEL = T(u'')
 
+
+def _iter_subclasses(cls):
+    yield cls
+    for sub in cls.__subclasses__():
+        yield from _iter_subclasses(sub)
+
+
+def add_weight(name, text_weight=None):
+    """Adds a weight channel *name* and returns its index.
+
+       Groups and containers aggregate the new channel by sum. Text
+       leaves have the weight *text_weight(text)*, all other texels
+       have weight 0 unless a subclass overrides *weights* or
+       *functions*. Adding a channel twice returns the existing
+       index.
+
+       Channels must be added before texels are created, usually at
+       import time of the module defining the channel.
+    """
+    global NULL_TEXEL
+    if name in weightnames:
+        return weightnames.index(name)
+    weightnames.append(name)
+    _text_functions.append(text_weight or (lambda text:0))
+    for cls in _iter_subclasses(Texel):
+        _pad_weights(cls)
+    NULL_TEXEL.weights = _text_weights(NULL_TEXEL.text)
+    return len(weightnames)-1
+
 # ---- functions -----
 def depth(texel):
     """Returns the depth of an element.
@@ -217,13 +493,43 @@ def spans(texel):
     return r
 
 
+def get_sums(texel, windex=1):
+    """Returns the prefix sums of weight *windex* over the childs of *texel*.
+
+       The returned sequence has one element more than *texel* has
+       childs. Element k is the sum of the weights of the first k
+       childs. Only weights which are aggregated by sum (such as
+       length and lineno) have prefix sums.
+    """
+    try:
+        sums = texel.sums
+    except AttributeError: # computed on first use
+        texel.compute_sums()
+        sums = texel.sums
+    return sums[windex]
+
+
+def find_child(texel, i):
+    """Returns the number *k* of the child containing index *i*.
+
+       The child k spans *i1* <= *i* < *i2*. Childs of zero length
+       are skipped. If *i* equals the length of *texel*, the last
+       child is returned.
+    """
+    offsets = get_sums(texel)
+    n = len(offsets)-1
+    if not 0 <= i <= offsets[n] or not n:
+        raise IndexError(i)
+    return bisect_right(offsets, i, 0, n)-1
+
+
 def iter_childs(texel):
     assert texel.is_group or texel.is_container
-    i1 = 0
+    offsets = get_sums(texel)
+    k = 0
     for child in texel.childs:
-        i2 = i1+length(child)
-        yield i1, i2, child
-        i1 = i2    
+        yield offsets[k], offsets[k+1], child
+        k += 1
 
 
 def iter_d0(texel): # not needed, but might be useful in future
@@ -243,24 +549,137 @@ def iter_d0(texel): # not needed, but might be useful in future
                 l.pop()
 
 
-def iter_leaves(texel): # not needed, but might be useful in future
-    """Iterate through all leaf-elements """
-    l = [[texel]]
-    i1 = 0
+class Finger:
+    """A cursor on the leaves of a texel tree.
+
+       The finger keeps the path from *texel* down to the current
+       leaf. Moving to a neighbouring leaf therefore costs amortized
+       O(1) instead of a descent from the root.
+    """
+    def __init__(self, texel, i=0):
+        self.texel = texel
+        self.seek(i)
+
+    def seek(self, i):
+        """Moves the finger to the leaf containing index *i*."""
+        path = self.path = [] # elements are [node, k, i0]
+        texel = self.texel
+        i0 = 0
+        while (texel.is_group or texel.is_container) and texel.childs:
+            if i-i0 <= 0:
+                k = 0
+            else:
+                k = find_child(texel, min(i-i0, length(texel)))
+            path.append([texel, k, i0])
+            i0 += get_sums(texel)[k]
+            texel = texel.childs[k]
+
+    def get(self):
+        """Returns index range and texel of the current leaf."""
+        if not self.path:
+            texel = self.texel
+            return 0, length(texel), texel
+        node, k, i0 = self.path[-1]
+        i1 = i0+get_sums(node)[k]
+        texel = node.childs[k]
+        return i1, i1+length(texel), texel
+
+    def _descend(self, last):
+        # Descends from the current texel to its first or last leaf.
+        i1, i2, texel = self.get()
+        while (texel.is_group or texel.is_container) and texel.childs:
+            k = len(texel.childs)-1 if last else 0
+            self.path.append([texel, k, i1])
+            i1 += get_sums(texel)[k]
+            texel = texel.childs[k]
+
+    def next_leaf(self):
+        """Moves to the next leaf. Returns False if there is none."""
+        path = self.path
+        while path:
+            frame = path[-1]
+            if frame[1]+1 < len(frame[0].childs):
+                frame[1] += 1
+                self._descend(False)
+                return True
+            path.pop()
+        self.seek(length(self.texel))
+        return False
+
+    def prev_leaf(self):
+        """Moves to the previous leaf. Returns False if there is none."""
+        path = self.path
+        while path:
+            frame = path[-1]
+            if frame[1] > 0:
+                frame[1] -= 1
+                self._descend(True)
+                return True
+            path.pop()
+        self.seek(0)
+        return False
+
+
+def iter_leaves(texel, i=0, backward=False):
+    """Iterates through all leaf elements starting at index *i*.
+
+       Yields tuples (i1, i2, leaf). Forward iteration starts with the
+       leaf containing *i*, backward iteration with the leaf
+       containing *i*-1.
+    """
+    if backward:
+        if i <= 0:
+            return
+        finger = Finger(texel, i-1)
+        step = finger.prev_leaf
+    else:
+        finger = Finger(texel, i)
+        step = finger.next_leaf
     while 1:
-        while l and not l[-1]:
-            l.pop()
-        if not l:
+        i1, i2, leaf = finger.get()
+        if not (leaf.is_group or leaf.is_container) and \
+           (backward or i2 > i or i1 == i2):
+            yield i1, i2, leaf
+        if not step():
             break
-        ll = l[-1]
-        elem = ll[0]
-        del ll[0]
-        if elem.is_group or elem.is_container:
-            l.append(list(elem.childs))
+
+
+def iter_chars(texel, i=0, backward=False):
+    """Iterates through the characters starting at index *i*.
+
+       Yields tuples (j, c) where c is the character at index j. 
+       Backward iteration starts at index *i*-1.
+    """
+    for i1, i2, leaf in iter_leaves(texel, i, backward):
+        text = leaf.text
+        if backward:
+            for j in range(min(i2, i)-1, i1-1, -1):
+                yield j, text[j-i1]
         else:
-            i2 = i1+length(elem)
-            yield i1, i2, elem
-            i1 = i2
+            for j in range(max(i1, i), i2):
+                yield j, text[j-i1]
+
+
+def iter_styles(texel, i=0):
+    """Iterates through the style runs starting at index *i*.
+
+       Yields tuples (i1, i2, style). Neighbouring leaves with the
+       same style are joined into one run.
+    """
+    j1 = j2 = None
+    current = None
+    for i1, i2, leaf in iter_leaves(texel, i):
+        if i1 == i2:
+            continue
+        i1 = max(i1, i)
+        if leaf.style is current and i1 == j2:
+            j2 = i2
+            continue
+        if current is not None:
+            yield j1, j2, current
+        j1, j2, current = i1, i2, leaf.style
+    if current is not None:
+        yield j1, j2, current
 
 
 def groups(l):
@@ -377,8 +796,8 @@ def _fuse(l1, l2):
        is_homogeneous(l2)
        calc_length(l1)+calc_length(l2) == calc_length(__return__)
     """
-    l1 = list(filter(length, l1)) # strip off empty elements
-    l2 = list(filter(length, l2)) #
+    l1 = split_oversized(list(filter(length, l1))) # strip off empty
+    l2 = split_oversized(list(filter(length, l2))) # elements
     if not l1:
         return l2
     if not l2:
@@ -432,15 +851,14 @@ def insert(texel, i, stuff):
     """
     if not 0 <= i <= length(texel):
         raise IndexError(i)
-    if texel.is_group:
-        k = -1
-        for i1, i2, child in iter_childs(texel):
-            k += 1
-            if i1 <= i <= i2:
-                l = insert(child, i-i1, stuff)
-                r1 = texel.childs[:k]
-                r2 = texel.childs[k+1:]
-                return join(r1, l, r2)
+    if texel.is_group and texel.childs:
+        # find the first child with i1 <= i <= i2
+        offsets = get_sums(texel)
+        k = bisect_left(offsets, i, 1)-1
+        l = insert(texel.childs[k], i-offsets[k], stuff)
+        r1 = texel.childs[:k]
+        r2 = texel.childs[k+1:]
+        return join(r1, l, r2)
     elif texel.is_container:
         mutable = texel.get_mutability()
         k = -1
@@ -503,9 +921,19 @@ def takeout(texel, i1, i2):
     # point we only have G, C or T.
 
     if texel.is_group:
-        r1 = []; r2 = []; r3 = []; r4 = [] # outer rest
+        # Childs before ka end before i1 and childs from kb on start
+        # after i2. Only the childs inbetween have to be examined.
+        childs = texel.childs
+        offsets = get_sums(texel)
+        n = len(childs)
+        ka = bisect_right(offsets, i1, 1, n+1)-1
+        kb = bisect_right(offsets, i2, ka, n)
+        r1 = childs[:ka]; r2 = []; r3 = []; r4 = [] # outer rest
         k1 = []; k2 = []; k3 = [] # inner kernel
-        for j1, j2, child in iter_childs(texel):
+        for k in range(ka, kb):
+            j1 = offsets[k]
+            j2 = offsets[k+1]
+            child = childs[k]
             # formal prove of if-conditions in notebook 26.08.2020
             # collecting parts can still be simplified, see same entry
             if j2 <= i1:
@@ -522,6 +950,7 @@ def takeout(texel, i1, i2):
                 k3.extend(k)
             else:
                 r4.append(child)
+        r4.extend(childs[kb:])
         # Note that we are returning a list of elements which have
         # been in the content before. So even if texel is only root
         # efficient, the elements muss be element efficient.  Each of
@@ -556,11 +985,14 @@ def takeout(texel, i1, i2):
         raise IndexError((i1, i2))
 
     elif texel.is_text:
+        # Note that usually text leaves do not exceed maxleaf. Using
+        # chunked() we also split leaves which have been created
+        # otherwise.
         r = texel.text[:i1]
         s = texel.text[i1:i2]
         t = texel.text[i2:]        
         style = texel.style
-        return [Text(r+t, style)], [Text(s, style)]
+        return chunked(r+t, style), chunked(s, style)
 
     assert False
 
@@ -604,13 +1036,204 @@ if debug:
 def copy(root, i1, i2):
     """Copy all content of *root* between *i1* and *i2*.
 
+       Returns the same kernel as takeout(root, i1, i2)[1], but the
+       outer rest is not built. Subtrees which are fully contained in
+       the interval are shared, so that the costs are O(log n) plus
+       the size of the copied piece.
+
        pre:
            isinstance(root, Texel)
 
        post:
            calc_length(__return__) == (i2-i1)
+           is_homogeneous(__return__)
+           is_clean(__return__)
     """
-    return takeout(root, i1, i2)[1]
+    texel = root
+    if not (0 <= i1 <= i2 <= length(texel)): 
+        raise IndexError([i1, i2])
+    if not length(texel) or i1 == i2:
+        return []
+    if i1 <= 0 and i2 >= length(texel):
+        return strip2list(texel)
+
+    if texel.is_group:
+        childs = texel.childs
+        offsets = get_sums(texel)
+        n = len(childs)
+        ka = bisect_right(offsets, i1, 1, n+1)-1
+        kb = bisect_left(offsets, i2, ka+1, n+1)
+        # Only the first and the last child can be partially copied
+        j1 = offsets[ka]
+        if kb-ka == 1:
+            return copy(childs[ka], i1-j1, i2-j1)
+        k1 = copy(childs[ka], i1-j1, offsets[ka+1]-j1)
+        k2 = childs[ka+1:kb-1]
+        j1 = offsets[kb-1]
+        k3 = copy(childs[kb-1], 0, i2-j1)
+        return join(k1, k2, k3)
+
+    elif texel.is_container:
+        m = texel.get_mutability()
+        for k, (j1, j2, child) in enumerate(iter_childs(texel)):
+            if  i1 < j2 and j1 < i2: # test of overlap
+                if not m[k]:
+                    raise IndexError("Takeout not permitted in immutable " \
+                                     "container element.")
+                if not (j1 <= i1 and i2 <= j2):
+                    raise IndexError("Taking indices exceed countainer " \
+                                     "element boundaries. ")
+                return copy(child, i1-j1, i2-j1)
+        raise IndexError((i1, i2))
+
+    elif texel.is_text:
+        return chunked(texel.text[i1:i2], texel.style)
+
+    assert False
+
+
+def _splice_sequential(texel, edits):
+    # Helper for splice. Applies the edits one by one from right to
+    # left, so that the indices stay valid.
+    l = [texel]
+    for i1, i2, stuff in reversed(edits):
+        texel = grouped(l)
+        if i1 < i2:
+            texel = grouped(takeout(texel, i1, i2)[0])
+        l = insert(texel, i1, stuff)
+    return l
+
+
+def _splice_leaf(texel, edits):
+    # Helper for splice. Applies the edits to a leaf, if all inserted
+    # texels are leaves. Returns None otherwise.
+    r = []
+    j = 0
+    for i1, i2, stuff in edits:
+        for x in stuff:
+            if x.weights[0]:
+                return None
+        if i1 > j:
+            r.append(T(texel.text[j:i1], texel.style) if texel.is_text 
+                     else texel)
+        r.extend(stuff)
+        j = i2
+    n = length(texel)
+    if j < n:
+        r.append(T(texel.text[j:], texel.style) if texel.is_text else texel)
+    l = []
+    for x in r:
+        if not length(x):
+            continue
+        if l and can_merge(l[-1], x):
+            l[-1] = merge(l[-1], x)
+        else:
+            l.append(x)
+    return split_oversized(l)
+
+
+def _spliced_childs(texel, lists):
+    # Helper for splice and for the style functions. Replaces the
+    # childs of *texel* by the concatenation of *lists*, which
+    # alternate between unchanged and changed childs. Returns a list
+    # of texels. If all childs of a group still have their original
+    # depth, joining is not needed.
+    if texel.is_container:
+        # containers keep their childs, e.g. input and output
+        childs = []
+        for k, l in enumerate(lists):
+            if k % 2:
+                childs.append(grouped(l))
+            else:
+                childs.extend(l)
+        return [texel.set_childs(childs)]
+    d = depth(texel)-1
+    childs = []
+    for l in lists:
+        for child in l:
+            if depth(child) != d:
+                return fuse(*lists)
+        childs.extend(l)
+    if d == 0:
+        l = childs[:1]
+        for child in childs[1:]:
+            if can_merge(l[-1], child):
+                l[-1] = merge(l[-1], child)
+            else:
+                l.append(child)
+        childs = l
+    if len(childs) < nmax // 2:
+        return childs
+    if len(childs) <= nmax:
+        return [Group(childs)]
+    return groups(childs)
+
+
+def splice(texel, edits):
+    """Applies several edits in a single pass.
+
+       *Edits* is a list of tuples (i1, i2, stuff), sorted by index
+       and not overlapping. The content between *i1* and *i2* is
+       replaced by the list of texels *stuff*. Indices refer to
+       *texel* before the change. Childs which are not touched by any
+       edit are shared. Returns a list efficient list of texels.
+
+       pre:
+           is_root_efficient(texel)
+       post:
+           calc_length(__return__) == length(texel)+sum(
+               [calc_length(stuff)-i2+i1 for i1, i2, stuff in edits])
+    """
+    if not edits:
+        return [texel]
+    if texel.is_group or texel.is_container:
+        # Assign each edit to the child which contains it. Inserts
+        # are assigned like in insert().
+        childs = texel.childs
+        offsets = get_sums(texel)
+        n = len(childs)
+        if texel.is_container:
+            mutable = texel.get_mutability()
+        assigned = [[] for child in childs]
+        for i1, i2, stuff in edits:
+            if texel.is_group:
+                if i1 == i2:
+                    k = bisect_left(offsets, i1, 1, n)-1
+                else:
+                    k = bisect_right(offsets, i1, 1, n)-1
+                ok = 0 <= k < n and i2 <= offsets[k+1]
+            else:
+                # same rules as in insert() and takeout()
+                ok = False
+                for k in range(n):
+                    j1, j2 = offsets[k], offsets[k+1]
+                    if i1 == i2:
+                        ok = (j1 < i1 < j2) or \
+                            (j1 <= i1 <= j2 and mutable[k])
+                    else:
+                        ok = mutable[k] and j1 <= i1 and i2 <= j2
+                    if ok:
+                        break
+            if not ok:
+                # The edit spans several childs
+                return _splice_sequential(texel, edits)
+            j1 = offsets[k]
+            assigned[k].append((i1-j1, i2-j1, stuff))
+        lists = [] # alternating unchanged and changed childs
+        same = []
+        for child, l in zip(childs, assigned):
+            if l:
+                lists.append(same)
+                lists.append(splice(child, l))
+                same = []
+            else:
+                same.append(child)
+        lists.append(same)
+        return _spliced_childs(texel, lists)
+    l = _splice_leaf(texel, edits)
+    if l is None:
+        return _splice_sequential(texel, edits)
+    return l
 
 
 def grouped(stuff):
@@ -633,6 +1256,89 @@ def grouped(stuff):
     return strip(g)
 
 
+class TreeBuilder:
+    """Builds a texel tree from a stream of texels.
+
+       Texels are added one at a time with append() or extend().
+       Groups are formed as soon as enough texels are pending, so
+       that the builder holds less than 2*nmax texels per level. The
+       costs are linear in the number of texels.
+
+       >>> builder = TreeBuilder()
+       >>> for i in range(1000):
+       ...     builder.append(Text("x"))
+       >>> length(builder.get_texel())
+       1000
+    """
+    def __init__(self, texels=()):
+        self.levels = [[]] # pending texels, indexed by depth
+        self.extend(texels)
+
+    def extend(self, texels):
+        for texel in texels:
+            self.append(texel)
+
+    def append(self, texel):
+        d, n = texel.weights[:2]
+        if not n:
+            return # trees must be clean
+        levels = self.levels
+        if not d: # fast path for leaves and containers
+            l = levels[0]
+            l.append(texel)
+            if len(l) == 2*nmax:
+                self._push(0)
+            return
+        if len(texel.childs) < nmax//2 or any(levels[:d]):
+            # The group can not be placed at depth d. We add its
+            # childs instead.
+            for child in texel.childs:
+                self.append(child)
+            return
+        while len(levels) <= d:
+            levels.append([])
+        levels[d].append(texel)
+        if len(levels[d]) == 2*nmax:
+            self._push(d)
+
+    def _push(self, d):
+        # Moves the first texels of level *d* into a group on the
+        # next level. Like groups(), we fill groups to 3/4 so that
+        # they have room for insertions.
+        levels = self.levels
+        l = levels[d]
+        s = 3*(nmax // 4)
+        while len(l) == 2*nmax:
+            group = Group(l[:s])
+            del l[:s]
+            d += 1
+            if len(levels) == d:
+                levels.append([])
+            l = levels[d]
+            l.append(group)
+
+    def get_texel(self):
+        """Returns the root efficient tree of all texels added so far."""
+        levels = [l[:] for l in self.levels]
+        for k, l in enumerate(levels):
+            higher = [m for m in range(k+1, len(levels)) if levels[m]]
+            if not higher:
+                if len(l) <= nmax:
+                    return strip(Group(l))
+                levels.append(groups(l))
+                continue
+            if l and len(l) < nmax//2:
+                # Too few texels for a group. We take the childs of
+                # the preceding texel on the next level.
+                m = higher[0]
+                while m > k+1:
+                    levels[m-1] = levels[m].pop().childs[:]
+                    m -= 1
+                l[:0] = levels[k+1].pop().childs
+            levels[k+1].extend(groups(l))
+        return Group([])
+
+
 def strip(element):
     """Removes unnecessary Group-elements from the root."""
     n = length(element)
@@ -704,7 +1410,49 @@ def remove_leftmost(element):
 
 def can_merge(texel1, texel2):
     return texel1.is_text and texel2.is_text and \
-           texel1.style is texel2.style
+           texel1.style is texel2.style and \
+           length(texel1)+length(texel2) <= maxleaf
+
+
+def chunked(text, style=EMPTYSTYLE):
+    """Creates a list of text texels containing *text*.
+
+       Each texel is at most *maxleaf* characters long. The pieces
+       are of (almost) equal length.
+
+       post:
+           calc_length(__return__) == len(text)
+    """
+    n = len(text)
+    if n <= maxleaf:
+        return [Text(text, style)]
+    k = (n+maxleaf-1) // maxleaf
+    r = []
+    j1 = 0
+    for j in range(1, k+1):
+        j2 = (j*n) // k
+        r.append(Text(text[j1:j2], style))
+        j1 = j2
+    return r
+
+
+def split_oversized(l):
+    """Splits all text elements in list *l* which exceed maxleaf.
+
+       Only elements of depth 0 are examined. Returns a list.
+    """
+    for texel in l:
+        if texel.is_text and length(texel) > maxleaf:
+            break
+    else:
+        return l
+    r = []
+    for texel in l:
+        if texel.is_text and length(texel) > maxleaf:
+            r.extend(chunked(texel.text, texel.style))
+        else:
+            r.append(texel)
+    return r
 
 
 def merge(texel1, texel2):
@@ -749,7 +1497,462 @@ def get_text(texel):
     if texel.is_single or texel.is_text:
         return texel.text
     assert texel.is_group or texel.is_container
-    return u''.join([get_text(x) for x in texel.childs])
+    try:
+        return texel.textcache
+    except AttributeError:
+        pass
+    text = u''.join([get_text(x) for x in texel.childs])
+    if textcache_min <= len(text) <= textcache_max:
+        _cache_text(texel, text)
+    return text
+
+
+# All cached texts are registered with their size, so that their
+# total size can be limited. When the limit is exceeded, the texts of
+# the lowest groups are dropped first: the groups above them can
+# still return their text quickly. Entries are removed when their
+# texel dies. Trees can be read from several threads (see
+# TextModel.snapshot), so the bookkeeping is guarded by a lock. It is
+# reentrant because the weak reference callbacks can run in the middle
+# of an update.
+_textcache = {} # depth -> OrderedDict id(texel) -> (weak reference, size)
+_textcache_size = 0 # number of cached characters
+_textcache_lock = RLock()
+
+def _cache_text(texel, text):
+    global _textcache_size
+    key = texel.weights[0], id(texel)
+    def forget(r, key=key):
+        with _textcache_lock:
+            entry = _textcache[key[0]].get(key[1])
+            if entry is not None and entry[0] is r:
+                _forget_text(key)
+    with _textcache_lock:
+        _forget_text(key)
+        try:
+            entries = _textcache[key[0]]
+        except KeyError:
+            entries = _textcache[key[0]] = OrderedDict()
+        entries[key[1]] = ref(texel, forget), len(text)
+        _textcache_size += len(text)
+        texel.textcache = text
+        _shrink_textcache()
+
+
+def _forget_text(key):
+    global _textcache_size
+    with _textcache_lock:
+        try:
+            r, n = _textcache[key[0]].pop(key[1])
+        except KeyError:
+            return
+        _textcache_size -= n
+        texel = r()
+        if texel is not None:
+            try:
+                del texel.textcache
+            except AttributeError: # dropped by compute_weights
+                pass
+
+
+def _shrink_textcache():
+    with _textcache_lock:
+        if _textcache_size <= textcache_total:
+            return
+        for d in sorted(_textcache):
+            entries = _textcache[d]
+            while entries and _textcache_size > textcache_total:
+                _forget_text((d, next(iter(entries))))
+
+
+
+# ---- Content hashes ----
+#
+# The content hash is a polynomial over the characters and over their
+# styles, modulo a large prime. It therefore does not depend on how
+# the content is split into leaves and groups: the hash of a group is
+# combined from the hashes and lengths of its childs. Since only
+# content enters the hash, it is stable across sessions and survives
+# saving and loading. Containers and other singles are hashed as a
+# whole.
+
+_P = (1<<61)-1 # Mersenne prime
+_B = 0x5851f42d4c957f2d % _P # base for characters
+_B2 = 0x9e3779b97f4a7c15 % _P # base for styles
+_INVB = pow(_B-1, _P-2, _P)
+_INV = pow(_B2-1, _P-2, _P)
+_powers = {}, {} # n -> B**n and n -> B2**n, for short lengths
+_BLOCK = 1024
+_bpowers = [1] # B**k for k < _BLOCK
+for _k in range(1, _BLOCK):
+    _bpowers.append(_bpowers[-1]*_B % _P)
+
+
+def _pow(k, n):
+    # Returns _B**n (k=0) or _B2**n (k=1) modulo _P.
+    cache = _powers[k]
+    try:
+        return cache[n]
+    except KeyError:
+        pass
+    r = pow((_B, _B2)[k], n, _P)
+    if n <= 4096:
+        cache[n] = r
+    return r
+
+
+def _text_hash(text):
+    # Returns the sum of (c+1)*B**(n-1-k) for the code points c at
+    # positions k. The text is processed in blocks, so that the
+    # products are summed up in C.
+    h = 0
+    for i in range(0, len(text), _BLOCK):
+        block = text[i:i+_BLOCK]
+        s = sum(map(mul, map(ord, reversed(block)), _bpowers))
+        h = (h*_pow(0, len(block))+s) % _P
+    # the +1 terms: sum of B**k for k < n
+    return (h+(_pow(0, len(text))-1)*_INVB) % _P
+
+_nohash = ('weights', 'sums', 'textcache', 'hashcache', 'childs', 'style', 
+           'parstyle')
+_fingerprints = {} # style id -> fingerprint and singles
+_hashnames = {} # class -> names of the hashed slots
+
+
+def _feed(h, value):
+    # Feeds *value* into the hash object *h* in a deterministic way.
+    t = type(value)
+    h.update(t.__name__.encode('utf-8'))
+    if isinstance(value, Texel):
+        h.update(b'%i' % content_hash(value))
+    elif t is bytes:
+        h.update(b'%i:' % len(value))
+        h.update(value)
+    elif t is str:
+        value = value.encode('utf-8', 'surrogatepass')
+        h.update(b'%i:' % len(value))
+        h.update(value)
+    elif value is None or t in (int, float, bool, complex):
+        h.update(repr(value).encode('ascii')+b';')
+    elif t in (tuple, list):
+        h.update(b'%i:' % len(value))
+        for x in value:
+            _feed(h, x)
+    elif isinstance(value, dict):
+        h.update(b'%i:' % len(value))
+        for key in sorted(value):
+            _feed(h, key)
+            _feed(h, value[key])
+    else:
+        _feed(h, getattr(value, '__dict__', repr(value)))
+
+
+def _fingerprint(*values):
+    h = blake2b(digest_size=16)
+    for value in values:
+        _feed(h, value)
+    return int.from_bytes(h.digest(), 'big') % _P
+
+
+def _style_fingerprint(style):
+    # Styles are shared, so we cache their fingerprints by style id.
+    try:
+        return _fingerprints[style.id]
+    except KeyError:
+        pass
+    if len(_fingerprints) > 10000:
+        _fingerprints.clear()
+    f = _fingerprints[style.id] = _fingerprint(style)
+    return f
+
+
+def _attrs(texel):
+    # Returns the attributes of *texel* which are hashed as a list of
+    # (name, value)-pairs.
+    cls = texel.__class__
+    try:
+        names = _hashnames[cls]
+    except KeyError:
+        names = _hashnames[cls] = tuple(
+            name for name in _slotnames(cls) if not name in _nohash)
+    d = getattr(texel, '__dict__', None)
+    if d:
+        names = names+tuple(sorted(name for name in d if not name in _nohash))
+    return [(name, getattr(texel, name)) for name in names \
+            if hasattr(texel, name)]
+
+
+def _hash_pair(texel):
+    # Returns the character and the style component of the hash.
+    if texel.is_group or texel.is_container:
+        try:
+            return texel.hashcache
+        except AttributeError:
+            pass
+    elif texel.is_text:
+        text = texel.text
+        ht = _text_hash(text)
+        # style component: sum of f*B2**k for k < len(text)
+        f = _style_fingerprint(texel.style)
+        hs = f*(_pow(1, len(text))-1)*_INV % _P
+        return ht, hs
+    attrs = _attrs(texel)
+    if texel.is_group:
+        ht = hs = 0
+        for child in texel.childs:
+            n = length(child)
+            a, b = _hash_pair(child)
+            ht = (ht*_pow(0, n)+a) % _P
+            hs = (hs*_pow(1, n)+b) % _P
+    elif texel.is_container:
+        pairs = [_hash_pair(child) for child in texel.childs]
+        ht = _fingerprint(texel.__class__.__name__, attrs, pairs)
+        hs = _fingerprint(pairs)
+    else:
+        # Most singles are newlines and tabulators which only differ
+        # in their styles. Their fingerprints are therefore cached.
+        key = (texel.__class__.__name__,)+tuple(attrs)
+        try:
+            ht = _fingerprints[key]
+        except (KeyError, TypeError): # TypeError: key is not hashable
+            ht = _fingerprint(*key)
+            if all(type(v) in (int, bool, str) for n, v in attrs):
+                _fingerprints[key] = ht
+        hs = 0
+        for name in ('style', 'parstyle'):
+            style = getattr(texel, name, None)
+            if style is not None:
+                hs = (hs*_B2+_style_fingerprint(style)) % _P
+    pair = ht, hs
+    if texel.is_group or texel.is_container:
+        texel.hashcache = pair
+    return pair
+
+
+def content_hash(texel):
+    """Returns a hash value of the content of *texel*.
+
+       Texels with equal text, equal styles and equal elements get
+       equal hashes, regardless of how they are grouped. The hash is
+       computed from content only, so that it is the same after a
+       texel has been saved and loaded again. It is cached in groups
+       and containers.
+    """
+    ht, hs = _hash_pair(texel)
+    return ht*_P+hs
+
+
+def _expand(l, d):
+    # Helper for diff: replaces all groups of depth *d* in *l* by
+    # their childs.
+    r = []
+    for i, texel in l:
+        if texel.is_group and texel.weights[0] == d:
+            offsets = get_sums(texel)
+            for k, child in enumerate(texel.childs):
+                r.append((i+offsets[k], child))
+        else:
+            r.append((i, texel))
+    return r
+
+
+def _diff(a, i1, i2, b, j1, j2, r):
+    # Helper for diff. The lists *a* and *b* contain tuples (i, texel)
+    # which cover the old range i1, i2 and the new range j1, j2.
+
+    # 1. strip common prefix and suffix
+    n = min(len(a), len(b))
+    k = 0
+    while k < n and a[k][1] is b[k][1]:
+        d = length(a[k][1])
+        i1 += d
+        j1 += d
+        k += 1
+    m = 0
+    while m < n-k and a[-1-m][1] is b[-1-m][1]:
+        d = length(a[-1-m][1])
+        i2 -= d
+        j2 -= d
+        m += 1
+    a = a[k:len(a)-m]
+    b = b[k:len(b)-m]
+    if not a or not b:
+        if i1 < i2 or j1 < j2:
+            r.append((i1, i2, j1, j2))
+        return
+
+    # 2. texels which are present in both lists split the problem
+    pos = dict((id(texel), k) for k, (i, texel) in enumerate(b))
+    anchors = []
+    last = -1
+    for ka, (i, texel) in enumerate(a):
+        kb = pos.get(id(texel), -1)
+        if kb > last:
+            anchors.append((ka, kb))
+            last = kb
+    if anchors:
+        ka0 = kb0 = 0
+        k1 = i1; l1 = j1
+        for ka, kb in anchors:
+            k2 = a[ka][0]; l2 = b[kb][0]
+            _diff(a[ka0:ka], k1, k2, b[kb0:kb], l1, l2, r)
+            k1 = k2+length(a[ka][1]); l1 = l2+length(b[kb][1])
+            ka0 = ka+1; kb0 = kb+1
+        _diff(a[ka0:], k1, i2, b[kb0:], l1, j2, r)
+        return
+
+    # 3. look one level deeper
+    da = max(texel.weights[0] for i, texel in a if texel.is_group) \
+        if any(texel.is_group for i, texel in a) else 0
+    db = max(texel.weights[0] for i, texel in b if texel.is_group) \
+        if any(texel.is_group for i, texel in b) else 0
+    if not da and not db:
+        r.append((i1, i2, j1, j2))
+        return
+    d = max(da, db)
+    if da == d:
+        a = _expand(a, d)
+    if db == d:
+        b = _expand(b, d)
+    _diff(a, i1, i2, b, j1, j2, r)
+
+
+def diff(old, new):
+    """Returns the index ranges in which the trees *old* and *new* differ.
+
+       The result is a sorted list of tuples (i1, i2, j1, j2) each
+       meaning that old[i1:i2] has been replaced by new[j1:j2]. Since
+       edits reuse all untouched subtrees, most of both trees is
+       shared. Shared subtrees are skipped, so that the costs are
+       proportional to the changed part. Containers are compared as a
+       whole.
+    """
+    r = []
+    _diff([(0, old)], 0, length(old), [(0, new)], 0, length(new), r)
+    # join adjacent ranges
+    l = []
+    for i1, i2, j1, j2 in r:
+        if l and l[-1][1] == i1 and l[-1][3] == j1:
+            l[-1] = (l[-1][0], i2, l[-1][2], j2)
+        else:
+            l.append((i1, i2, j1, j2))
+    return l
+
+
+# ---- Interning ----
+#
+# Texels never change. Structurally identical subtrees can therefore
+# be replaced by a single shared instance. This saves a lot of memory
+# in generated notebooks, which often repeat output blocks, headers
+# or bitmaps. Texels are identified by class, weights and content
+# hash. The weights contain the depth, so that groups are only
+# replaced by groups which fit into the same place of the tree. Leaves
+# are cheap to compare and are therefore identified by their
+# attributes. Since styles are shared, they are compared by identity.
+
+def _sizeof(texel):
+    # Rough estimate of the memory held by *texel* alone, i.e. without
+    # its childs and without the shared styles.
+    n = sys.getsizeof(texel)
+    for name in _slotnames(texel.__class__):
+        if name in ('style', 'parstyle') or not hasattr(texel, name):
+            continue
+        value = getattr(texel, name)
+        if name == 'weights' and value is texel.__class__.weights:
+            continue
+        n += sys.getsizeof(value)
+        if name == 'sums':
+            n += sum(sys.getsizeof(a) for a in value if a is not None)
+    d = getattr(texel, '__dict__', None)
+    if d is not None:
+        n += sys.getsizeof(d)
+        for name, value in d.items():
+            if name not in ('style', 'parstyle') and \
+                    not isinstance(value, Texel):
+                n += sys.getsizeof(value)
+    return n
+
+
+def _intern_key(texel):
+    # Texels with equal keys are structurally identical. The childs
+    # must already be interned, so that they can be compared by
+    # identity.
+    if texel.is_text:
+        return Text, texel.text, id(texel.style)
+    key = (texel.__class__, id(getattr(texel, 'style', None)), 
+           id(getattr(texel, 'parstyle', None)))+tuple(_attrs(texel))
+    if texel.is_group or texel.is_container:
+        key += (tuple([id(child) for child in texel.childs]),)
+    return key
+
+
+class Interner:
+    """Shares structurally identical subtrees and leaves.
+
+       An interner can be applied to several trees, e.g. to all
+       documents loaded in a session. It counts the texels it dropped
+       (*shared*) and estimates the memory they held in bytes
+       (*saved*).
+    """
+    def __init__(self):
+        self.table = {}
+        self.shared = 0
+        self.saved = 0
+
+    def intern(self, texel):
+        """Returns *texel* with all identical subtrees shared."""
+        return self._intern(texel, {})
+
+    def _intern(self, texel, done):
+        # *done* maps the ids of already visited texels to the
+        # result. Loaded trees can already share subtrees.
+        try:
+            return done[id(texel)]
+        except KeyError:
+            pass
+        r = done[id(texel)] = self._intern1(texel, done)
+        return r
+
+    def _intern1(self, texel, done):
+        old = texel
+        if texel.is_group or texel.is_container:
+            childs = [self._intern(child, done) for child in texel.childs]
+            if any(a is not b for a, b in zip(childs, texel.childs)):
+                if texel.is_group:
+                    texel = texel.__class__(childs)
+                else:
+                    texel = texel.set_childs(childs)
+                if hasattr(old, 'hashcache'): # content is the same
+                    texel.hashcache = old.hashcache
+        key = _intern_key(texel)
+        try:
+            shared = self.table[key]
+        except KeyError:
+            self.table[key] = texel
+            return texel
+        except TypeError: # unhashable attributes
+            shared = self._lookup(key, texel)
+        if shared is not old:
+            self.shared += 1
+            self.saved += _sizeof(old)
+        return shared
+
+    def _lookup(self, key, texel):
+        # Texels with unhashable attributes are collected in buckets
+        # by content hash. The hash only selects the bucket, equality
+        # is decided by comparing the keys.
+        bucket = self.table.setdefault(
+            (texel.__class__, content_hash(texel)), [])
+        for other, shared in bucket:
+            if other == key:
+                return shared
+        bucket.append((key, texel))
+        return texel
+
+
+def intern_texels(texel):
+    """Returns *texel* with structurally identical subtrees shared."""
+    return Interner().intern(texel)
 
 
 # ---- Debug Tools ---
@@ -1114,3 +2317,407 @@ def test_11():
     assert nl2.parstyle == dict(base='h2')
 
 
+
+
+def test_12():
+    "slots"
+    s1 = as_style(dict(base='h1'))
+    for texel in (T("abc"), NL, TAB, G([T("abc"), NL])):
+        assert not hasattr(texel, '__dict__')
+    nl = NL.set_parstyle(s1)
+    assert nl.style is NL.style
+    from pickle import dumps, loads
+    g = G([T("abc"), nl, G([])])
+    g_ = loads(dumps(g))
+    assert g_.weights == g.weights
+    assert g_.childs[1].parstyle is s1
+    assert not g_.childs[1].is_endmark
+    assert loads(dumps(ENDMARK)).is_endmark
+
+
+def test_13():
+    "maxleaf"
+    global maxleaf
+    old = maxleaf
+    set_maxleaf(10)
+    try:
+        l = chunked("0123456789abcdefghijklmnopqrstuvwxyz")
+        assert [len(x.text) for x in l] == [9, 9, 9, 9]
+        texel = grouped(l)
+        for i in range(20):
+            texel = grouped(insert(texel, 2*i, [T("X")]))
+            for i1, i2, leaf in iter_leaves(texel):
+                assert length(leaf) <= maxleaf
+        texel = grouped(fuse([texel], [T("ABCDEFGHIJKLMNOPQRSTUVW")]))
+        for i1, i2, leaf in iter_leaves(texel):
+            assert length(leaf) <= maxleaf
+        assert is_root_efficient(texel)
+        r, k = takeout(G([T("0123456789"*5)]), 3, 4)
+        assert max(length(x) for x in r) <= maxleaf
+    finally:
+        set_maxleaf(old)
+
+
+def test_14():
+    "prefix sums and bisection"
+    from random import Random
+    random = Random(1)
+    texel = G([T("01"), T("2345"), NL, T("6"), T("789")])
+    assert list(get_sums(texel)) == [0, 2, 6, 7, 8, 11]
+    assert list(get_sums(texel, 2)) == [0, 0, 0, 1, 1, 1]
+    assert get_sums(texel, 0) is None
+    assert [find_child(texel, i) for i in range(12)] == \
+        [0, 0, 1, 1, 1, 1, 2, 3, 4, 4, 4, 4]
+    try:
+        find_child(texel, 12)
+        assert False
+    except IndexError:
+        pass
+
+    # compare insert and takeout against plain strings
+    s = ''
+    texel = G([])
+    for n in range(300):
+        i = random.randrange(len(s)+1)
+        t = "abcdefgh"[:random.randrange(1, 8)]
+        texel = grouped(insert(texel, i, [T(t)]))
+        s = s[:i]+t+s[i:]
+        if n % 3 == 0:
+            i1 = random.randrange(len(s)+1)
+            i2 = random.randrange(i1, len(s)+1)
+            r, k = takeout(texel, i1, i2)
+            assert ''.join(x.text for x in strip2list(grouped(k))
+                           if x.is_text) == s[i1:i2]
+            texel = grouped(r)
+            s = s[:i1]+s[i2:]
+        assert length(texel) == len(s)
+    assert ''.join(leaf.text for i1, i2, leaf in iter_leaves(texel)) == s
+
+
+def test_15():
+    "text cache"
+    old = textcache_min, textcache_max, textcache_total
+    set_textcache(10, 100)
+    try:
+        small = G([T("0123"), T("456")])
+        assert get_text(small) == "0123456"
+        assert not hasattr(small, 'textcache')
+        texel = G([G([T("012345678"), NL]) for k in range(20)])
+        assert get_text(texel) == "012345678\n"*20
+        assert not hasattr(texel, 'textcache') # too long
+        for child in texel.childs:
+            assert child.textcache == get_text(child)
+
+        c = Container()
+        c.childs = [TAB, G([T("abcdefghijk")]), TAB]
+        c.compute_weights()
+        assert get_text(c) == "\tabcdefghijk\t"
+        assert c.textcache == get_text(c)
+        c2 = c.set_childs([TAB, G([T("ABCDEFGHIJK")]), TAB])
+        assert get_text(c2) == "\tABCDEFGHIJK\t"
+        assert get_text(c) == "\tabcdefghijk\t"
+
+        import pickle
+        s = pickle.dumps(c)
+        assert not 'textcache' in pickle.loads(s).__getstate__()
+
+        # total limit
+        set_textcache(10, 1000, 0)
+        assert _textcache_size == 0
+        set_textcache(10, 1000, 600)
+        texel = G([G([G([T("012345678"), NL]) for k in range(5)]) 
+                   for k in range(10)])
+        assert get_text(texel) == "012345678\n"*50
+        assert _textcache_size <= 600
+        # the lowest groups are dropped first
+        assert texel.textcache == "012345678\n"*50
+        assert not hasattr(texel.childs[0].childs[-1], 'textcache')
+        assert texel.childs[-1].textcache == "012345678\n"*5
+        del texel
+        assert _textcache_size == 0 # entries of dead texels are removed
+    finally:
+        set_textcache(*old)
+
+
+def test_16():
+    "finger"
+    x = {'x':1}
+    texel = G([G([T("012"), NL, T("", x)]), G([]),
+               G([T("456", x), T("789", x)]), TAB])
+    text = get_text(texel)
+    assert text == "012\n456789\t"
+    n = len(text)
+    leaves = list(iter_leaves(texel))
+    assert [x[:2] for x in leaves] == \
+        [(0, 3), (3, 4), (4, 4), (4, 7), (7, 10), (10, 11)]
+    assert [x[:2] for x in iter_leaves(texel, 5)] == \
+        [(4, 7), (7, 10), (10, 11)]
+    assert [x[:2] for x in iter_leaves(texel, 7, backward=True)] == \
+        [(4, 7), (4, 4), (3, 4), (0, 3)]
+    assert list(iter_leaves(texel, n)) == []
+    assert list(iter_leaves(texel, 0, backward=True)) == []
+    for i in range(n+1):
+        assert ''.join(c for j, c in iter_chars(texel, i)) == text[i:]
+        assert ''.join(c for j, c in iter_chars(texel, i, True)) == \
+            text[:i][::-1]
+        assert [j for j, c in iter_chars(texel, i)] == list(range(i, n))
+    assert [x[:2] for x in iter_styles(texel)] == [(0, 4), (4, 10), (10, 11)]
+    assert [x[:2] for x in iter_styles(texel, 5)] == [(5, 10), (10, 11)]
+
+    finger = Finger(texel, 8)
+    assert finger.get()[:2] == (7, 10)
+    assert finger.prev_leaf() and finger.get()[:2] == (4, 7)
+    assert finger.next_leaf() and finger.next_leaf()
+    assert finger.get()[:2] == (10, 11)
+    assert not finger.next_leaf()
+    assert finger.get()[:2] == (10, 11)
+
+    assert [x[:2] for x in iter_leaves(T(""))] == [(0, 0)]
+    assert list(iter_chars(G([]))) == []
+
+
+def test_17():
+    "diff"
+    from random import Random
+    random = Random(2)
+    def check(old, new, ranges):
+        # applying the replacements to the old text gives the new text
+        a = get_text(old)
+        b = get_text(new)
+        s = a
+        for i1, i2, j1, j2 in reversed(ranges):
+            s = s[:i1]+b[j1:j2]+s[i2:]
+        assert s == b
+
+    texel = grouped([T("%04i\n" % k) for k in range(2000)])
+    assert diff(texel, texel) == []
+    for n in range(100):
+        i = random.randrange(length(texel)+1)
+        new = grouped(insert(texel, i, [T("abc")]))
+        ranges = diff(texel, new)
+        assert len(ranges) == 1
+        i1, i2, j1, j2 = ranges[0]
+        assert i1 <= i <= i2 and j2-j1 == i2-i1+3 and i2-i1 <= 10
+        check(texel, new, ranges)
+        i1 = random.randrange(length(new)+1)
+        i2 = min(length(new), i1+random.randrange(20))
+        newer = grouped(takeout(new, i1, i2)[0])
+        ranges = diff(new, newer)
+        check(new, newer, ranges)
+        assert sum(i2-i1+j2-j1 for i1, i2, j1, j2 in ranges) <= 2*(i2-i1)+20
+        texel = newer
+
+    # two separate changes
+    new = grouped(insert(texel, 10, [T("x")]))
+    new = grouped(insert(new, 5000, [T("y")]))
+    ranges = diff(texel, new)
+    check(texel, new, ranges)
+    assert len(ranges) == 2
+
+
+def test_18():
+    "content_hash"
+    import pickle
+    bold = {'bold':True}
+    t1 = G([G([T("Hello "), T("World", bold)]), NL, TAB])
+    t2 = G([T("Hel"), G([T("lo "), T("Wor", bold), T("ld", bold)]),
+            G([NL, TAB, G([])])])
+    assert content_hash(t1) == content_hash(t2)
+    assert content_hash(t1) == content_hash(pickle.loads(pickle.dumps(t1)))
+    assert content_hash(T("")) == content_hash(G([]))
+    t3 = G([G([T("Hello "), T("World")]), NL, TAB])
+    t4 = G([G([T("Hello "), T("Wordl", bold)]), NL, TAB])
+    t5 = G([G([T("Hello "), T("World", bold)]), TAB, NL])
+    l = [content_hash(x) for x in (t1, t3, t4, t5, NL, TAB, ENDMARK, T("\n"))]
+    assert len(set(l)) == len(l)
+    assert t1.hashcache
+
+    texel = grouped([T("%04i\n" % k) for k in range(500)])
+    h = content_hash(texel)
+    new = grouped(insert(texel, 100, [T("x")]))
+    assert content_hash(new) != h
+    assert content_hash(grouped(takeout(new, 100, 101)[0])) == h
+    
+    c1 = Fraction(G([T("a")]), G([T("b")]))
+    c2 = Fraction(G([T("a")]), G([T("b")]))
+    c3 = Fraction(G([T("b")]), G([T("a")]))
+    assert content_hash(c1) == content_hash(c2) != content_hash(c3)
+    assert content_hash(G([T("x"), c1])) == content_hash(G([T("x"), c2]))
+
+    # characters are not hashed with a periodic base
+    a = T("x"+"a"*60+"y")
+    b = T("y"+"a"*60+"x")
+    assert content_hash(a) != content_hash(b)
+    text = u"".join(chr(32+k % 5000) for k in range(3000))
+    assert content_hash(T(text)) == content_hash(
+        G([T(text[:1000]), T(text[1000:2500]), T(text[2500:])]))
+
+
+def test_19():
+    "interning"
+    bold = {'bold':True}
+    def block():
+        return G([G([T("Hello "), T("World", bold), NewLine()]),
+                  G([T("x = 1"), NewLine()])])
+    texel = G([block(), block(), Fraction(block(), block())])
+    interner = Interner()
+    new = interner.intern(texel)
+    assert get_text(new) == get_text(texel)
+    assert content_hash(new) == content_hash(texel)
+    assert new.weights == texel.weights
+    assert new.childs[0] is new.childs[1]
+    fraction = new.childs[2]
+    assert fraction.childs[1] is fraction.childs[3] is new.childs[0]
+    assert interner.shared > 0 and interner.saved > 0
+    # interning again does not change anything
+    assert interner.intern(new) is new
+
+    # different styles or depths are not shared
+    t1 = G([T("ab"), T("c")])
+    t2 = G([G([T("ab"), T("c")])])
+    t3 = G([T("ab", bold), T("c")])
+    new = intern_texels(G([t1, T("abc"), t3, NL, G([t2, t2])]))
+    l = new.childs
+    assert l[0] is not l[1] and l[0] is not l[2]
+    assert l[4].childs[0] is l[4].childs[1]
+    assert l[4].childs[0].childs[0] is l[0]
+
+
+
+def test_20():
+    "TreeBuilder"
+    from random import Random
+    random = Random(0)
+    for n in (0, 1, 2, 7, 8, 15, 16, 17, 31, 32, 33, 100, 257, 1000, 5000):
+        l = [T("%i," % k) for k in range(n)]
+        texel = TreeBuilder(l).get_texel()
+        assert is_root_efficient(texel)
+        assert get_text(texel) == ''.join(t.text for t in l)
+
+    # mixed input: leaves, empty texels and subtrees of any depth
+    for k in range(50):
+        builder = TreeBuilder()
+        text = []
+        for j in range(random.randrange(200)):
+            x = random.random()
+            if x < 0.1:
+                builder.append(NULL_TEXEL)
+                continue
+            elif x < 0.3:
+                m = random.choice((1, 5, 20, 100, 1000))
+                texel = grouped([T("%i;" % i) for i in range(m)])
+            else:
+                texel = T("%i," % j)
+            builder.append(texel)
+            text.append(get_text(texel))
+            if random.random() < 0.05:
+                # get_texel does not consume the builder
+                assert get_text(builder.get_texel()) == ''.join(text)
+        texel = builder.get_texel()
+        assert is_root_efficient(texel)
+        assert is_clean(strip2list(texel))
+        assert get_text(texel) == ''.join(text)
+
+
+def test_21():
+    "copy"
+    from random import Random
+    random = Random(0)
+    l = []
+    for k in range(3000):
+        l.append(T("%i," % k))
+        if random.random() < 0.1:
+            l.append(NL)
+    texel = TreeBuilder(l).get_texel()
+    s = get_text(texel)
+    for k in range(200):
+        i1 = random.randrange(len(s)+1)
+        i2 = random.randrange(i1, min(i1+random.choice((5, 100, 5000)), 
+                                      len(s))+1)
+        kernel = copy(texel, i1, i2)
+        assert is_clean(kernel)
+        assert is_list_efficient(kernel)
+        assert get_text(grouped(kernel)) == s[i1:i2]
+        assert content_hash(grouped(kernel)) == \
+            content_hash(grouped(takeout(texel, i1, i2)[1]))
+    # subtrees are shared
+    kernel = copy(texel, 3, len(s)-3)
+    inner = [leaf for i1, i2, leaf in iter_leaves(texel) 
+             if i1 >= 3 and i2 <= len(s)-3]
+    copied = [leaf for i1, i2, leaf in iter_leaves(grouped(kernel))]
+    assert len(copied) == len(inner)+2
+    for a, b in zip(copied[1:-1], inner):
+        assert a is b
+    try:
+        copy(texel, 5, 3)
+        assert False
+    except IndexError:
+        pass
+
+
+def test_22():
+    "splice"
+    from random import Random
+    random = Random(0)
+    l = []
+    for k in range(500):
+        l.append(T("%i," % k))
+        if random.random() < 0.1:
+            l.append(NL)
+    texel = TreeBuilder(l).get_texel()
+    s = get_text(texel)
+    for k in range(100):
+        edits = []
+        i = 0
+        while 1:
+            i1 = i+random.randrange(random.choice((3, 50, 500)))
+            i2 = i1+random.choice((0, 0, 1, 4, 20))
+            if i2 > len(s):
+                break
+            stuff = random.choice(([], [T("xx")], [NL, T("y")]))
+            edits.append((i1, i2, stuff))
+            i = i2
+        new = splice(texel, edits)
+        assert is_list_efficient(new)
+        assert is_clean(new)
+        t = s
+        for i1, i2, stuff in reversed(edits):
+            t = t[:i1]+''.join(get_text(x) for x in stuff)+t[i2:]
+        assert get_text(grouped(new)) == t
+        assert content_hash(grouped(new)) == \
+            content_hash(grouped(_splice_sequential(texel, edits)))
+
+    # edits inside a container
+    fraction = Fraction(T("Sin(alpha)"), T("Cos(alpha)"))
+    texel = G([T("abc"), fraction, T("def")])
+    new = grouped(splice(texel, [(1, 2, []), (5, 8, [T("x")]), 
+                                  (16, 16, [T("y")])]))
+    assert get_text(new) == get_text(grouped(_splice_sequential(
+        texel, [(1, 2, []), (5, 8, [T("x")]), (16, 16, [T("y")])])))
+    try:
+        splice(texel, [(3, 5, [])]) # partially removes the fraction
+        assert False
+    except IndexError:
+        pass
+
+
+def test_23():
+    "interning does not trust content hashes"
+    global content_hash
+    a = "x"+"a"*60+"y"
+    b = "y"+"a"*60+"x"
+    class Data(Single):
+        def __init__(self, data):
+            self.data = data # unhashable
+    texel = G([G([T(a)]), G([T(b)]), Fraction(G([T(a)]), G([T(b)])),
+               Data([1]), Data([2]), Data([1])])
+    old = content_hash
+    try:
+        content_hash = lambda texel: 0
+        new = intern_texels(texel)
+    finally:
+        content_hash = old
+    assert get_text(new) == get_text(texel)
+    assert new.childs[0] is not new.childs[1]
+    l = new.childs
+    assert l[3].data == [1] and l[4].data == [2] and l[5] is l[3]
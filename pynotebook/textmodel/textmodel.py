@@ -3,12 +3,18 @@
 
 from .texeltree import Text, Group, NewLine, Tabulator, insert, takeout, \
     ENDMARK, is_homogeneous, provides_childs, grouped, length, iter_childs, depth, \
-    is_list_efficient, is_root_efficient, strip2list, EMPTYSTYLE
+    is_list_efficient, is_root_efficient, strip2list, EMPTYSTYLE, chunked, \
+    find_child, get_sums, get_text, iter_leaves, iter_chars, iter_styles, \
+    TreeBuilder, NULL_TEXEL, copy, splice, diff
 from .styles import updated_style, create_style, get_styles, set_styles, \
     get_style, set_properties, get_parstyles, set_parstyles, set_parproperties, \
-    StyleIterator
-from .weights import find_weight, get_weight, NotFound
+    StyleIterator, apply_runs, style_length, get_parstyle, iter_paragraphs
+from .weights import find_weight, get_weight, find_weights, get_weights, \
+    NotFound
+from .search import finditer
 from .modelbase import Model
+from .properties import overridable_property
+from bisect import bisect_left, bisect_right
 import re
 
 
@@ -18,9 +24,9 @@ debug = 0
 
 def _get_texel(texel, i):
     if provides_childs(texel):
-        for i1, i2, child in iter_childs(texel):
-            if i1 <= i < i2:
-                return _get_texel(child, i-i1)
+        if 0 <= i < length(texel):
+            k = find_child(texel, i)
+            return _get_texel(texel.childs[k], i-get_sums(texel)[k])
     else:
         if i != 0:
             raise IndexError(i)
@@ -28,10 +34,18 @@ def _get_texel(texel, i):
 
 def _get_text(texel, i1, i2):
     r = []
+    if i1 <= 0 and i2 >= length(texel):
+        return get_text(texel) # may be cached
     if provides_childs(texel):
-        for j1, j2, child in iter_childs(texel):
-            if i1 < j2 and j1 < i2: # intersection
-                r.append(_get_text(child, i1-j1, i2-j1))
+        # only childs k1 <= k < k2 intersect with i1, i2
+        childs = texel.childs
+        offsets = get_sums(texel)
+        n = len(childs)
+        k1 = bisect_right(offsets, i1, 1, n+1)-1
+        k2 = bisect_left(offsets, i2, k1, n)
+        for k in range(k1, k2):
+            j1 = offsets[k]
+            r.append(_get_text(childs[k], i1-j1, i2-j1))
         return u''.join(r)
     text = texel.text
     return text[max(0, i1):min(i2, len(text))]
@@ -60,6 +74,7 @@ class TextModel(Model):
     - "inserted" (arguments: i, length)
     - "removed" (arguments: i, removed data)
     - "properties changed" (arguments: i1, i2)
+    - "replaced" (arguments: i, n1, n2)
 
     """
     defaultstyle = create_style()
@@ -68,36 +83,78 @@ class TextModel(Model):
         """Creates a new textmodel with text $text$ and uniform style."""
         return self.__class__(text, **properties)
 
-    def __init__(self, text='', **properties):
+    def __init__(self, text='', interner=None, **properties):
+        # If an *interner* (see texeltree.Interner) is given,
+        # identical subtrees are shared. It counts the shared texels
+        # and the memory saved.
         assert type(text) == str
         style = updated_style(self.defaultstyle, properties)
         self.ENDMARK = ENDMARK.set_style(style)
-        l = []
+        builder = TreeBuilder()
+        append = builder.append
         text = text.replace('\r', '')
+        # Texels never change. Equal leaves are therefore shared.
+        leaves = {'\n':NewLine(style), '\t':Tabulator(style), '':NULL_TEXEL}
         for part in _split(text):
-            if part == '\n':
-                l.append(NewLine(style))
-            elif part == '\t':
-                l.append(Tabulator(style))
-            elif len(part):
-                l.append(Text(part, style))
-        self.texel = grouped(l)
+            try:
+                append(leaves[part])
+            except KeyError:
+                l = chunked(part, style)
+                if len(l) == 1:
+                    leaves[part] = l[0]
+                builder.extend(l)
+        texel = builder.get_texel()
+        if interner is not None:
+            texel = interner.intern(texel)
+        self.texel = texel
 
     def __len__(self):
         return length(self.texel)
 
     def __getstate__(self):
         state = self.__dict__.copy()
+        for name in ('_xtexel', '_version', '_versioned'):
+            state.pop(name, None)
         return state
 
     def __setstate__(self, state):
         if state is not None:
             self.__dict__ = state
 
+    version = overridable_property(
+        'version', "Number which increases whenever the content changes.")
+    _version = 0
+    _versioned = None
+    def get_version(self):
+        # The version is updated lazily. Texel trees never change, so
+        # that a new root means new content.
+        if self._versioned is not self.texel:
+            self._versioned = self.texel
+            self._version += 1
+        return self._version
+
+    def snapshot(self):
+        """Returns a read-only view of the current content.
+
+           The snapshot is not affected by later changes and can
+           be read from other threads. Caches which are filled
+           while reading are either guarded by a lock (the text
+           cache) or only ever receive the same values (prefix sums
+           and content hashes).
+        """
+        return Snapshot(self)
+
+    _xtexel = None, None
     def get_xtexel(self):
         """Returns the texel tree extended by an ENDMARK glyph."""
         texel = self.texel
-        return Group([texel, self.ENDMARK])
+        base, xtexel = self._xtexel
+        if base is not texel:
+            # Texels never change, so the extended tree can be reused
+            # as long as the texel tree is the same.
+            xtexel = Group([texel, self.ENDMARK])
+            self._xtexel = texel, xtexel
+        return xtexel
 
     def nlines(self):
         """Returns the number of lines."""
@@ -115,15 +172,48 @@ class TextModel(Model):
             raise IndexError(i2)
         return _get_text(self.texel, i1, i2)
 
+    def iter_chars(self, i=0, backward=False):
+        """Iterates through (index, character) pairs starting at *i*.
+
+           Backward iteration starts at index *i*-1.
+        """
+        return iter_chars(self.texel, i, backward)
+
+    def iter_leaves(self, i=0, backward=False):
+        """Iterates through (i1, i2, leaf) tuples starting at *i*."""
+        return iter_leaves(self.texel, i, backward)
+
+    def iter_styles(self, i=0):
+        """Iterates through (i1, i2, style) runs starting at *i*."""
+        return iter_styles(self.texel, i)
+
     def get_style(self, i):
         """Returns the style at index *i*."""
         return get_style(self.get_xtexel(), i)
 
+    def get_styles(self, i1, i2):
+        """Returns the style runs (n, style) between *i1* and *i2*."""
+        if not (0 <= i1 <= i2 <= len(self)):
+            raise IndexError((i1, i2))
+        return get_styles(self.texel, i1, i2)
+
     def get_parstyle(self, i):
-        row, col = self.index2position(i)
-        j = self.lineend(row)
-        texel = _get_texel(self.get_xtexel(), j)
-        return texel.parstyle
+        """Returns the paragraph style at index *i*."""
+        return get_parstyle(self.get_xtexel(), i)
+
+    def iter_paragraphs(self, i1=0, i2=None):
+        """Iterates through the paragraphs containing *i1*...*i2*.
+
+           Yields (start, end, parstyle) tuples. The end index
+           includes the NewLine. The last paragraph ends at
+           len(self).
+        """
+        if i2 is None:
+            i2 = len(self)
+        if not (0 <= i1 <= i2 <= len(self)):
+            raise IndexError((i1, i2))
+        for start, end, parstyle in iter_paragraphs(self.get_xtexel(), i1, i2):
+            yield start, min(end, len(self)), parstyle
 
     def position2index(self, row, col):
         """Returns the index corresponding to *row* and *col*."""
@@ -152,6 +242,40 @@ class TextModel(Model):
         col = i-j
         return row, col
 
+    def positions_to_indices(self, positions):
+        """Returns the indices corresponding to a sequence of (row,
+           col)-tuples. Like position2index, but all lines are located
+           in one pass through the tree.
+        """
+        positions = list(positions)
+        order = sorted(range(len(positions)), key=lambda k: positions[k])
+        rows = [positions[k][0] for k in order]
+        try:
+            starts = find_weights(self.texel, rows, 2)
+        except NotFound as e:
+            raise IndexError(e.args[0])
+        r = [None]*len(positions)
+        for k, i in zip(order, starts):
+            r[k] = i+positions[k][1]
+        return r
+
+    def indices_to_positions(self, indices):
+        """Returns the (row, col)-tuples corresponding to a sequence
+           of indices. Like index2position, but done in one pass
+           through the tree.
+        """
+        indices = list(indices)
+        order = sorted(range(len(indices)), key=indices.__getitem__)
+        l = [indices[k] for k in order]
+        if l and (l[0] < 0 or l[-1] > length(self.texel)):
+            raise IndexError(l[0] if l[0] < 0 else l[-1])
+        rows = get_weights(self.texel, 2, l)
+        starts = find_weights(self.texel, rows, 2)
+        r = [None]*len(indices)
+        for k, row, i in zip(order, rows, starts):
+            r[k] = row, indices[k]-i
+        return r
+
     def linestart(self, row):
         """Returns the index where line number *row* starts."""
         try:
@@ -194,13 +318,39 @@ class TextModel(Model):
         """Sets the text properties between *i1* and *i2*."""
         if not (-1 <= i1 <= i2 <= len(self)):
             raise IndexError((i1, i2))
-        memo = get_styles(self.texel, i1, i2)
+        memo = []
         self.texel = grouped(
-            set_properties(self.texel, i1, i2, properties))
+            set_properties(self.texel, i1, i2, properties, memo))
         #assert check(self.texel)
         self.notify_views('properties_changed', i1, i2)
         return memo
 
+    def apply_style_runs(self, i0, runs):
+        """Sets text properties for several spans at once.
+
+           *Runs* is a sorted sequence of non overlapping tuples (i1,
+           i2, properties) with indices relative to *i0*. The texel
+           tree is rewritten in a single pass and views are notified
+           only once. Returns the original styles from *i0* on, as
+           needed by set_styles.
+        """
+        runs = list(runs)
+        if not runs:
+            return []
+        j = runs[0][0]
+        for i1, i2, properties in runs:
+            if i1 < j or i2 < i1:
+                raise ValueError("runs must be sorted and must not overlap")
+            j = i2
+        if not (0 <= i0+runs[0][0] and i0+j <= len(self)):
+            raise IndexError((i0+runs[0][0], i0+j))
+        if all([i1 == i2 for i1, i2, properties in runs]):
+            return [] # nothing to do
+        memo = []
+        self.texel = grouped(apply_runs(self.texel, i0, runs, memo))
+        self.notify_views('properties_changed', i0+runs[0][0], i0+j)
+        return memo
+
     def set_styles(self, i, styles):
         """Sets the styling of a span of text. Usually used by undo."""
         if not (0 <= i <= len(self)):
@@ -219,7 +369,7 @@ class TextModel(Model):
             raise IndexError((i1, i2))
         memo = get_parstyles(self.texel, i1, i2)
         self.texel = grouped(
-            set_parproperties(self.texel, i1, i2, properties))
+            set_parproperties(self.texel, i1, i2, properties, memo))
         #assert check(self.texel)
         self.notify_views('properties_changed', i1, i2)
         return memo
@@ -266,14 +416,98 @@ class TextModel(Model):
         textmodel = self.create_textmodel(text, **properties)
         self.insert(i, textmodel)
 
+    def apply_edits(self, edits):
+        """Replaces several ranges in one step.
+
+           *Edits* is a sequence of tuples (i1, i2, textmodel), sorted
+           by index and not overlapping. The content between *i1* and
+           *i2* is replaced by *textmodel*, which can be None for
+           plain removals. All indices refer to the model before the
+           change. The tree is rebuilt once and views receive a single
+           "replaced" signal (arguments: i, n1, n2) covering all
+           edits.
+
+           Returns a list of edits which reverts the change.
+        """
+        edits = list(edits)
+        if not edits:
+            return []
+        if edits[0][0] < 0 or edits[-1][1] > len(self):
+            raise IndexError((edits[0][0], edits[-1][1]))
+        j = 0
+        for i1, i2, textmodel in edits:
+            if i1 < j or i2 < i1:
+                raise ValueError("edits must be sorted and must not overlap")
+            j = i2
+        texel = self.texel
+        stuff = []
+        undo = []
+        delta = 0
+        for i1, i2, textmodel in edits:
+            l = []
+            n = 0
+            if textmodel is not None:
+                l = [x for x in strip2list(textmodel.texel) if length(x)]
+                n = len(textmodel)
+            removed = None
+            if i1 < i2:
+                removed = self.create_textmodel()
+                removed.texel = grouped(copy(texel, i1, i2))
+            undo.append((i1+delta, i1+delta+n, removed))
+            stuff.append((i1, i2, l))
+            delta += n-(i2-i1)
+        self.texel = grouped(splice(texel, stuff))
+        i = edits[0][0]
+        n1 = edits[-1][1]-i
+        self.notify_views('replaced', i, n1, n1+delta)
+        return undo
+
+    def search(self, pattern, i1=0, i2=None, flags=0):
+        """Iterates lazily through the matches of the regular
+           expression *pattern* between *i1* and *i2*.
+
+           Yields tuples (j1, j2, match). The text is scanned in
+           chunks and never materialized as a whole.
+        """
+        if i2 is None:
+            i2 = len(self)
+        if not (0 <= i1 <= i2 <= len(self)):
+            raise IndexError((i1, i2))
+        return finditer(self.texel, pattern, i1, i2, flags)
+
+    def get_replacements(self, pattern, repl, i1=0, i2=None, flags=0):
+        """Returns the edits which replace all matches of *pattern* by
+           *repl*, as needed by apply_edits.
+
+           *Repl* is a template string or a function, as in re.sub.
+           Replacements take the style of the replaced text.
+        """
+        edits = []
+        for j1, j2, match in self.search(pattern, i1, i2, flags):
+            if callable(repl):
+                text = repl(match)
+            else:
+                text = match.expand(repl)
+            if j1 == j2 and not text:
+                continue
+            style = self.get_style(j1)
+            edits.append((j1, j2, self.create_textmodel(text, **style)))
+        return edits
+
+    def replace_all(self, pattern, repl, i1=0, i2=None, flags=0):
+        """Replaces all matches of *pattern* by *repl* in one step.
+
+           Returns a list of edits which reverts the change.
+        """
+        return self.apply_edits(
+            self.get_replacements(pattern, repl, i1, i2, flags))
+
     def copy(self, i1, i2):
         """Returns a copy of all data between *i1* and *i2*."""
-        row1, col1 = self.index2position(i1)
-        row2, col2 = self.index2position(i2)
-
-        rest, removed = takeout(self.texel, i1, i2)
+        if not (0 <= i1 <= i2 <= len(self)):
+            raise IndexError((i1, i2))
         model = self.create_textmodel()
-        model.texel = grouped(removed)
+        model.texel = grouped(copy(self.texel, i1, i2))
         return model
 
     def __add__(self, other):
@@ -319,6 +553,55 @@ class TextModel(Model):
 
 
 
+class Snapshot(object):
+    """A read-only view of a TextModel.
+
+       The snapshot is pinned to the texel tree of the model at the
+       time of its creation. Since texel trees never change, it can be
+       read by background workers while the model is edited. The
+       attribute *version* holds the model version of the snapshot,
+       so that workers can detect when their results are stale.
+    """
+    def __init__(self, model):
+        self.texel = model.texel
+        self.ENDMARK = model.ENDMARK
+        self.version = model.version
+        self.model_class = model.__class__
+
+    def create_textmodel(self, text=u'', **properties):
+        return self.model_class(text, **properties)
+
+    def diff(self, other):
+        """Returns the ranges (i1, i2, j1, j2) in which the snapshot and
+           the model or snapshot *other* differ. Used for rebasing
+           results.
+        """
+        return diff(self.texel, other.texel)
+
+    # The query methods are shared with TextModel.
+    _xtexel = None, None
+    __len__ = TextModel.__len__
+    get_xtexel = TextModel.get_xtexel
+    nlines = TextModel.nlines
+    get_text = TextModel.get_text
+    iter_chars = TextModel.iter_chars
+    iter_leaves = TextModel.iter_leaves
+    iter_styles = TextModel.iter_styles
+    get_style = TextModel.get_style
+    get_styles = TextModel.get_styles
+    get_parstyle = TextModel.get_parstyle
+    iter_paragraphs = TextModel.iter_paragraphs
+    position2index = TextModel.position2index
+    index2position = TextModel.index2position
+    positions_to_indices = TextModel.positions_to_indices
+    indices_to_positions = TextModel.indices_to_positions
+    linestart = TextModel.linestart
+    lineend = TextModel.lineend
+    linelength = TextModel.linelength
+    search = TextModel.search
+    copy = TextModel.copy
+    __getitem__ = TextModel.__getitem__
+
 def pycolorize(rawtext, coding='latin-1'): # XXX is latin-1 ok?
     # used for benchmarking
     assert type(rawtext) == bytes
@@ -345,19 +628,26 @@ def pycolorize(rawtext, coding='latin-1'): # XXX is latin-1 ok?
     text = rawtext.decode(coding)    
     model = TextModel(text)
 
+    properties = dict((key, {'textcolor':color}) 
+                      for key, color in _colors.items())
+    tokens = []
+    positions = []
     for t in tokenize.tokenize(instream):
         toktype = t.type
         if token.LPAR <= toktype and toktype <= token.OP:
             toktype = token.OP
         elif toktype == token.NAME and keyword.iskeyword(t.string):
             toktype = _KEYWORD
-        color = _colors.get(toktype)            
-        if color is not None:
+        if toktype in properties:
             srow, scol = t.start
             erow, ecol = t.end
-            i1 = model.position2index(srow-1, scol)
-            i2 = model.position2index(erow-1, ecol)
-            model.set_properties(i1, i2, textcolor=color)            
+            tokens.append(toktype)
+            positions.append((srow-1, scol))
+            positions.append((erow-1, ecol))
+    indices = model.positions_to_indices(positions)
+    runs = [(indices[2*k], indices[2*k+1], properties[toktype])
+            for k, toktype in enumerate(tokens)]
+    model.apply_style_runs(0, runs)
 
     return model.copy(0, len(model)-1)
 
@@ -631,6 +921,110 @@ def heavy_test():
     pycolorize(rawtext)
 
 
+def _mk_document(size):
+    # Creates a synthetic text of about *size* characters. Used for
+    # benchmarking.
+    from random import Random
+    random = Random(0)
+    words = ['for', 'a', 'in', 'range(10):', 'print(a)', 'x', '=', 
+             '1234567', 'lorem', 'ipsum', 'dolor', 'sit', 'amet', '#']
+    lines = []
+    n = 0
+    while n < size:
+        line = ' '.join(random.choice(words) for i in 
+                        range(random.randrange(1, 15)))
+        if random.random() < 0.2:
+            line = '\t'+line
+        lines.append(line)
+        n += len(line)+1
+    return '\n'.join(lines)
+
+
+def benchmark_00():
+    "memory and throughput for a 10 MB document"
+    import tracemalloc
+    import time
+    text = _mk_document(10*1024*1024)
+    n = len(text)
+
+    tracemalloc.start()
+    t0 = time.time()
+    model = TextModel(text)
+    t1 = time.time()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("characters:          %i" % n)
+    print("construction:        %.2f s" % (t1-t0))
+    print("bytes per character: %.2f (peak %.2f)" % (
+        float(current)/n, float(peak)/n))
+
+    from random import Random
+    random = Random(1)
+    t0 = time.time()
+    for k in range(1000):
+        i = random.randrange(len(model))
+        model.insert_text(i, 'x')
+        model.remove(i, i+1)
+    t1 = time.time()
+    print("insert/remove:       %.3f ms per edit" % ((t1-t0)*1000/1000.0))
+    assert len(model) == n
+
+
+def benchmark_01():
+    "edit costs in long lines"
+    import time
+    from random import Random
+    random = Random(0)
+    for n in (10**3, 10**4, 10**5, 10**6, 5*10**6):
+        model = TextModel('x'*n)
+        t0 = time.time()
+        for k in range(200):
+            i = random.randrange(n)
+            model.insert_text(i, 'y')
+            model.set_properties(i, i+1, bold=True)
+            model.remove(i, i+1)
+        t1 = time.time()
+        print("line length %8i: %.3f ms per edit" % (n, (t1-t0)*1000/200.0))
+
+
+def benchmark_02():
+    "index lookups and edits for different values of nmax"
+    import time
+    from random import Random
+    from . import texeltree
+    old = texeltree.nmax
+    text = _mk_document(2*10**6)
+    try:
+        for n in (8, 16, 32, 64, 128):
+            texeltree.set_nmax(n)
+            model = TextModel(text)
+            random = Random(0)
+            size = len(model)
+            rows = model.index2position(size)[0]
+            indices = [random.randrange(size) for k in range(5000)]
+            positions = [(random.randrange(rows), 0) for k in range(5000)]
+            t0 = time.time()
+            for i in indices:
+                model.index2position(i)
+            t1 = time.time()
+            for row, col in positions:
+                model.position2index(row, col)
+            t2 = time.time()
+            for i in indices:
+                model.get_style(i)
+            t3 = time.time()
+            for i in indices[:1000]:
+                model.insert_text(i, 'y')
+                model.remove(i, i+1)
+            t4 = time.time()
+            print(("nmax=%3i: index2position %.1f us, position2index %.1f us, "
+                   "get_style %.1f us, insert+remove %.1f us") % \
+                (n, (t1-t0)*1e6/5000, (t2-t1)*1e6/5000, (t3-t2)*1e6/5000,
+                 (t4-t3)*1e6/1000))
+    finally:
+        texeltree.set_nmax(old)
+
+
 def test_14():
     "random insert/remove"
     class TestModel(TextModel):
@@ -737,4 +1131,391 @@ def test_19():
     model.set_parproperties(0, len(model), textcolor='red')
     assert model.get_parstyle(1) == {'textcolor':'red'}
 
-__all__ = ['TextModel']
+def test_20():
+    "iter_chars"
+    model = TextModel(text1+'\n'+text2)
+    model.set_properties(3, 7, bold=True)
+    text = model.get_text()
+    assert ''.join(c for i, c in model.iter_chars(5)) == text[5:]
+    assert ''.join(c for i, c in model.iter_chars(5, True)) == text[:5][::-1]
+    runs = list(model.iter_styles())
+    assert [(i1, i2) for i1, i2, style in runs][:2] == [(0, 3), (3, 7)]
+    assert runs[1][2] == {'bold':True}
+    assert runs[-1][1] == len(model)
+
+__all__ = ['TextModel', 'Snapshot']
+
+
+def benchmark_03():
+    "toggling bold over a whole document"
+    import time
+    model = TextModel(_mk_document(2*10**6))
+    n = len(model)
+    for bold in (True, True, False):
+        t0 = time.time()
+        memo = model.set_properties(0, n, bold=bold)
+        t1 = time.time()
+        print("bold=%-5s %.2f s (%i runs in memo)" % (bold, t1-t0, len(memo)))
+
+
+def test_21():
+    "apply_style_runs"
+    text = text3*10
+    runs = [(1, 4, {'bold':True}), (4, 6, {'textcolor':'red'}), 
+            (6, 6, {'bold':True}), (10, 50, {'bold':True}), 
+            (70, 75, {'fontsize':5})]
+    for i0 in (0, 3):
+        m1 = TextModel(text)
+        m1.set_properties(20, 30, italic=True)
+        m2 = TextModel(text)
+        m2.set_properties(20, 30, italic=True)
+        old = list(m2.iter_styles())
+        for i1, i2, properties in runs:
+            m1.set_properties(i0+i1, i0+i2, **properties)
+        memo = m2.apply_style_runs(i0, iter(runs))
+        assert style_length(memo) == 75
+        assert list(m2.iter_styles()) == list(m1.iter_styles())
+        assert is_root_efficient(m2.texel)
+        m2.set_styles(i0, memo)
+        assert list(m2.iter_styles()) == old
+    try:
+        m2.apply_style_runs(0, [(5, 10, {}), (8, 12, {})])
+    except ValueError:
+        pass
+    else:
+        assert False
+
+    # empty runs change nothing
+    class Recorder:
+        signals = 0
+        def properties_changed(self, model, i1, i2):
+            self.signals += 1
+    recorder = Recorder()
+    m2.add_view(recorder)
+    texel = m2.texel
+    assert m2.apply_style_runs(0, [(2, 2, {'bold':True}), 
+                                   (5, 5, {'bold':True})]) == []
+    assert m2.texel is texel
+    assert recorder.signals == 0
+    m2.apply_style_runs(0, [(2, 3, {'bold':True})])
+    assert recorder.signals == 1
+
+
+def benchmark_04():
+    "pycolorize"
+    import time
+    from . import texeltree
+    filename = texeltree.__file__
+    rawtext = open(filename, 'rb').read()
+    t0 = time.time()
+    pycolorize(rawtext)
+    t1 = time.time()
+    print("%i bytes colorized in %.2f s" % (len(rawtext), t1-t0))
+
+
+def test_22():
+    "iter_paragraphs, get_parstyle"
+    model = TextModel(text3*20)
+    model.set_parproperties(3, 9, bullet=True)
+    model.set_parproperties(30, 31, base='h1')
+    texel = model.get_xtexel()
+    assert model.get_xtexel() is texel
+    n = len(model)
+    l = list(model.iter_paragraphs())
+    assert l[0][0] == 0 and l[-1][1] == n
+    assert len(l) == model.nlines()
+    for (i1, i2, parstyle), (j1, j2, p) in zip(l, l[1:]):
+        assert i2 == j1
+    for i in range(n+1):
+        row, col = model.index2position(i)
+        j = model.lineend(row)
+        assert model.get_parstyle(i) is _get_texel(texel, j).parstyle
+        start, end, parstyle = next(model.iter_paragraphs(i, i))
+        assert start <= i and (i < end or end == n)
+        assert parstyle is model.get_parstyle(i)
+        assert list(model.iter_paragraphs(i, n)) == \
+            [x for x in l if x[1] > i or x is l[-1]]
+    assert model.get_parstyle(5) == {'bullet':True}
+    model.insert_text(0, 'x')
+    assert model.get_xtexel() is not texel
+
+
+def benchmark_05():
+    "get_parstyle"
+    import time
+    model = TextModel(_mk_document(10**6))
+    n = len(model)
+    t0 = time.time()
+    for i in range(0, n, 100):
+        model.get_parstyle(i)
+    t1 = time.time()
+    l = list(model.iter_paragraphs())
+    t2 = time.time()
+    print("%i calls to get_parstyle: %.2f s" % (n // 100, t1-t0))
+    print("iterating %i paragraphs: %.2f s" % (len(l), t2-t1))
+
+
+def test_23():
+    "apply_edits"
+    class Recorder:
+        def __init__(self):
+            self.signals = []
+        def model_changed(self, model):
+            self.signals.append('model_changed')
+        def replaced(self, model, i, n1, n2):
+            self.signals.append(('replaced', i, n1, n2))
+
+    text = text3*10
+    model = TextModel(text)
+    model.set_properties(5, 12, bold=True)
+    styles = list(model.iter_styles())
+    recorder = Recorder()
+    model.add_view(recorder)
+    x = TextModel('xx')
+    edits = [(0, 0, x), (3, 5, None), (5, 5, x), (7, 20, TextModel('y\n')), 
+             (len(text), len(text), x)]
+    undo = model.apply_edits(iter(edits))
+    expected = 'xx'+text[:3]+'xx'+text[5:7]+'y\n'+text[20:]+'xx'
+    assert model.get_text() == expected
+    assert recorder.signals == [('replaced', 0, len(text), len(expected))]
+    assert is_root_efficient(model.texel)
+    model.apply_edits(undo)
+    assert model.get_text() == text
+    assert list(model.iter_styles()) == styles
+
+    # indenting many lines
+    model = TextModel(text*100)
+    spaces = TextModel('    ')
+    edits = [(i, i, spaces) for i, j, s in model.iter_paragraphs()]
+    undo = model.apply_edits(edits)
+    assert model.get_text() == ''.join(
+        '    '+line for line in (text*100).splitlines(True))+'    '
+    model.apply_edits(undo)
+    assert model.get_text() == text*100
+
+    for edits in ([(5, 3, None)], [(1, 5, None), (4, 6, None)]):
+        try:
+            model.apply_edits(edits)
+            assert False
+        except ValueError:
+            pass
+    try:
+        model.apply_edits([(0, len(model)+1, None)])
+        assert False
+    except IndexError:
+        pass
+
+
+def test_24():
+    "snapshot, version"
+    model = TextModel(text3)
+    model.set_properties(1, 4, bold=True)
+    v = model.version
+    assert model.version == v
+    snapshot = model.snapshot()
+    assert snapshot.version == v
+    model.insert_text(0, 'xyz\n')
+    model.set_parproperties(0, 1, bullet=True)
+    assert model.version > v
+    assert snapshot.get_text() == text3
+    assert len(snapshot) == len(text3)
+    assert snapshot.nlines() == TextModel(text3).nlines()
+    assert snapshot.index2position(4) == (1, 1)
+    assert snapshot.position2index(1, 1) == 4
+    assert snapshot.get_styles(0, 5) == \
+        [(1, {}), (3, {'bold':True}), (1, {})]
+    assert snapshot.get_parstyle(0) == {}
+    assert list(snapshot.iter_paragraphs(0, 3))[0] == (0, 3, {})
+    part = snapshot[1:4]
+    assert isinstance(part, TextModel)
+    assert part.get_text() == text3[1:4]
+    assert snapshot.diff(model) == [(0, 0, 0, 4)]
+    assert not hasattr(snapshot, 'insert')
+    state = model.__getstate__()
+    assert '_version' not in state and '_versioned' not in state
+
+
+def test_25():
+    "search, replace_all"
+    model = TextModel(text3*1000)
+    model.set_properties(3, 5, bold=True)
+    text = model.get_text()
+    found = [(j1, j2) for j1, j2, m in model.search(r'\d+\n\d')]
+    assert found == [(m.start(), m.end()) for m in 
+                     re.finditer(r'\d+\n\d', text)]
+    assert next(model.search('45', 100))[:2] == (text.index('45', 100), 
+                                                 text.index('45', 100)+2)
+    found = [(j1, j2) for j1, j2, m in model.search('89', 0, 29)]
+    assert found == [(8, 10)]
+    styles = model.get_styles(0, len(model))
+    undo = model.replace_all(r'(\d)(\d)', r'\2\1')
+    assert model.get_text() == re.sub(r'(\d)(\d)', r'\2\1', text)
+    assert model.get_style(3) == {'bold':True}
+    model.apply_edits(undo)
+    assert model.get_text() == text
+    assert model.get_styles(0, len(model)) == styles
+    model.replace_all('5', lambda m:'five', 0, 30)
+    assert model.get_text() == re.sub('5', 'five', text[:30])+text[30:]
+
+
+def test_26():
+    "positions_to_indices, indices_to_positions"
+    from random import Random
+    random = Random(0)
+    for text in (text3, text3*100, "", "\n\n", "abc"):
+        model = TextModel(text)
+        indices = list(range(len(model)+1))
+        random.shuffle(indices)
+        positions = model.indices_to_positions(indices)
+        assert positions == [model.index2position(i) for i in indices]
+        assert model.positions_to_indices(positions) == indices
+    model = TextModel(text3)
+    assert model.positions_to_indices([(4, 2), (0, 0), (4, 2)]) == [16, 0, 16]
+    assert model.indices_to_positions([]) == []
+    try:
+        model.positions_to_indices([(0, 0), (6, 0)])
+        assert False
+    except IndexError:
+        pass
+    try:
+        model.indices_to_positions([len(model)+1])
+        assert False
+    except IndexError:
+        pass
+
+
+def benchmark_06():
+    "batch coordinate conversion"
+    import time
+    from random import Random
+    random = Random(0)
+    model = TextModel(_mk_document(10**6))
+    size = len(model)
+    indices = [random.randrange(size) for k in range(10**5)]
+    t0 = time.time()
+    positions = [model.index2position(i) for i in indices]
+    t1 = time.time()
+    l = [model.position2index(row, col) for row, col in positions]
+    t2 = time.time()
+    assert model.indices_to_positions(indices) == positions
+    t3 = time.time()
+    assert model.positions_to_indices(positions) == l
+    t4 = time.time()
+    print("index2position:       %.2f s" % (t1-t0))
+    print("position2index:       %.2f s" % (t2-t1))
+    print("indices_to_positions: %.2f s" % (t3-t2))
+    print("positions_to_indices: %.2f s" % (t4-t3))
+
+
+def benchmark_07():
+    "memory and speed of the text cache"
+    import time
+    import tracemalloc
+    from . import texeltree
+    old = texeltree.textcache_min, texeltree.textcache_max, \
+        texeltree.textcache_total
+    try:
+        for total in (0, 10**9, old[2]):
+            texeltree.set_textcache(old[0], old[1], total)
+            for n in (10**5, 10**6, 4*10**6):
+                model = TextModel(_mk_document(n))
+                size = texeltree._textcache_size
+                tracemalloc.start()
+                t0 = time.time()
+                model.get_text()
+                t1 = time.time()
+                current, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                cached = texeltree._textcache_size-size
+                model.insert_text(n//2, 'x')
+                t2 = time.time()
+                model.get_text()
+                t3 = time.time()
+                print("total=%10i, %7i chars, depth %i: first %6.1f ms, "
+                      "after edit %6.2f ms, cached %.2f chars/char, "
+                      "%.2f bytes/char" % (
+                          total, n, depth(model.texel), (t1-t0)*1000,
+                          (t3-t2)*1000, float(cached)/n, float(current)/n))
+                del model
+    finally:
+        texeltree.set_textcache(*old)
+
+
+def test_27():
+    "deferred notification"
+    from random import Random
+    random = Random(0)
+    class Recorder:
+        def __init__(self):
+            self.signals = []
+        def changed(self, model, ranges):
+            self.signals.append(('changed', ranges))
+        def inserted(self, model, i, n):
+            self.signals.append(('inserted', i, n))
+
+    class Plain:
+        signals = 0
+        def model_changed(self, model):
+            self.signals += 1
+
+    model = TextModel(text3*10)
+    recorder = Recorder()
+    plain = Plain()
+    model.add_view(recorder)
+    model.add_view(plain)
+    for k in range(100):
+        old = model.get_text()
+        recorder.signals = []
+        plain.signals = 0
+        with model.changes():
+            for l in range(random.randrange(1, 10)):
+                n = len(model)
+                i1 = random.randrange(n+1)
+                i2 = random.randrange(i1, min(n, i1+5)+1)
+                r = random.random()
+                if r < 0.3:
+                    model.insert_text(i1, 'x'*random.randrange(1, 4))
+                elif r < 0.6:
+                    model.remove(i1, i2)
+                elif r < 0.8:
+                    model.set_properties(i1, i2, bold=True)
+                else:
+                    with model.changes(): # nested
+                        model.apply_edits([(i1, i2, TextModel('yy'))])
+                assert plain.signals == l+1
+        new = model.get_text()
+        if old == new and not recorder.signals:
+            continue
+        assert len(recorder.signals) == 1
+        name, ranges = recorder.signals[0]
+        # rebuild the new text from the old text and the ranges
+        text = u''
+        j = 0
+        for i1, i2, n in ranges:
+            assert j == 0 or i1 > j # not overlapping, not adjacent
+            text += old[j:i1]
+            text += new[len(text):len(text)+n]
+            j = i2
+        text += old[j:]
+        assert text == new
+
+    recorder.signals = []
+    model.insert_text(0, 'abc')
+    assert recorder.signals == [('inserted', 0, 3)]
+    recorder.signals = []
+    with model.changes():
+        pass
+    assert recorder.signals == []
+
+
+def test_28():
+    "interning"
+    from .texeltree import Interner, content_hash
+    text = u'x = 1\nprint(x)\n\tdone\n'*3000
+    interner = Interner()
+    model = TextModel(text, interner=interner, bold=True)
+    assert model.get_text() == text
+    assert model.get_style(0)['bold']
+    assert content_hash(model.texel) == content_hash(TextModel(
+        text, bold=True).texel)
+    assert interner.shared > 0 and interner.saved > 0
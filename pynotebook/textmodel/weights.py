@@ -1,7 +1,9 @@
 # -*- coding: latin-1 -*-
 
 
-from .texeltree import length, provides_childs, iter_childs, Texel
+from .texeltree import length, provides_childs, iter_childs, get_sums, \
+    Texel
+from bisect import bisect_left, bisect_right
 
 
 debug = 0
@@ -15,6 +17,10 @@ class NotFound(Exception):
 # work with certain weight functions. They will work for weights
 # aggregated by 'sum', such as lengths and line numbers. But trying to
 # find depth values will lead to unexpected and unpredicted behaviour.
+#
+# Texels which aggregate a channel differently (e.g. cells, which
+# count as one in the cells channel) are treated as atoms: their
+# weight is reached at their end.
 
 def find_weight(texel, w, windex):
     """Returns position *i* at which weight *windex* switches to value *w*."""
@@ -22,12 +28,15 @@ def find_weight(texel, w, windex):
     if w == 0:
         return 0
     if provides_childs(texel):
-        sum_w = 0
-        for i1, i2, child in iter_childs(texel):
-            delta = child.weights[windex]
-            if sum_w+delta >= w:
-                return find_weight(child, w-sum_w, windex)+i1
-            sum_w += delta
+        # the first child k for which the weight sum reaches w
+        cum = get_sums(texel, windex)
+        n = len(texel.childs)
+        k = n
+        if cum is not None:
+            k = bisect_left(cum, w, 1, n+1)-1
+        if k < n:
+            i1 = get_sums(texel)[k]
+            return find_weight(texel.childs[k], w-cum[k], windex)+i1
     if w == texel.weights[windex]:
         return length(texel)
     raise NotFound(w)
@@ -59,16 +68,89 @@ def get_weight(texel, windex, i):
         return w
 
     if provides_childs(texel):
-        for i1, i2, child in iter_childs(texel):
-            if i2 <= i:
-                w += child.weights[windex]
-            elif i1 <= i <= i2:
-                w += get_weight(child, windex, i-i1)
-            else:
-                break
+        cum = get_sums(texel, windex)
+        if cum is None:
+            return w
+        offsets = get_sums(texel)
+        k = bisect_right(offsets, i, 0, len(texel.childs))-1
+        w = cum[k]+get_weight(texel.childs[k], windex, i-offsets[k])
     return w
 
 
+def find_weights(texel, ws, windex):
+    """Like find_weight, but for a sorted sequence of weights *ws*.
+
+       The tree is descended only once. Returns a list of positions.
+    """
+    r = []
+    _find_weights(texel, ws, 0, len(ws), windex, 0, 0, r)
+    return r
+
+
+def _find_weights(texel, ws, k1, k2, windex, w0, i0, r):
+    # Appends the positions for ws[k1:k2]. The weight at the
+    # beginning of *texel* is *w0*, its index is *i0*.
+    while k1 < k2 and ws[k1] == w0:
+        r.append(i0)
+        k1 += 1
+    if provides_childs(texel):
+        cum = get_sums(texel, windex)
+        if cum is not None:
+            offsets = get_sums(texel)
+            for k, child in enumerate(texel.childs):
+                if k1 == k2:
+                    return
+                l = bisect_right(ws, w0+cum[k+1], k1, k2)
+                if l > k1:
+                    _find_weights(child, ws, k1, l, windex, w0+cum[k],
+                                  i0+offsets[k], r)
+                    k1 = l
+    w = w0+texel.weights[windex]
+    n = i0+length(texel)
+    for k in range(k1, k2):
+        if ws[k] != w:
+            raise NotFound(ws[k])
+        r.append(n)
+
+
+def get_weights(texel, windex, indices):
+    """Like get_weight, but for a sorted sequence of *indices*.
+
+       The tree is descended only once. Returns a list of weights.
+    """
+    if len(indices) and indices[0] < 0:
+        raise IndexError(indices[0])
+    r = []
+    _get_weights(texel, windex, indices, 0, len(indices), 0, 0, r)
+    return r
+
+
+def _get_weights(texel, windex, indices, k1, k2, i0, w0, r):
+    # Appends the weights for indices[k1:k2]. The weight at the
+    # beginning of *texel* is *w0*, its index is *i0*.
+    while k1 < k2 and indices[k1] <= i0:
+        r.append(w0)
+        k1 += 1
+    n = length(texel)
+    k3 = bisect_left(indices, i0+n, k1, k2)
+    cum = None
+    if provides_childs(texel):
+        cum = get_sums(texel, windex)
+    if cum is None:
+        r.extend([w0]*(k3-k1))
+    else:
+        offsets = get_sums(texel)
+        for k, child in enumerate(texel.childs):
+            if k1 == k3:
+                break
+            l = bisect_left(indices, i0+offsets[k+1], k1, k3)
+            if l > k1:
+                _get_weights(child, windex, indices, k1, l, i0+offsets[k],
+                             w0+cum[k], r)
+                k1 = l
+    r.extend([w0+texel.weights[windex]]*(k2-k3))
+
+
 if debug: # enable contract checking
      import contract
      contract.checkmod(__name__)
@@ -8,6 +8,17 @@ from ..textmodel.styles import EMPTYSTYLE
 from .testdevice import TESTDEVICE
 from .boxes import TextBox, NewlineBox, TabulatorBox, EmptyTextBox, \
     EndBox, check_box, Box, calc_length
+from .lrucache import LRUCache
+
+
+def _estimate_size(boxes):
+    # Rough estimate of the memory used by a list of text boxes
+    return sum([200+len(box.text) for box in boxes])
+
+# Cache for text boxes, shared by the builders of all views. The keys
+# must contain everything the boxes depend on. Note that style ids are
+# never reused.
+text_cache = LRUCache(20000, sizeof=_estimate_size)
 
 
 
@@ -79,20 +90,17 @@ class Factory:
         return [self.TextBox(texel.text[i1:i2], self.mk_style(texel.style), 
                              self.device)]
 
-    _cache = dict()
-    _cache_keys = []
+    _cache = text_cache
     def Text_handler(self, texel, i1, i2):
         # cached version
-        key = texel.text, id(texel.style), id(self.parstyle), i1, i2, self.device
+        key = self.TextBox, texel.text, texel.style.id, self.parstyle.id, \
+            i1, i2, self.device
         try:
             return self._cache[key]
-        except: pass        
+        except KeyError: 
+            pass
         r = [self.TextBox(texel.text[i1:i2], self.mk_style(texel.style), 
                           self.device)]
-        self._cache_keys.insert(0, key)        
-        if len(self._cache_keys) > 10000:
-            _key = self._cache_keys.pop()
-            del self._cache[_key]
         self._cache[key] = r
         return r
 
@@ -122,6 +130,7 @@ class BuilderBase:
     """
 
     _layout = None
+    partial_updates = False # True if replaced() does not rebuild
 
     def rebuild(self):
         # sets self._layout
@@ -141,6 +150,12 @@ class BuilderBase:
     def removed(self, i, n):
         pass
 
+    def replaced(self, i, n1, n2):
+        # *n1* characters at index *i* have been replaced by *n2*
+        # characters. Builders which can update partially should
+        # override this.
+        self.rebuild()
+
 
 
 def test_01():
@@ -153,3 +168,26 @@ def test_01():
     
 
 
+
+
+def benchmark_00():
+    "text box cache"
+    import time
+    from ..textmodel.textmodel import _mk_document
+    model = TextModel(_mk_document(10**6))
+    factory = Factory()
+    old = text_cache.maxsize
+    try:
+        for maxsize in (1000, 20000, 10**6):
+            text_cache.clear()
+            text_cache.reset_stats()
+            text_cache.set_limits(maxsize)
+            t0 = time.time()
+            factory.create_all(model.texel)
+            t1 = time.time()
+            factory.create_all(model.texel)
+            t2 = time.time()
+            print("maxsize=%7i: first %.2f s, second %.2f s, %s" % (
+                maxsize, t1-t0, t2-t1, text_cache.stats()))
+    finally:
+        text_cache.set_limits(old)
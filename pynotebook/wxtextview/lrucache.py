@@ -0,0 +1,146 @@
+# -*- coding: latin-1 -*-
+
+# A least recently used cache with statistics. Used by the builders
+# to cache boxes.
+
+
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Mapping which discards the least recently used entries.
+
+    The cache is limited to *maxsize* entries and, if *maxbytes* is
+    given, to *maxbytes* bytes as estimated by the function
+    *sizeof*. Either limit can be None. All operations are O(1).
+
+    The counters hits, misses and evictions can be used to tune the
+    limits, see stats().
+    """
+    def __init__(self, maxsize=10000, maxbytes=None, sizeof=None):
+        if maxbytes is not None and sizeof is None:
+            raise ValueError("maxbytes needs a sizeof function")
+        self._data = OrderedDict() # key -> (value, size)
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.nbytes = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        # Note that this neither counts nor touches the entry.
+        return key in self._data
+
+    def __getitem__(self, key):
+        try:
+            value, size = self._data[key]
+        except KeyError:
+            self.misses += 1
+            raise
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        data = self._data
+        if key in data:
+            self.nbytes -= data.pop(key)[1]
+        size = 0
+        if self.sizeof is not None:
+            size = self.sizeof(value)
+        data[key] = value, size
+        self.nbytes += size
+        self._shrink()
+
+    def __delitem__(self, key):
+        value, size = self._data.pop(key)
+        self.nbytes -= size
+
+    def set_limits(self, maxsize=None, maxbytes=None):
+        if maxbytes is not None and self.sizeof is None:
+            raise ValueError("maxbytes needs a sizeof function")
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self._shrink()
+
+    def _shrink(self):
+        data = self._data
+        maxsize = self.maxsize
+        maxbytes = self.maxbytes
+        while data and ((maxsize is not None and len(data) > maxsize) or \
+                        (maxbytes is not None and self.nbytes > maxbytes)):
+            key, (value, size) = data.popitem(last=False)
+            self.nbytes -= size
+            self.evictions += 1
+
+    def clear(self):
+        self._data.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        """Returns a dict with the cache statistics."""
+        n = self.hits+self.misses
+        return dict(
+            hits=self.hits, misses=self.misses, evictions=self.evictions,
+            entries=len(self._data), nbytes=self.nbytes,
+            hitrate=float(self.hits)/n if n else 0.0)
+
+
+
+def test_00():
+    "lru"
+    cache = LRUCache(3)
+    for i in range(3):
+        cache[i] = str(i)
+    assert cache[0] == '0' # 0 is now the most recent entry
+    cache[3] = '3'
+    assert 1 not in cache
+    assert sorted(cache._data) == [0, 2, 3]
+    try:
+        cache[1]
+        assert False
+    except KeyError:
+        pass
+    assert cache.get(1) is None
+    cache[2] = 'two' # replacing counts as use
+    cache[4] = '4'
+    assert sorted(cache._data) == [2, 3, 4]
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['evictions']) == (1, 2, 2)
+    del cache[3]
+    assert len(cache) == 2
+    cache.set_limits(1)
+    assert list(cache._data) == [4]
+
+
+def test_01():
+    "maxbytes"
+    cache = LRUCache(None, maxbytes=10, sizeof=len)
+    cache['a'] = 'xxxx'
+    cache['b'] = 'xxxx'
+    assert cache.nbytes == 8
+    cache['c'] = 'xxxx'
+    assert 'a' not in cache
+    assert cache.nbytes == 8
+    cache['d'] = 'x'*20 # too large for the cache
+    assert len(cache) == 0 and cache.nbytes == 0
+    assert cache.evictions == 4
+    try:
+        LRUCache(10, maxbytes=10)
+        assert False
+    except ValueError:
+        pass
@@ -40,7 +40,14 @@
 #  - create_mark / remove_mark ndert die Hierarchie auf nicht reentrent-
 #    fhige weise
 #
+# Update: the tree is now balanced like a B-tree. All marks have the
+# same depth. Groups with more than nmax childs are split, groups with
+# less than nmin() childs are merged with a neighbour and the root is
+# dropped when it has a single child group. Insertion and removal of
+# marks modify the groups on the path in place.
+#
 
+from bisect import bisect_right
 
 
 class Mark:
@@ -86,30 +93,35 @@ def dump(tree, i0=0, d=0):
 
 
 def all_marks(tree, i0=0):
-    if isinstance(tree, Mark):
-        return [(i0+tree.n, tree)]
     l = []
-    for child in tree.childs:
-        l.extend(all_marks(child, i0))
-        i0 += child.n
+    _get_marks(tree, None, None, i0, l)
     return l
 
 
 def get_marks(tree, i1, i2, i0=0):
+    # Returns the marks between i1 (included) and i2 (excluded) as a
+    # list of tuples (i, mark). Only the subtrees overlapping i1...i2
+    # are visited.
+    l = []
+    _get_marks(tree, i1, i2, i0, l)
+    return l
+
+
+def _get_marks(tree, i1, i2, i0, l):
+    # Helper for get_marks and all_marks. The boundaries are ignored
+    # if None.
     if isinstance(tree, Mark):
         j = tree.n+i0
-        if i1 <= j < i2:
-            return [(j, tree)]
-        else:
-            return []
-    l = []
+        if (i1 is None or i1 <= j) and (i2 is None or j < i2):
+            l.append((j, tree))
+        return
     for child in tree.childs:
-        j1 = i0
+        if i2 is not None and i0 >= i2:
+            break
         j2 = i0+child.n
-        if j1 < i2 and i1 <= j2: # test fo overlap. 
-            l.extend(get_marks(child, i1, i2, i0))
-        i0 += child.n
-    return l
+        if i1 is None or i1 <= j2: # test fo overlap. 
+            _get_marks(child, i1, i2, i0, l)
+        i0 = j2
     
 
 def abspos(node):
@@ -127,13 +139,19 @@ def abspos(node):
 nmax = 15
 
 
+def nmin():
+    # Groups with less childs are merged with a neighbour. Note that
+    # groups() never creates groups with less childs.
+    return (nmax+1)//2
+
+
 def groups(l):
     # Create one or two groups out of l. It is assumed, that len(l) <=
-    # nmax+1.
-    assert len(l) <= nmax+1
+    # 2*nmax.
+    assert len(l) <= 2*nmax
     if len(l) <= nmax:
         return [Group(l)]
-    n = nmax // 2
+    n = len(l) // 2
     return [Group(l[:n]), Group(l[n:])]
 
 
@@ -145,67 +163,152 @@ def grouped(stuff):
     return Group(stuff)
 
 
+def build(marks):
+    # Builds a balanced tree out of a list of marks. The n-values of
+    # the marks must already be set.
+    l = marks
+    while len(l) > nmax:
+        k = -(-len(l) // nmax) # number of groups
+        l = [Group(l[j*len(l)//k:(j+1)*len(l)//k]) for j in range(k)]
+    return Group(l)
+
+
+def _replace(node, new):
+    # Replaces *node* by the list of nodes *new* in its parent. The
+    # n-value of the parent is not changed.
+    p = node.parent
+    childs = p.childs
+    for k, child in enumerate(childs):
+        if child is node:
+            break
+    p.childs = childs[:k]+tuple(new)+childs[k+1:]
+    for child in new:
+        child.parent = p
+
+
 def add_mark(tree, i, m):
-    if isinstance(tree, Group):
-        if not tree.childs:
-            m.n = i
-            return [m]
-        l = []
-        for k, child in enumerate(tree.childs):
-            l.append(child)
-            i -= child.n
-            if i <= 0:
+    # Inserts mark *m* at index *i*. The tree is modified in place:
+    # only the groups on the path to the new mark are updated. Groups
+    # which become too large are split. Returns the new root.
+    node = tree
+    path = []
+    while isinstance(node, Group) and node.childs:
+        path.append(node)
+        childs = node.childs
+        for child in childs:
+            if i <= child.n:
                 break
-        l.pop()
-        l.extend(add_mark(child, i+child.n, m))
-        l.extend(tree.childs[k+1:])
-        return groups(l)
-    elif i >= tree.n:
-        m.n = i-tree.n
-        return [tree, m]
+            i -= child.n
+        else:
+            i += child.n # behind the last child
+        node = child
+    if isinstance(node, Group): # empty tree
+        m.n = i
+        node.childs = (m,)
+        m.parent = node
+        node.n = i
+        return tree
+    group = node.parent
+    childs = group.childs
+    for k, child in enumerate(childs):
+        if child is node:
+            break
+    if i >= node.n:
+        # Either the mark is placed at the same index as *node*, or
+        # behind the last mark of the tree.
+        m.n = i-node.n
+        k += 1
+        for node in path:
+            node.n += m.n
     else:
         m.n = i
-        tree.n -= i        
-        return [m, tree]
-
-
-def remove_mark(tree, mark, i):
-    if tree is mark:
-        if i != mark.n:
-            raise IndexError(i) # Wrong index position
-        mark.parent = None
-        return [], mark.n
-    if not isinstance(tree, Group):
-        return [tree], 0 # this is ok!
-    l = []
-    co = 0 # carry over
+        node.n -= i
+    group.childs = childs[:k]+(m,)+childs[k:]
+    m.parent = group
+    while len(group.childs) > nmax:
+        new = groups(group.childs)
+        if group.parent is None:
+            return Group(new)
+        _replace(group, new)
+        group = group.parent
+    return tree
+
+
+def first_mark(tree):
+    if isinstance(tree, Mark):
+        return tree
     for child in tree.childs:
-        if co:
-            insert(child, 0, co)
-            co = 0
-        n = child.n
-        if i < 0 or n < i:
-            l.append(child)
-        else:
-            l1, co = remove_mark(child, mark, i)
-            l.extend(l1)
-        i -= n
-    g = Group(l)
-    assert co == tree.n-g.n
-    return [g], co
+        m = first_mark(child)
+        if m is not None:
+            return m
+
+
+def next_mark(node):
+    # Returns the mark following *node* or None.
+    while node.parent is not None:
+        p = node.parent
+        childs = p.childs
+        for k, child in enumerate(childs):
+            if child is node:
+                break
+        for child in childs[k+1:]:
+            m = first_mark(child)
+            if m is not None:
+                return m
+        node = p
+
+
+def remove_mark(mark):
+    # Removes *mark* from its tree. The space left of the mark is
+    # passed on to the following mark. Groups which become too small
+    # are merged with a neighbour. Returns the new root.
+    n = mark.n
+    p = mark.parent
+    while p is not None:
+        p.n -= n
+        root = p
+        p = p.parent
+    node = next_mark(mark)
+    while node is not None:
+        node.n += n
+        node = node.parent
+    group = mark.parent
+    group.childs = tuple([c for c in group.childs if c is not mark])
+    mark.parent = None
+    mark.n = None
+    while group.parent is not None and len(group.childs) < nmin():
+        p = group.parent
+        childs = p.childs
+        if len(childs) == 1:
+            group = p
+            continue
+        for k, child in enumerate(childs):
+            if child is group:
+                break
+        k = min(k, len(childs)-2)
+        new = groups(childs[k].childs+childs[k+1].childs)
+        p.childs = childs[:k]+tuple(new)+childs[k+2:]
+        for child in new:
+            child.parent = p
+        group = p
+    while len(root.childs) == 1 and isinstance(root.childs[0], Group):
+        root = root.childs[0]
+        root.parent = None
+    return root
 
 
 def remove(tree, i1, i2):
-    assert i2 >= i1 >= 0
-    tree.n -= max(min(i2, tree.n) - max(i1, 0), 0)
-    if isinstance(tree, Group):
+    assert i2 >= i1
+    n = max(min(i2, tree.n) - max(i1, 0), 0)
+    if n and isinstance(tree, Group):
         for child in tree.childs:
             j = child.n
-            child.n -=  max(min(i2, j) - max(i1, 0), 0)
+            remove(child, i1, i2)
             i1 -= j
             i2 -= j
             if i2 <= 0:
                 break
+    tree.n -= n
                 
 def insert(tree, i, n):
     if 0 <= i <= tree.n:
@@ -226,13 +329,42 @@ class MarkBuffer:
 
     def create_mark(self, i, label=''):
         m = Mark(label)
-        self.tree = grouped(add_mark(self.tree, i, m))
+        self.tree = add_mark(self.tree, i, m)
         return m
 
+    def create_marks(self, positions, label=''):
+        # Creates marks for a sorted sequence of indices and returns
+        # them as list. The tree is rebuilt once, which is much faster
+        # than creating the marks one by one.
+        new = []
+        j = 0
+        for i in positions:
+            if i < j:
+                raise ValueError("positions must be sorted")
+            new.append((i, Mark(label)))
+            j = i
+        l = []
+        k = 0
+        for i, m in self.all_marks(): # merge old and new marks
+            while k < len(new) and new[k][0] < i:
+                l.append(new[k])
+                k += 1
+            l.append((i, m))
+        l.extend(new[k:])
+        j = 0
+        for i, m in l:
+            m.n = i-j
+            j = i
+        self.tree = build([m for i, m in l])
+        return [m for i, m in new]
+
     def remove_mark(self, m):
-        i = m.get()
-        #print "remove ", i
-        self.tree = grouped(remove_mark(self.tree, m, i)[0])
+        self.tree = remove_mark(m)
+
+    def move_mark(self, m, i):
+        # Moves mark *m* to index *i*
+        self.remove_mark(m)
+        self.tree = add_mark(self.tree, i, m)
 
     def insert(self, i, n):
         insert(self.tree, i, n)
@@ -242,6 +374,15 @@ class MarkBuffer:
             raise IndexError((i1, i2))
         remove(self.tree, i1, i2)
 
+    def replace(self, i, n1, n2):
+        # *n1* characters at index *i* have been replaced by *n2*
+        # characters. Marks inside the range keep their position if
+        # possible.
+        if n2 > n1:
+            self.insert(i+n1, n2-n1)
+        elif n2 < n1:
+            self.remove(i+n2, i+n1)
+
     def get_marks(self, i1, i2):
         # get all marks between i1 and i2, where i1 is included and i2
         # excluded
@@ -267,19 +408,16 @@ class LinearBuffer:
         self.marks = []
         
     def create_mark(self, i, label=''):
-        positions = self.positions
-        marks = self.marks
-        k = 0
-        for k, j in enumerate(positions):
-            if j >= i:
-                break
-        positions.insert(k, i)
-        marks.insert(k, Mark(i, label))
+        k = bisect_right(self.positions, i)
+        m = Mark(label, i)
+        self.positions.insert(k, i)
+        self.marks.insert(k, m)
+        return m
 
     def insert(self, i, n): # slightly faster
         positions = self.positions
         for k in range(len(positions)):
-            if positions[k] > k: 
+            if positions[k] >= i: 
                 positions[k] += n
 
     def remove(self, i1, i2):
@@ -458,12 +596,100 @@ def test_04():
             assert b.get_marks(i1, i2) == _m
             
 
-def _benchmark_00(Buffer):
+def test_05():
+    "random operations"
+    global nmax
+    from random import Random
+    random = Random(0)
+    for nmax in (3, 5, 15):
+        b = MarkBuffer()
+        positions = {}
+        for k in range(1000):
+            r = random.random()
+            if r < 0.3 or not positions:
+                i = random.randrange(50)
+                positions[b.create_mark(i)] = i
+            elif r < 0.45:
+                m = random.choice(list(positions))
+                i = random.randrange(50)
+                b.move_mark(m, i)
+                positions[m] = i
+            elif r < 0.55:
+                m = random.choice(list(positions))
+                b.remove_mark(m)
+                assert m.get() is None
+                del positions[m]
+            else:
+                i = random.randrange(60)
+                n1 = random.randrange(6)
+                n2 = random.randrange(6)
+                b.replace(i, n1, n2)
+                for m, j in positions.items():
+                    if j >= i+n1:
+                        positions[m] = j+n2-n1
+                    elif j > i:
+                        positions[m] = min(j, i+n2)
+            for m, j in positions.items():
+                assert m.get() == j
+            assert sorted(positions.values()) == \
+                [j for j, m in b.all_marks()]
+    nmax = 15
+
+
+def _check(tree, root=True):
+    # Checks the tree invariants and returns the depth.
+    if isinstance(tree, Mark):
+        return 0
+    assert len(tree.childs) <= nmax
+    assert root or len(tree.childs) >= nmin()
+    assert tree.n == sum([child.n for child in tree.childs])
+    depths = set()
+    for child in tree.childs:
+        assert child.parent is tree
+        depths.add(_check(child, False))
+    assert len(depths) <= 1
+    return max(depths or [0])+1
+
+
+def test_06():
+    "balance, create_marks"
+    global nmax
+    from random import Random
+    random = Random(0)
+    for nmax in (3, 5, 15):
+        b = MarkBuffer()
+        marks = []
+        for i in range(2000):
+            marks.append(b.create_mark(random.randrange(10000)))
+        d = _check(b.tree)
+        random.shuffle(marks)
+        for m in marks[:-10]:
+            b.remove_mark(m)
+        # the minimum number of marks for a tree of depth d is
+        # 2*nmin()**(d-1)
+        d2 = _check(b.tree)
+        assert d2 == 1 or 2*nmin()**(d2-1) <= 10
+        positions = sorted([random.randrange(10000) for i in range(1000)])
+        new = b.create_marks(positions, 'new')
+        assert [m.get() for m in new] == positions
+        assert _check(b.tree) <= d
+        l = b.all_marks()
+        assert [i for i, m in l] == sorted([m.get() for m in new+marks[-10:]])
+        for i1, i2 in ((0, 10000), (500, 600), (5000, 5000)):
+            assert b.get_marks(i1, i2) == [x for x in l if i1 <= x[0] < i2]
+        for m in new+marks[-10:]:
+            b.remove_mark(m)
+        assert b.all_marks() == []
+    nmax = 15
+
+
+def _benchmark_00(Buffer, nmarks=1000):
     from random import randrange
     b = Buffer()
-    for i in range(1000):
-        b.create_mark(randrange(10000))
+    for i in range(nmarks):
+        b.create_mark(randrange(10*nmarks))
     #b._dump()
+    return b
 
 def benchmark_00a():
     _benchmark_00(MarkBuffer)
@@ -473,14 +699,12 @@ def benchmark_00b():
     _benchmark_00(LinearBuffer)
 
 
-def _benchmark_01(Buffer):
+def _benchmark_01(Buffer, nmarks=1000, nedits=10000):
     from random import randrange
-    b = Buffer()
-    for i in range(1000):
-        b.create_mark(randrange(10000))
-
-    for i in range(10000):
-        b.insert(randrange(10000), randrange(100))
+    b = _benchmark_00(Buffer, nmarks)
+    size = 10*nmarks
+    for i in range(nedits):
+        b.insert(randrange(size), randrange(100))
 
 
 def benchmark_01a():
@@ -491,13 +715,12 @@ def benchmark_01b():
     # 10x slower YES!!!
 
 
-def _benchmark_02(Buffer):
+def _benchmark_02(Buffer, nmarks=1000, nedits=10000):
     from random import randrange
-    b = Buffer()
-    for i in range(1000):
-        b.create_mark(randrange(10000))
-    for i in range(10000):
-        i1 = randrange(10000)
+    b = _benchmark_00(Buffer, nmarks)
+    size = 10*nmarks
+    for i in range(nedits):
+        i1 = randrange(size)
         i2 = i1+randrange(10)
         b.remove(i1, i2)
 
@@ -509,4 +732,42 @@ def benchmark_02b():
     # 5x slower
 
 
+def benchmark_03():
+    "10^5 marks"
+    import time
+    from random import Random
+    nmarks = 10**5
+    size = 10*nmarks
+    for Buffer in (MarkBuffer, LinearBuffer):
+        random = Random(0)
+        b = Buffer()
+        t0 = time.time()
+        for i in range(nmarks):
+            b.create_mark(random.randrange(size))
+        t1 = time.time()
+        for i in range(1000):
+            b.insert(random.randrange(size), random.randrange(100))
+        t2 = time.time()
+        for i in range(1000):
+            i1 = random.randrange(size)
+            b.remove(i1, i1+random.randrange(10))
+        t3 = time.time()
+        print("%-12s: create %.2f s, 1000 inserts %.2f s, "
+              "1000 removes %.2f s" % (Buffer.__name__, t1-t0, t2-t1, t3-t2))
 
+    b = MarkBuffer()
+    positions = sorted([random.randrange(size) for i in range(nmarks)])
+    t0 = time.time()
+    marks = b.create_marks(positions)
+    t1 = time.time()
+    for i in range(1000):
+        i1 = random.randrange(size)
+        b.get_marks(i1, i1+100)
+    t2 = time.time()
+    random.shuffle(marks)
+    for m in marks[:nmarks//2]:
+        b.remove_mark(m)
+    t3 = time.time()
+    print("create_marks %.2f s, 1000 get_marks %.3f s, "
+          "%i remove_mark %.2f s, depth %i" % (
+              t1-t0, t2-t1, nmarks//2, t3-t2, depth(b.tree)))
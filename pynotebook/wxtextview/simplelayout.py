@@ -119,6 +119,7 @@ class Factory(_Factory):
 
 class Builder(BuilderBase, Factory):
     Paragraph = Paragraph
+    partial_updates = True
 
     def __init__(self, model, device=TESTDEVICE, maxw=0):
         self.model = model
@@ -191,6 +192,17 @@ class Builder(BuilderBase, Factory):
         new = self.create_paragraphs(texel, j1, j2-n)
         self.replace_paragraphs(j1, j2, new)
 
+    def replaced(self, i, n1, n2):
+        # Combination of removed and inserted: *n1* characters at
+        # index *i* have been replaced by *n2* new characters.
+        i2 = i+n1
+        if i2<len(self._layout):
+            i2 = i2+1
+        j1, j2 = self.get_envelope(i, i2)
+        texel = self.extended_texel()
+        new = self.create_paragraphs(texel, j1, j2-n1+n2)
+        self.replace_paragraphs(j1, j2, new)
+
 
 
 def _create_testobjects(s):
@@ -371,3 +383,29 @@ def test_05():
     # ...
 
 
+
+
+def test_06():
+    "replaced"
+    from ..textmodel.textmodel import TextModel
+    from ..textmodel.texeltree import diff
+    model = TextModel("\n".join("line %i" % k for k in range(200)))
+    builder = Builder(model)
+    builder.rebuild()
+    old = model.texel
+    model.insert_text(30, "xyz\nabc")
+    model.remove(800, 820)
+    model.set_properties(1500, 1510, bold=True)
+    ranges = diff(old, model.texel)
+    assert len(ranges) == 3
+    for i1, i2, j1, j2 in ranges:
+        builder.replaced(j1, i2-i1, j2-j1)
+    layout = builder.get_layout()
+    assert check_box(layout, model.get_xtexel())
+    builder2 = Builder(model)
+    builder2.rebuild()
+    def paragraphs(box):
+        if box.is_group:
+            return sum([paragraphs(child) for child in box.childs], [])
+        return [str(box)]
+    assert paragraphs(layout) == paragraphs(builder2.get_layout())
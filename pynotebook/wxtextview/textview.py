@@ -4,8 +4,10 @@
 from ..textmodel.viewbase import ViewBase, overridable_property
 from ..textmodel.modelbase import Model
 from ..textmodel.textmodel import dump_range
-from ..textmodel.texeltree import length, iter_childs
+from ..textmodel.texeltree import length, iter_childs, diff
+from ..textmodel.weights import get_weight
 from ..textmodel import TextModel
+from .markbuffer import MarkBuffer
 import sys
 
 
@@ -24,6 +26,21 @@ def undo(info):
     return redo
 
 
+def translated(i, changes):
+    # Translates index *i* over a sorted list of changes (i1, i2, n),
+    # where the text between i1 and i2 has been replaced by n
+    # characters. Inserts at *i* move the index. Indices inside of a
+    # removed range are moved to its start.
+    delta = 0
+    for i1, i2, n in changes:
+        if i1 > i or (i1 == i and i1 < i2):
+            break
+        if i < i2:
+            return i1+delta
+        delta += n-(i2-i1)
+    return i+delta
+
+
 inf = sys.maxsize
 def right_limit(texel, i0, i):
     if i <= i0 or i>= i0+length(texel):
@@ -68,14 +85,35 @@ def left_limit(texel, i0, i):
     return 0
 
 
+def word_end(model, i):
+    """Returns the end of the word at or after index *i*."""
+    inword = False
+    for j, c in model.iter_chars(i):
+        if c.isalnum():
+            inword = True
+        elif inword:
+            return j
+    return len(model)
+
+
+def word_begin(model, i):
+    """Returns the begin of the word at or before index *i*."""
+    inword = False
+    for j, c in model.iter_chars(i, backward=True):
+        if c.isalnum():
+            inword = True
+        elif inword:
+            return j+1
+    return 0
+
+
 
 class TextView(ViewBase, Model):
     index = overridable_property('index')
-    _index = 0
     selection = overridable_property('selection') # NOTE: i2 can also
                                                   # be smaller than
                                                   # i1!
-    _selection = None
+    _selection_marks = None
     maxw = overridable_property('maxw')
     _maxw = 0
     _scrollrate = 10, 10
@@ -91,6 +129,11 @@ class TextView(ViewBase, Model):
 
     def set_model(self, model):
         ViewBase.set_model(self, model)
+        # Positions in the text, such as index and selection, are
+        # kept as marks.
+        self.marks = MarkBuffer()
+        self._index_mark = self.marks.create_mark(0, 'index')
+        self._selection_marks = None
         self.builder = self.create_builder()
         self.rebuild()
 
@@ -227,8 +270,27 @@ class TextView(ViewBase, Model):
     def _set_texel(self, new):
         old = self.model.texel
         self.model.texel = new
-        self.index = min(len(self.model), self.index)        
-        self.rebuild()
+        # Only update the layout where the trees differ. Changes
+        # which are not separated by at least two line breaks are
+        # joined, because the builder updates whole paragraphs.
+        changes = []
+        for i1, i2, j1, j2 in diff(old, new):
+            if changes and get_weight(new, 2, j1)- \
+               get_weight(new, 2, changes[-1][3]) < 2:
+                k1, k2, l1, l2 = changes[-1]
+                changes[-1] = (k1, i2, l1, j2)
+            else:
+                changes.append((i1, i2, j1, j2))
+        builder = self.builder
+        if builder.partial_updates:
+            for i1, i2, j1, j2 in changes:
+                builder.replaced(j1, i2-i1, j2-j1)
+        elif changes:
+            builder.rebuild() # once for all changes
+        self.layout = self.builder.get_layout()
+        self._update_marks(self._replace_marks, 
+                           [(i1, i2, j2-j1) for i1, i2, j1, j2 in changes])
+        self.refresh()
         return self._set_texel, old
 
     def get_maxw(self):
@@ -243,70 +305,55 @@ class TextView(ViewBase, Model):
         self.Refresh()
         self.notify_views('maxw_changed')
 
-    def indent_rows(self, firstrow, lastrow, n=4):
-        model = self.model
-        has_selection = self.has_selection()
-        if has_selection:
-            s1, s2 = self.selection
-        else:
-            s1 = s2 = 0
-        index = self.index
-        for line in range(lastrow, firstrow-1, -1): # indent
-            i = model.linestart(line)
-            model.insert_text(i, ' '*n)
-            if index >= i:
-                index += n
-            if s1 >= i:
-                s1 += n
-            if s2 >= i:
-                s2 += n
-        self.index = index
-        if has_selection:
-            self.selection = (s1, s2)            
-        info = self._dedent_rows, firstrow, lastrow, n
+    def apply_edits(self, edits):
+        # Replaces several ranges in one step, see
+        # TextModel.apply_edits. The change is undone as a whole.
+        info = self._apply_edits(edits)
         self.add_undo(info)
 
-    def _dedent_rows(self, firstrow, lastrow, n):
-        has_selection = self.has_selection()
-        if has_selection:
+    def _apply_edits(self, edits):
+        edits = list(edits)
+        changes = [(i1, i2, 0 if textmodel is None else len(textmodel))
+                   for i1, i2, textmodel in edits]
+        index = translated(self.index, changes)
+        if self.has_selection():
             s1, s2 = self.selection
+            selection = translated(s1, changes), translated(s2, changes)
         else:
-            s1 = s2 = 0
-        index = self.index
-        memo = []
-        model = self.model
-        for line in reversed(list(range(firstrow, lastrow+1))):
-            i = model.linestart(line)
-            for j in range(i, i+n+1):
-                if j > len(model): break
-                if model.get_text(j, j+1) != ' ': break
-            memo.append(model.remove(i, j))
-            if index > i:
-                index = i+max(0, index-j)
-            if s1 > i:
-                s1 = i+max(0, s1-j)
-            if s2 > i:
-                s2 = i+max(0, s2-j)
+            selection = None
+        undo = self.model.apply_edits(edits)
         self.index = index
-        if has_selection:
-            self.selection = (s1, s2)
-            
-        assert len(memo) == lastrow-firstrow+1
-        return self._undo_dedent, firstrow, memo, n
-        
-    def dedent_rows(self, firstrow, lastrow, n=4):
-        info = self._dedent_rows(firstrow, lastrow, n)
-        self.add_undo(info)
+        if selection is not None:
+            self.selection = selection
+        return self._apply_edits, undo
+
+    def _row_starts(self, firstrow, lastrow):
+        model = self.model
+        i1 = model.linestart(firstrow)
+        i2 = model.linestart(lastrow)
+        return [i for i, j, parstyle in model.iter_paragraphs(i1, i2)]
+
+    def replace_all(self, pattern, repl, i1=0, i2=None, flags=0):
+        # Replaces all matches of *pattern* in one step. See
+        # TextModel.get_replacements for the arguments.
+        edits = self.model.get_replacements(pattern, repl, i1, i2, flags)
+        if edits:
+            self.apply_edits(edits)
+        return len(edits)
+
+    def indent_rows(self, firstrow, lastrow, n=4):
+        spaces = self.model.create_textmodel(' '*n)
+        edits = [(i, i, spaces) for i in self._row_starts(firstrow, lastrow)]
+        self.apply_edits(edits)
 
-    def _undo_dedent(self, firstrow, memo, n):
+    def dedent_rows(self, firstrow, lastrow, n=4):
         model = self.model
-        lastrow = firstrow+len(memo)-1
-        memo = list(memo)
-        for line in reversed(list(range(firstrow, lastrow+1))):
-            i = model.linestart(line)
-            model.insert(i, memo[0])
-            memo = memo[1:]
-        return self._dedent_rows, firstrow, lastrow, n
+        edits = []
+        for i in self._row_starts(firstrow, lastrow):
+            text = model.get_text(i, min(i+n, len(model)))
+            j = len(text)-len(text.lstrip(' '))
+            edits.append((i, i+j, None))
+        self.apply_edits(edits)
 
     def compute_index(self, x, y):
         if y >= self.layout.height:
@@ -360,28 +407,11 @@ class TextView(ViewBase, Model):
             row2 = model.index2position(s2)[0]
             self.dedent_rows(row1, row2)            
         elif action == 'move_word_end':
-            i = index
-            n = len(model)
-            try:
-                while not model.get_text(i, i+1).isalnum():
-                    i = i+1
-                while model.get_text(i, i+1).isalnum():
-                    i = i+1
-            except IndexError:
-                i = n
-            self.set_index(i, shift)
+            self.set_index(word_end(model, index), shift)
         elif action == 'move_right':
             self.set_index(index+1, shift)
         elif action == 'move_word_begin':
-            i = index
-            try:
-                while not model.get_text(i-1, i).isalnum():
-                    i = i-1
-                while model.get_text(i-1, i).isalnum():
-                    i = i-1
-            except IndexError:
-                i = 0
-            self.set_index(i, shift)
+            self.set_index(word_begin(model, index), shift)
         elif action == 'move_left':
             self.set_index(index-1, shift)
         elif action == 'move_paragraph_end':
@@ -474,14 +504,7 @@ class TextView(ViewBase, Model):
             self.remove(j1, j2)
         elif action == 'del_word_left':
             # find the beginning of the word
-            i = index
-            try:
-                while not model.get_text(i-1, i).isalnum():
-                    i = i-1
-                while model.get_text(i-1, i).isalnum():
-                    i = i-1
-            except IndexError:
-                i = 0
+            i = word_begin(model, index)
             i = max(i, left_limit(model.texel, 0, index))                
             j1, j2 = layout.extend_range(i, index)
             self.remove(j1, j2)
@@ -526,24 +549,8 @@ class TextView(ViewBase, Model):
         if i is None:
             return
         model = self.model
-        n = len(model)
-        try:
-            while not model.get_text(i-1, i).isalnum():
-                i = i-1
-            while model.get_text(i-1, i).isalnum():
-                i = i-1
-        except IndexError:
-            i = 0
-        i1 = i
-        i = i1
-        try:
-            while not model.get_text(i, i+1).isalnum():
-                i = i+1
-            while model.get_text(i, i+1).isalnum():
-                i = i+1
-        except IndexError:
-            i = n
-        i2 = i
+        i1 = word_begin(model, i)
+        i2 = word_end(model, i1)
         self.index = i2
         self.selection = (i1, i2)
 
@@ -565,63 +572,118 @@ class TextView(ViewBase, Model):
         self.layout = self.builder.get_layout()
         if debug:
             self.check()
-        if i>= self.index:
-            self.index += n
-        if self._selection is not None:
-            s1, s2 = self.selection
-            if i >= s1:
-                s1 += n
-            if i >= s2:
-                s2 += n
-            self.selection = s1, s2
+        self._update_marks(self.marks.insert, i, n)
+        self.refresh()
+
+    def replaced(self, model, i, n1, n2):
+        self.builder.replaced(i, n1, n2)
+        self.layout = self.builder.get_layout()
+        self._update_marks(self.marks.replace, i, n1, n2)
         self.refresh()
 
+    _deferred = None # explicit assignments while changes are deferred
+    def changes_started(self, model):
+        # Notification is deferred, see Model.changes(). Until the
+        # end of the block the layout is out of date. We record
+        # index and selection when they are set explicitly, because
+        # these already refer to the new text.
+        self._deferred = {}
+
+    def changed(self, model, ranges):
+        # Called once for all changes made inside of a "with
+        # model.changes()"-block. The layout is updated in one step.
+        i = ranges[0][0]
+        n1 = ranges[-1][1]-i
+        n2 = n1+sum([n-(i2-i1) for i1, i2, n in ranges])
+        self.builder.replaced(i, n1, n2)
+        self.layout = self.builder.get_layout()
+        self._update_marks(self._replace_marks, ranges)
+        deferred = self._deferred or {}
+        if 'selection' in deferred:
+            self.selection = deferred['selection']
+        if 'index' in deferred:
+            self.set_index(deferred['index'], update=False)
+        self.refresh()
+
+    def changes_finished(self, model):
+        self._deferred = None
+        self.adjust_viewport()
+
     def removed(self, model, i, text):
         self.builder.removed(i, len(text))
         self.layout = self.builder.get_layout()
-        n = len(text)
-        i1 = i
-        i2 = i+n
-        m = len(model)
-        index = self.index
-        if index >= i2:
-            self.index = index-n
-        elif index > i1:
-            self.index = i1
-        if self._selection is not None:
-            s1, s2 = self.selection
-            if s1 >= i2:
-                s1 -= n
-            elif s1 > i1:
-                s1 = i1
-            if s2 >= i2:
-                s2 -= n
-            elif s2 > i1:
-                s2 = i1
-            self.selection = min(s1, m), min(s2, m)
+        self._update_marks(self.marks.remove, i, i+len(text))
         self.refresh()
 
     def keep_cursor_on_screen(self):
         pass
         
+    ### Marks
+    def create_mark(self, i, label=''):
+        # Creates a mark at index *i*. Marks move with the text when
+        # the model is changed. Use mark.get() to get the current
+        # position.
+        if not 0 <= i <= len(self.model):
+            raise IndexError(i)
+        return self.marks.create_mark(i, label)
+
+    def create_marks(self, positions, label=''):
+        # Creates marks for a sorted sequence of indices. Much faster
+        # than calling create_mark for each of them.
+        positions = list(positions)
+        if positions and not (0 <= positions[0] and \
+                              positions[-1] <= len(self.model)):
+            raise IndexError((positions[0], positions[-1]))
+        return self.marks.create_marks(positions, label)
+
+    def remove_mark(self, mark):
+        self.marks.remove_mark(mark)
+
+    def get_marks(self, i1, i2):
+        # Returns a list of tuples (i, mark) for all marks between
+        # *i1* and *i2*. *i2* is excluded.
+        return self.marks.get_marks(i1, i2)
+
+    def _replace_marks(self, changes):
+        # Applies a sorted list of changes (i1, i2, n) to the marks.
+        for i1, i2, n in reversed(changes):
+            self.marks.replace(i1, i2-i1, n)
+
+    def _update_marks(self, fun, *args):
+        # Moves the marks by calling *fun* and notifies about changes
+        # of index and selection.
+        index = self.index
+        selection = self.selection
+        fun(*args)
+        if self.selection != selection:
+            self.Refresh()
+            self.notify_views('selection_changed')
+        if self.index != index:
+            if self._deferred is None:
+                self.adjust_viewport()
+            self.notify_views('index_changed')
+
     ### Index
     def set_index(self, index, extend=False, update=True):
         if index < 0:
             index = 0
         elif index > len(self.model):
             index = len(self.model)
-        if index != self._index:
-            self._index = index
+        if self._deferred is not None:
+            self._deferred['index'] = index
+        if index != self.index:
+            self.marks.move_mark(self._index_mark, index)
             if extend:
                 self.extend_selection()
             elif update:
                 self.start_selection()
-            self.adjust_viewport()
+            if self._deferred is None: # else the layout is outdated
+                self.adjust_viewport()
             self.refresh()
             self.notify_views('index_changed')
 
     def get_index(self):
-        return self._index
+        return self._index_mark.get()
 
     def current_position(self):
         # Returns the cursorposition as tuple (row, col)
@@ -644,15 +706,28 @@ class TextView(ViewBase, Model):
         self.set_index(model.position2index(row, col), extend, update)
 
     def get_selection(self):
-        return self._selection
+        marks = self._selection_marks
+        if marks is None:
+            return None
+        return marks[0].get(), marks[1].get()
 
     def set_selection(self, selection):
-        old = self._selection
+        if self._deferred is not None:
+            self._deferred['selection'] = selection
+        old = self.selection
         if selection == old:
             return
-        if old is not None:
-            i1, i2 = old
-        self._selection = selection
+        marks = self._selection_marks
+        if selection is None:
+            for mark in marks:
+                self.marks.remove_mark(mark)
+            self._selection_marks = None
+        elif marks is None:
+            self._selection_marks = tuple(
+                [self.marks.create_mark(i, 'selection') for i in selection])
+        else:
+            for mark, i in zip(marks, selection):
+                self.marks.move_mark(mark, i)
         self.Refresh()
         self.notify_views('selection_changed')
 
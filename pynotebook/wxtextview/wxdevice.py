@@ -1,6 +1,9 @@
 # -*- coding: latin-1 -*-
 
 import wx
+from itertools import accumulate
+from ..textmodel.texeltree import hash_style
+from .lrucache import LRUCache
 
 
 defaultstyle = dict(
@@ -56,91 +59,195 @@ def get_font(style):
         style['underline'], style['facename'])
 
 
-# Profiling revelead that a lot of time is spent in the measure_*
-# functions. We therefore cache the results in a fixed size dict. This
-# reduces the time spent by ~90%.
-_cache = dict()
-_cache_keys = []
+# Profiling revealed that a lot of time is spent measuring text. For
+# every font we therefore keep a table of character advances, so that
+# the extent of a string is simply the sum of the advances of its
+# characters. This is only correct if the font has no kerning and no
+# ligatures and if the advances are not rounded. This is checked once
+# per font (see FontMetrics.validate). Fonts which fail the check, and
+# strings containing control characters, are measured by wx. These
+# results are cached.
+
+use_advances = True # can be switched off for benchmarking
+
+# Sample text for validation. It contains typical kerning pairs and
+# ligatures.
+SAMPLE = u"AVAWAYTo Te Ty LT P. r. fi fl ffi 1.1 m,m Wa Yo \xc4V" * 4
+
+
+class FontMetrics:
+    """Measures text in one font.
+
+       *context* is a wx.DC or a wx.GraphicsContext with the font
+       already set.
+    """
+    tolerance = 1e-3 # GraphicsContexts return floats
+
+    def __init__(self, font, context):
+        self.font = font
+        self.context = context
+        self.advances = dict() # char -> advance or None if not usable
+        self.cache = LRUCache(1000) # results of native measurement
+        self.height = None
+        self.arithmetic = use_advances and self.validate()
+
+    def validate(self):
+        """Checks whether widths can be computed from the advances."""
+        context = self.context
+        w, h = context.GetTextExtent(SAMPLE)
+        self.height = h
+        self.learn(SAMPLE)
+        advances = self.advances
+        if None in [advances[c] for c in SAMPLE]:
+            return False
+        parts = self._parts(SAMPLE)
+        if abs(parts[-1]-w) > self.tolerance:
+            return False
+        native = context.GetPartialTextExtents(SAMPLE)
+        for x1, x2 in zip(parts, native):
+            if abs(x1-x2) > self.tolerance:
+                return False
+        return True
+
+    def learn(self, text):
+        """Adds the advances of all characters in *text* to the table."""
+        advances = self.advances
+        for c in set(text):
+            if c in advances:
+                continue
+            if c < u' ':
+                advances[c] = None # control characters
+                continue
+            w, h = self.context.GetTextExtent(c)
+            if h != self.height:
+                advances[c] = None # e.g. taken from a fallback font
+            else:
+                advances[c] = w
+
+    def _parts(self, text):
+        return list(accumulate([self.advances[c] for c in text]))
+
+    def measure(self, text):
+        if self.arithmetic and text:
+            advances = self.advances
+            try:
+                return sum([advances[c] for c in text]), self.height
+            except KeyError:
+                self.learn(text)
+                return self.measure(text)
+            except TypeError: # not usable advance
+                pass
+        key = text, False
+        try:
+            return self.cache[key]
+        except KeyError:
+            pass
+        r = self.cache[key] = self.context.GetTextExtent(text)
+        return r
+
+    def measure_parts(self, text):
+        if self.arithmetic:
+            try:
+                return self._parts(text)
+            except KeyError:
+                self.learn(text)
+                return self.measure_parts(text)
+            except TypeError:
+                pass
+        key = text, True
+        try:
+            return self.cache[key]
+        except KeyError:
+            pass
+        r = self.cache[key] = self.context.GetPartialTextExtents(text)
+        return r
+
+
+def font_key(style):
+    # The properties which determine the font of *style*. Style must
+    # be filled.
+    return (style['fontsize'], style.get('family', 'modern'),
+            style.get('italic', False), style.get('bold', False),
+            style['underline'], style['facename'])
+
+
+_fonts = dict() # font key -> font
+_metrics = dict() # (style key, measuring context factory) -> FontMetrics
+_font_metrics = dict() # (font key, measuring context factory) -> FontMetrics
+
+def get_cached_font(style):
+    style = filled(style)
+    key = font_key(style)
+    try:
+        return _fonts[key]
+    except KeyError:
+        pass
+    font = _fonts[key] = get_font(style)
+    return font
 
-def measure_win(self, text, style):
-    key = text, tuple(style.items())
+
+def get_metrics(style, new_context):
+    """Returns the FontMetrics for *style*.
+
+       *new_context* is called with a font and must return a measuring
+       context.
+    """
+    key = hash_style(style), new_context
     try:
-        return _cache[key]
-    except:
+        return _metrics[key]
+    except KeyError:
         pass
-    style = filled(style)
-    font = get_font(style)
+    _style = filled(style)
+    fkey = font_key(_style), new_context
+    try:
+        metrics = _font_metrics[fkey]
+    except KeyError:
+        font = get_cached_font(_style)
+        metrics = _font_metrics[fkey] = FontMetrics(font, new_context(font))
+    _metrics[key] = metrics
+    return metrics
+
+
+def clear_metrics():
+    _metrics.clear()
+    _font_metrics.clear()
+
+
+def new_dc(font):
     dc = wx.MemoryDC()
     dc.SetFont(font)
-    w, h = dc.GetTextExtent(text)
-    _cache[key] = w, h
-    _cache_keys.insert(0, key)
-    if len(_cache_keys) > 1000:
-        _key = _cache_keys.pop()
-        del _cache[key]        
-    return w, h
+    return dc
 
-def measure_mac(self, text, style):
-    key = text, tuple(style.items())
-    try:
-        return _cache[key]
-    except:
-        pass
-    style = filled(style)
-    font = get_font(style)
+
+def new_gc(font):
     gc = wx.GraphicsContext_CreateMeasuringContext()
     gc.SetFont(font)
-    w, h = gc.GetTextExtent(text)
-    _cache[key] = w, h
-    _cache_keys.insert(0, key)
-    if len(_cache_keys) > 1000:
-        _key = _cache_keys.pop()
-        del _cache[key]        
-    return w, h
+    return gc
+
+
+def measure_win(self, text, style):
+    return get_metrics(style, new_dc).measure(text)
+
+def measure_mac(self, text, style):
+    return get_metrics(style, new_gc).measure(text)
 
 def measure_gtk(self, text, style):
-    key = text, tuple(style.items())
-    try:
-        return _cache[key]
-    except:
-        pass
-    style = filled(style)
-    text = text.replace('\n', ' ') # replace newlines to avoid double lines
-    font = get_font(style)
-    # GC returns wrong font metric values in gtk! We therefore use the DC.  
-    dc = wx.MemoryDC()
-    dc.SetFont(font)
-    w, h = dc.GetTextExtent(text)
-    _cache[key] = w, h
-    _cache_keys.insert(0, key)
-    if len(_cache_keys) > 1000:
-        _key = _cache_keys.pop()
-        del _cache[key]        
-    return w, h
+    # GC returns wrong font metric values in gtk! We therefore use the DC.
+    if u'\n' in text:
+        text = text.replace(u'\n', u' ') # avoid double lines
+    return get_metrics(style, new_dc).measure(text)
 
 
 def measure_parts_win(self, text, style):
-    style = filled(style)
-    font = get_font(style)
-    dc = wx.MemoryDC()
-    dc.SetFont(font)
-    return dc.GetPartialTextExtents(text)
+    return get_metrics(style, new_dc).measure_parts(text)
 
 
 def measure_parts_gtk(self, text, style):
-    style = filled(style)
-    font = get_font(style)
-    dc = wx.MemoryDC()
-    dc.SetFont(font)
-    return dc.GetPartialTextExtents(text)
+    return get_metrics(style, new_dc).measure_parts(text)
 
 
 def measure_parts_mac(self, text, style):
-    style = filled(style)
-    font = get_font(style)
-    gc = wx.GraphicsContext_CreateMeasuringContext()
-    gc.SetFont(font)
-    return gc.GetPartialTextExtents(text)
+    return get_metrics(style, new_gc).measure_parts(text)
 
 
 class WxDevice:
@@ -183,7 +290,7 @@ class DCStyler:
         self.last_style = style
 
         _style = filled(style)
-        font = get_font(_style)
+        font = get_cached_font(_style)
         self.dc.SetFont(font)            
         try: # Phoenix
             self.dc.SetTextBackground(wx.Colour(_style['bgcolor']))
@@ -225,3 +332,44 @@ def test_00():
 
     # just check that this does not give an exception
     print(device.measure_parts("asdasd", defaultstyle))
+
+
+def test_01():
+    "FontMetrics"
+    class Context:
+        # Measuring context with 2 pixels per character. "AV" is
+        # kerned if *kerning* is set.
+        def __init__(self, kerning=False):
+            self.kerning = kerning
+            self.calls = 0
+        def GetPartialTextExtents(self, text):
+            self.calls += 1
+            r = []
+            x = 0
+            for i, c in enumerate(text):
+                x += 2
+                if self.kerning and text[i-1:i+1] == 'AV':
+                    x -= 1
+                r.append(x)
+            return r
+        def GetTextExtent(self, text):
+            parts = self.GetPartialTextExtents(text)
+            return (parts[-1] if parts else 0), 10
+
+    metrics = FontMetrics(None, Context())
+    assert metrics.arithmetic
+    context = metrics.context
+    n = context.calls
+    assert metrics.measure(u'AVo') == (6, 10)
+    assert metrics.measure_parts(u'AVo') == [2, 4, 6]
+    assert context.calls == n
+    assert metrics.measure(u'\u20ac') == (2, 10) # learns new characters
+    assert context.calls == n+1
+    assert metrics.measure(u'a\to') == (6, 10) # measured natively
+    assert metrics.measure(u'a\to') == (6, 10) # cached
+    assert context.calls == n+2
+
+    metrics = FontMetrics(None, Context(kerning=True))
+    assert not metrics.arithmetic
+    assert metrics.measure(u'AVo') == (5, 10)
+    assert metrics.measure_parts(u'AVo') == [2, 3, 5]
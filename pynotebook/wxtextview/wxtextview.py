@@ -370,6 +370,49 @@ def test_14():
     view.add_undo(view.remove(9, 10))
     assert len(view._undoinfo) == 1
 
+def test_15():
+    "indent_rows, dedent_rows"
+    ns = init_testing(redirect=False)
+    model = ns['model']
+    view = ns['view']
+    text = model.get_text()
+    n = model.nlines()
+    view.index = len(model)
+    view.indent_rows(0, n-1)
+    assert model.get_text() == '\n'.join(
+        '    '+line for line in text.split('\n'))
+    assert view.index == len(model)
+    assert len(view.layout) == len(model)+1
+    view.dedent_rows(0, n-1)
+    assert model.get_text() == text
+    view.undo()
+    view.undo()
+    assert model.get_text() == text
+    assert view.undocount() == 0
+
+def test_16():
+    "marks"
+    ns = init_testing(redirect=False)
+    model = ns['model']
+    view = ns['view']
+    view.index = 10
+    view.selection = (5, 15)
+    mark = view.create_mark(20, 'bookmark')
+    model.insert_text(0, 'abc')
+    assert view.index == 13
+    assert view.selection == (8, 18)
+    assert mark.get() == 23
+    model.insert_text(30, 'abc')
+    assert view.index == 13
+    assert mark.get() == 23
+    model.remove(0, 10)
+    assert view.index == 3
+    assert view.selection == (0, 8)
+    assert mark.get() == 13
+    assert view.get_marks(13, 14) == [(13, mark)]
+    view.remove_mark(mark)
+    assert mark.get() is None
+
 def demo_00():
     "simple demo"
     ns = test_02()